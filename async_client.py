@@ -0,0 +1,424 @@
+import asyncio
+import itertools
+import os
+import sys
+import threading
+
+import client_utils
+import file_transfer
+import framing
+import mux_transfers
+
+# Seconds to wait for the server to accept or confirm a transfer.
+REPLY_TIMEOUT = 30
+
+# A progress line is printed every time a transfer gets this many percent further.
+PROGRESS_STEP = 25
+
+# Downloads are written to FILENAME.TRANSFER_ID.DOWNLOAD_SUFFIX and renamed
+# once their digest matches.
+DOWNLOAD_SUFFIX = "download"
+
+
+class Transfer:
+    """The progress of one upload or download."""
+
+    def __init__(self, direction, filename, peer, size):
+        """Initialize the progress.
+
+        Input Arguments:
+        - direction (str): "upload" or "download".
+        - filename (str): The file name.
+        - peer (str): Where the file goes to or comes from.
+        - size (int): The file size in bytes.
+        """
+        self.direction = direction
+        self.filename = filename
+        self.peer = peer
+        self.size = size
+        self.done = 0
+        self._reported = 0
+
+    def add(self, count):
+        """Count count more bytes and print a line at every PROGRESS_STEP percent."""
+        self.done += count
+        percent = self.percent()
+        if percent >= self._reported + PROGRESS_STEP and percent < 100:
+            self._reported = percent - percent % PROGRESS_STEP
+            print(f"{self.describe()}: {self._reported}%")
+
+    def percent(self):
+        return 100 * self.done // self.size if self.size else 100
+
+    def describe(self):
+        preposition = "to" if self.direction == "upload" else "from"
+        return f"{self.direction.capitalize()} of '{self.filename}' {preposition} {self.peer}"
+
+
+class AsyncClient:
+    """A chat client that runs file transfers in the background.
+
+    One task reads frames from the server, one reads the user's lines and
+    one sends heartbeats; every upload gets a task of its own. When the
+    server agrees on chunked transfers ("mux" in its hello) files move as
+    chunk frames tagged with a transfer id (see mux_transfers), so several
+    uploads and downloads share the connection with chat and the user can
+    keep typing and reading while they run. Against a server that does not,
+    files are sent and received as raw bodies like client.py does, which
+    holds up the other frames while a body is on the wire.
+    """
+
+    def __init__(self, reader, writer):
+        """Initialize the client.
+
+        Input Arguments:
+        - reader (asyncio.StreamReader): The stream reader of the connection.
+        - writer (asyncio.StreamWriter): The stream writer of the connection.
+        """
+        self.reader = reader
+        self.writer = writer
+        self.codec = framing.V1
+        self.loop = asyncio.get_running_loop()
+        # Held while a frame, or a raw file body, is written.
+        self.send_lock = asyncio.Lock()
+        # Transfer id -> future for the server's next answer about it.
+        self.replies = {}
+        # Transfer id -> Transfer, for the transfers running.
+        self.transfers = {}
+        # Transfer id -> (file, hasher, part path) of the downloads running.
+        self.downloads = {}
+        self.tasks = set()
+        self._ids = itertools.count(1)
+
+    async def send(self, header, message):
+        """Send one frame."""
+        await self.send_frame(framing.encode_message(header, message))
+
+    async def send_frame(self, frame):
+        """Send one encoded frame, after whatever is being sent now."""
+        async with self.send_lock:
+            self.writer.write(self.codec.wire(frame))
+            await self.writer.drain()
+
+    async def read(self, decode=True):
+        """Read one frame in the format agreed with the server."""
+        return await framing.read_message_async(self.reader, self.codec.version, decode)
+
+    async def prompt(self, text=""):
+        """Read a line from the user without holding up the loop."""
+        return (await self.loop.run_in_executor(None, input, text)).strip()
+
+    async def authenticate(self):
+        """Authenticate the client with the server, as client_utils.authenticate() does.
+
+        Output Arguments:
+        - bool: True if authentication is successful, False otherwise.
+        """
+        # Ask for the compact frame format and chunked transfers; the server
+        # answers after its prompt.
+        await self.send(framing.HELLO, framing.Codec(framing.VERSION, True, True, True).hello())
+        header, response = await self.read()
+        if header != "info":
+            return False
+
+        header, hello = await self.read()
+        if header == framing.HELLO:
+            self.codec = framing.Codec.from_hello(hello)
+
+        print(response)
+        if not response.endswith("(yes/no):"):
+            print("Invalid response.")
+            return False
+
+        choice = (await self.prompt()).lower()
+        await self.send("info", choice)
+        if choice == "no":
+            await self.send("info", await self.prompt("Enter a username: "))
+            header, message = await self.read()
+            while message != "Username registered successfully.":
+                await self.send("info", await self.prompt(message))
+                header, message = await self.read()
+            await self.send("info", await self.prompt("Enter a password: "))
+        elif choice == "yes":
+            await self.send("info", await self.prompt("Enter your username: "))
+            await self.send("info", await self.prompt("Enter your password: "))
+        else:
+            print("Invalid choice.")
+            return False
+        return True
+
+    def spawn(self, coroutine):
+        """Run a coroutine in the background and keep a reference to it until it ends."""
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def receive_messages(self):
+        """Read and process frames from the server until the connection closes."""
+        try:
+            while True:
+                header, payload = await self.read(decode=False)
+                if header == mux_transfers.CHUNK_HEADER:
+                    await self.receive_chunk(payload)
+                    continue
+                payload = payload.decode()
+
+                if not client_utils.validate_message(header):
+                    print("Invalid message received:", payload)
+                elif header == "cmd":
+                    # The server's pong to a heartbeat.
+                    continue
+                elif header == "file_transfer":
+                    await self.handle_file_transfer(payload)
+                else:
+                    print("=================")
+                    print(payload, end="")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("Disconnected from the server.")
+        finally:
+            for waiting in self.replies.values():
+                if not waiting.done():
+                    waiting.set_result(("failed", "the connection was closed"))
+            self.replies.clear()
+            for file, _, part_path in self.downloads.values():
+                file.close()
+                os.remove(part_path)
+            self.downloads.clear()
+
+    async def handle_file_transfer(self, payload):
+        """Handle a file_transfer frame from the server."""
+        kind, _, rest = payload.strip().partition(":")
+        if kind in ("accept", "refused", "done", "failed"):
+            identifier, _, reason = rest.partition(":")
+            waiting = self.replies.pop(identifier, None)
+            if waiting is not None and not waiting.done():
+                waiting.set_result((kind, reason))
+        elif kind == "recv":
+            self.start_download(rest)
+        elif kind == "end":
+            await self.finish_download(*rest.split(":"))
+        elif kind == "file_to":
+            # A raw body follows, relayed from a client on another server process.
+            sender, filename = rest.split(":")
+            filename = os.path.basename(filename)
+            print(f"Receiving '{filename}' from {sender}.")
+            with open(filename, "wb") as file:
+                await file_transfer.receive_file_body_async(self.reader, file)
+            print(f"File '{filename}' received from {sender}.")
+        elif payload.startswith("file from server:"):
+            await self.receive_server_body(payload.strip().split(":")[1:])
+        else:
+            print(payload, end="")
+
+    async def receive_server_body(self, fields):
+        """Receive a raw file body the server sent, resumable or not."""
+        filename = os.path.basename(fields[0])
+        with open(filename, "wb") as file:
+            if len(fields) == 3:
+                try:
+                    await file_transfer.receive_resumable_body_async(self.reader, file)
+                except file_transfer.IntegrityError:
+                    print(f"File '{filename}' from Server was damaged in transit and discarded.")
+                    return
+            else:
+                await file_transfer.receive_file_body_async(self.reader, file)
+        print(f"File '{filename}' received from Server.")
+
+    def start_download(self, fields):
+        """Open the part file of a download announced with recv:ID:SIZE:SENDER:FILENAME."""
+        identifier, size, sender, filename = fields.split(":", 3)
+        filename = os.path.basename(filename)
+        part_path = f"{filename}.{identifier}.{DOWNLOAD_SUFFIX}"
+        self.downloads[identifier] = (open(part_path, "wb"), file_transfer.new_hash(), part_path)
+        self.transfers[identifier] = Transfer("download", filename, sender, int(size))
+        print(f"{self.transfers[identifier].describe()} started ({size} bytes).")
+
+    async def receive_chunk(self, payload):
+        """Write the data of a chunk frame to its download."""
+        identifier, data = mux_transfers.parse_chunk(payload)
+        download = self.downloads.get(identifier)
+        if download is None:
+            return
+        file, hasher, _ = download
+        hasher.update(data)
+        await self.loop.run_in_executor(None, file.write, data)
+        self.transfers[identifier].add(len(data))
+
+    async def finish_download(self, identifier, digest):
+        """Keep a download whose digest matches, discard it otherwise."""
+        download = self.downloads.pop(identifier, None)
+        if download is None:
+            return
+        file, hasher, part_path = download
+        transfer = self.transfers.pop(identifier)
+        file.close()
+        if hasher.hexdigest() != digest or transfer.done != transfer.size:
+            os.remove(part_path)
+            print(f"File '{transfer.filename}' from {transfer.peer} was damaged in transit and discarded.")
+            return
+        os.replace(part_path, transfer.filename)
+        print(f"File '{transfer.filename}' received from {transfer.peer}.")
+
+    def expect_reply(self, identifier):
+        """Start waiting for the server's next answer about a transfer, before asking for it."""
+        waiting = self.replies[identifier] = self.loop.create_future()
+        return waiting
+
+    async def wait_reply(self, identifier, waiting):
+        """Wait for an answer expect_reply() is waiting for; returns (kind, reason)."""
+        try:
+            return await asyncio.wait_for(waiting, REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.replies.pop(identifier, None)
+            return "failed", "the server did not answer"
+
+    async def upload(self, filename, target):
+        """Send a file as chunk frames, to the server or to another client.
+
+        Input Arguments:
+        - filename (str): The file in the working directory.
+        - target (str): "server" or the username of the recipient.
+
+        Output Arguments:
+        - None
+        """
+        identifier = f"u{next(self._ids)}"
+        size = os.path.getsize(filename)
+        try:
+            waiting = self.expect_reply(identifier)
+            await self.send("file_transfer", f"send:{identifier}:{size}:{target}:{os.path.basename(filename)}")
+            kind, reason = await self.wait_reply(identifier, waiting)
+            if kind != "accept":
+                print(f"The server did not accept '{filename}': {reason}.")
+                return
+
+            transfer = self.transfers[identifier] = Transfer("upload", filename, target, size)
+            hasher = file_transfer.new_hash()
+            with open(filename, "rb") as file:
+                while True:
+                    data = await self.loop.run_in_executor(None, file.read, mux_transfers.CHUNK_SIZE)
+                    if not data:
+                        break
+                    hasher.update(data)
+                    await self.send_frame(mux_transfers.chunk_frame(identifier, data))
+                    transfer.add(len(data))
+            waiting = self.expect_reply(identifier)
+            await self.send("file_transfer", f"sent:{identifier}:{hasher.hexdigest()}")
+            kind, reason = await self.wait_reply(identifier, waiting)
+        except ConnectionError:
+            kind, reason = "failed", "the connection was closed"
+        finally:
+            self.transfers.pop(identifier, None)
+        if kind == "done":
+            print(f"File '{filename}' sent to {target}.")
+        else:
+            print(f"File '{filename}' could not be sent: {reason}.")
+
+    async def upload_raw(self, message, filename):
+        """Send a file_transfer request followed by a raw body, to a server without chunked transfers."""
+        try:
+            async with self.send_lock:
+                self.writer.write(self.codec.wire(framing.encode_message("file_transfer", message)))
+                with open(filename, "rb") as file:
+                    await file_transfer.send_file_body_async(self.writer, file)
+        except ConnectionError:
+            print(f"File '{filename}' could not be sent: the connection was closed.")
+            return
+        print(f"File '{filename}' sent to server.")
+
+    def show_transfers(self):
+        """Print the progress of every transfer running."""
+        if not self.transfers:
+            print("No transfers running.")
+        for transfer in self.transfers.values():
+            print(f"{transfer.describe()}: {transfer.done} of {transfer.size} bytes ({transfer.percent()}%)")
+
+    async def send_heartbeats(self):
+        """Send cmd:ping every client_utils.HEARTBEAT_INTERVAL seconds."""
+        while True:
+            await asyncio.sleep(client_utils.HEARTBEAT_INTERVAL)
+            await self.send("cmd", "ping")
+
+    async def handle_input(self):
+        """Send the user's lines until cmd:disconnect or the end of the input.
+
+        Lines are HEADER:MESSAGE as for client.py; file transfers are
+        started in the background and "transfers" shows their progress.
+        """
+        lines = asyncio.Queue()
+        # A daemon thread, since a blocked read of the terminal cannot be
+        # cancelled and must not keep the process alive.
+        threading.Thread(target=self._read_lines, args=(lines,), daemon=True).start()
+        while True:
+            line = await lines.get()
+            if not line:
+                await self.send("cmd", "disconnect")
+                return
+            line = line.strip()
+            if line == "transfers":
+                self.show_transfers()
+                continue
+            if ":" not in line:
+                continue
+            header, message = line.split(":", 1)
+
+            if header == "file_transfer" and (message.startswith("file_to_server:") or message.startswith("file_to:")):
+                fields = message.split(":")
+                filename = fields[-1]
+                if not os.path.isfile(filename):
+                    print("No such file: " + filename)
+                elif not self.codec.mux:
+                    self.spawn(self.upload_raw(message, filename))
+                else:
+                    target = "server" if fields[0] == "file_to_server" else fields[1]
+                    self.spawn(self.upload(filename, target))
+                continue
+
+            await self.send(header, message)
+            if header == "cmd" and message == "disconnect":
+                return
+
+    def _read_lines(self, lines):
+        """Put every line of the standard input on the queue, then an empty string."""
+        for line in sys.stdin:
+            self.loop.call_soon_threadsafe(lines.put_nowait, line)
+        self.loop.call_soon_threadsafe(lines.put_nowait, "")
+
+    async def run(self):
+        """Run the client until the user or the server ends the session."""
+        receiving = self.spawn(self.receive_messages())
+        self.spawn(self.send_heartbeats())
+        typing = self.spawn(self.handle_input())
+        await asyncio.wait([receiving, typing], return_when=asyncio.FIRST_COMPLETED)
+        if typing.done():
+            # The server closes the connection after cmd:disconnect.
+            await receiving
+        for task in list(self.tasks):
+            task.cancel()
+        self.writer.close()
+
+
+async def main(host):
+    """Connect to the server, log in and run the client.
+
+    Input Arguments:
+    - host (tuple): The server host and port.
+
+    Output Arguments:
+    - int: The exit status.
+    """
+    try:
+        reader, writer = await asyncio.open_connection(host[0], host[1], limit=file_transfer.CHUNK_SIZE)
+    except OSError:
+        print("Could not connect to " + host[0] + ":" + str(host[1]))
+        return 2
+    print("Connected to " + host[0] + ":" + str(host[1]))
+
+    client = AsyncClient(reader, writer)
+    if not await client.authenticate():
+        print("Could not connect to " + host[0] + ":" + str(host[1]))
+        writer.close()
+        return 2
+    await client.run()
+    return 0
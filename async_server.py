@@ -0,0 +1,657 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import connection_limits
+import file_transfer
+import framing
+import metrics
+import mux_transfers
+import rate_limits
+import server_utils
+import session_registry
+
+logger = logging.getLogger("chat")
+
+
+class StreamClient:
+    """Socket-like wrapper around an asyncio stream writer.
+
+    The helpers in server_utils only ever call sendall() on a session's
+    client object, so wrapping the stream writer lets the asyncio
+    server reuse them unchanged. Calls made on the event loop are buffered by
+    the transport, calls made from other threads (the server console) block
+    until the data has been handed to the transport and drained.
+    """
+
+    def __init__(self, writer, loop):
+        """Initialize with the stream writer and its event loop."""
+        self.writer = writer
+        self.loop = loop
+        # Frames passed to sendall() are converted to the agreed format.
+        self.codec = framing.V1
+
+    def _on_loop(self):
+        """Return True if called from the event loop thread."""
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    async def _write(self, data):
+        """Write data to the stream and wait for the buffer to drain."""
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def sendall(self, data):
+        """Send data to the client.
+
+        Input Arguments:
+        - data (bytes): The data to send.
+
+        Output Arguments:
+        - None
+        """
+        data = self.codec.wire(data)
+        if self._on_loop():
+            self.writer.write(data)
+        else:
+            asyncio.run_coroutine_threadsafe(self._write(data), self.loop).result()
+
+    def sendfile(self, file, offset=0, count=None):
+        """Send a file to the client, like socket.sendfile().
+
+        Must be called from outside the event loop thread; the call blocks
+        until the whole range has been written.
+
+        Input Arguments:
+        - file (file object): The file to send, opened in binary mode.
+        - offset (int): The position to start reading from.
+        - count (int): The number of bytes to send, up to EOF when None.
+
+        Output Arguments:
+        - int: The number of bytes sent.
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self.loop.sendfile(self.writer.transport, file, offset, count), self.loop
+        ).result()
+
+    def close(self):
+        """Close the underlying stream."""
+        if self._on_loop():
+            self.writer.close()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class AsyncSession(session_registry.Session):
+    """Session for an asyncio stream, drained by a writer task on the event loop.
+
+    Frames may be queued from any thread. Blocking jobs passed to run() are
+    executed on a worker thread, where the StreamClient methods block until
+    the event loop has written the data; coroutine jobs passed to
+    run_async() are awaited on the event loop itself.
+    """
+
+    coroutine_jobs = True
+
+    def __init__(self, username, client, address, connected_at=None):
+        """Initialize the session and start its writer task.
+
+        Must be called on the event loop of client.
+        """
+        super().__init__(username, client, address, connected_at, client.codec)
+        self.loop = client.loop
+        self._queue = asyncio.Queue()
+        self._task = self.loop.create_task(self._write_loop())
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _enqueue(self, item):
+        if self.client._on_loop():
+            self._queue.put_nowait(item)
+        else:
+            self.loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    def run(self, job):
+        future = concurrent.futures.Future()
+        self._enqueue((job, future, False))
+        return future
+
+    def run_async(self, job):
+        """Await job(writer) on the writer task once everything queued before it is sent.
+
+        Input Arguments:
+        - job (callable): Coroutine function called with the stream writer.
+
+        Output Arguments:
+        - Future: Resolves to the job's return value; an asyncio.Future
+          when called on the event loop, a concurrent.futures.Future from
+          any other thread.
+        """
+        future = self.loop.create_future() if self.client._on_loop() else concurrent.futures.Future()
+        self._enqueue((job, future, True))
+        return future
+
+    async def _collect(self, frames):
+        """Add frames queued within COALESCE_WINDOW to a batch.
+
+        Input Arguments:
+        - frames (list): The batch, holding the frame already taken.
+
+        Output Arguments:
+        - object: The first non-frame item taken off the queue, or NO_ITEM.
+        """
+        size = len(frames[0])
+        deadline = self.loop.time() + session_registry.COALESCE_WINDOW
+        while size < session_registry.COALESCE_BYTES:
+            if self._queue.empty():
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self._queue.get_nowait()
+            if not isinstance(item, bytes):
+                return item
+            frames.append(item)
+            size += len(item)
+        return session_registry.NO_ITEM
+
+    async def _write_loop(self):
+        """Write queued frames and run queued jobs until close()."""
+        writer = self.client.writer
+        failed = False
+        leftover = session_registry.NO_ITEM
+        while True:
+            if leftover is session_registry.NO_ITEM:
+                item = await self._queue.get()
+            else:
+                item, leftover = leftover, session_registry.NO_ITEM
+            if item is None:
+                self._abandon_jobs()
+                return
+
+            if isinstance(item, bytes):
+                if failed:
+                    continue
+                frames = [item]
+                if session_registry.COALESCE_WINDOW > 0:
+                    leftover = await self._collect(frames)
+                try:
+                    data = self._encode_batch(frames)
+                    writer.write(data)
+                    await writer.drain()
+                    self._record_batch(frames, data)
+                except ConnectionError:
+                    failed = True
+                continue
+
+            job, future, is_async = item
+            self.running_job = True
+            if is_async:
+                try:
+                    future.set_result(await job(writer))
+                except Exception as error:
+                    future.set_exception(error)
+            elif future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(await self.loop.run_in_executor(None, job, self.client))
+                except Exception as error:
+                    future.set_exception(error)
+            self.running_job = False
+
+    def _abandon_jobs(self):
+        """Fail the jobs queued after close(), which will never run."""
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if isinstance(item, tuple) and not item[1].done():
+                item[1].set_exception(ConnectionError("the session was closed"))
+
+    def disconnect(self):
+        if self.client._on_loop():
+            self.client.writer.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.client.writer.transport.abort)
+
+    def close(self):
+        self.closing = True
+        self._enqueue(None)
+        if not self.client._on_loop():
+            # Called from the console: wait for the writer task to flush.
+            asyncio.run_coroutine_threadsafe(self.wait_closed(), self.loop).result()
+
+    async def wait_closed(self):
+        """Wait up to CLOSE_TIMEOUT seconds for the writer task to finish."""
+        await asyncio.wait([self._task], timeout=session_registry.CLOSE_TIMEOUT)
+
+
+class AsyncChatServer:
+    """Single event loop server speaking the same protocol as ThreadedTCPServer.
+
+    The object mirrors the parts of the socketserver interface used by
+    server.py (serve_forever, shutdown and server_close) so the console loop
+    does not need to know which mode is running.
+    """
+
+    def __init__(self, server_address, registry, quizzes, store, hasher, blobs, history=None, reuse_port=False,
+                 limiter=None, reaper=None, limits=None):
+        """Initialize the server.
+
+        Input Arguments:
+        - server_address (tuple): The (host, port) to listen on.
+        - registry (SessionRegistry): The active sessions.
+        - quizzes (QuizSessions): The quiz sessions answers are scored against.
+        - store (UserStore): The registered users.
+        - hasher (Hasher): Hashes and checks passwords off the event loop.
+        - blobs (BlobStore): Where uploaded and relayed files are kept.
+        - history (ChatHistory): The group message log, or None to keep none.
+        - reuse_port (bool): Bind with SO_REUSEPORT, for cluster workers.
+        - limiter (ConnectionLimiter): Counts connections against the
+          connection limits, a new one by default.
+        - reaper (IdleReaper): Disconnects idle sessions, none by default.
+        - limits (RateLimits): The rate limits of every session, new ones
+          by default.
+        """
+        self.server_address = server_address
+        self.registry = registry
+        self.quizzes = quizzes
+        self.store = store
+        self.hasher = hasher
+        self.blobs = blobs
+        self.history = history
+        self.limiter = limiter or connection_limits.ConnectionLimiter()
+        self.reaper = reaper
+        self.limits = limits or rate_limits.RateLimits()
+        self.loop = asyncio.new_event_loop()
+        self.stopped = threading.Event()
+        self.writers = set()
+        self.server = None
+
+        # Database calls block, so they run on worker threads, one per
+        # pooled connection.
+        self.db_executor = ThreadPoolExecutor(max_workers=store.pool_size, thread_name_prefix="users-db")
+
+        self.server = self.loop.run_until_complete(
+            # A stream buffer as large as a file chunk lets relays and uploads
+            # read whole chunks instead of 64 KiB slices.
+            asyncio.start_server(self.handle, server_address[0], server_address[1], limit=file_transfer.CHUNK_SIZE,
+                                 reuse_port=reuse_port)
+        )
+
+    def serve_forever(self):
+        """Run the event loop until shutdown() is called."""
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.stopped.set()
+
+    def shutdown(self):
+        """Stop the event loop and wait for serve_forever() to return."""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.stopped.wait()
+
+    def server_close(self):
+        """Close the listening socket and release resources."""
+        self.server.close()
+        # Closing the streams makes every handler return through its normal
+        # cleanup path; anything still running after that is cancelled.
+        for writer in self.writers:
+            writer.close()
+        tasks = asyncio.all_tasks(self.loop)
+        if tasks:
+            self.loop.run_until_complete(asyncio.wait(tasks, timeout=5))
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+        self.db_executor.shutdown()
+
+    async def run_db(self, function, *args):
+        """Run a blocking database function on the database thread."""
+        return await self.loop.run_in_executor(self.db_executor, function, *args)
+
+    async def validate_user_credentials(self, username, password):
+        """Validate user credentials, rehashing outdated password hashes.
+
+        Input Arguments:
+        - username (str): The username to validate.
+        - password (str): The password to validate.
+
+        Output Arguments:
+        - bool: True if the credentials are valid, False otherwise.
+        """
+        stored = await self.run_db(self.store.password_hash, username)
+        if stored is None:
+            return False
+        matched, rehashed = await self.hasher.verify_async(password, stored)
+        if rehashed:
+            await self.run_db(self.store.update_password, username, rehashed)
+        return matched
+
+    async def authenticate(self, reader, client):
+        """Authenticate clients based on whether they are registered or not.
+
+        Input Arguments:
+        - reader (asyncio.StreamReader): The client stream reader.
+        - client (StreamClient): The client stream wrapper.
+
+        Output Arguments:
+        - str: The username if authentication is successful, None otherwise.
+        """
+        client.sendall(server_utils.encode_message("info", "Are you already registered? (yes/no):"))
+        header, response = await framing.read_message_async(reader)
+
+        if header == framing.HELLO:
+            codec = server_utils.negotiate(response)
+            client.sendall(server_utils.encode_message(framing.HELLO, codec.hello()))
+            client.codec = codec
+            if codec.mux:
+                mux_transfers.limit_unsent(client.writer.get_extra_info("socket"))
+            header, response = await framing.read_message_async(reader, codec.version)
+
+        if header != "info":
+            return None
+
+        if response.lower() == "no":
+
+            while True:
+                header, username = await framing.read_message_async(reader, client.codec.version)
+
+                if not await self.run_db(self.store.username_exists, username):
+                    client.sendall(server_utils.encode_message("info", "Username registered successfully."))
+                    break
+                else:
+                    client.sendall(server_utils.encode_message("info", "Username already exists. Please choose another: "))
+
+            header, password = await framing.read_message_async(reader, client.codec.version)
+
+            # Hash the password before storing it
+            started = time.perf_counter()
+            hashed_password = await self.hasher.hash_async(password)
+            added = await self.run_db(self.store.add_user, username, hashed_password)
+            metrics.AUTH_SECONDS.observe(time.perf_counter() - started, "register" if added else "register_failed")
+            if not added:
+                client.sendall(server_utils.encode_message("info", "Username already exists."))
+                return None
+
+            return username
+
+        elif response.lower() == "yes":
+
+            header, username = await framing.read_message_async(reader, client.codec.version)
+            header, password = await framing.read_message_async(reader, client.codec.version)
+
+            # Validate username and password
+            started = time.perf_counter()
+            valid = await self.validate_user_credentials(username, password)
+            metrics.AUTH_SECONDS.observe(time.perf_counter() - started, "login" if valid else "login_failed")
+            if valid:
+                return username
+            else:
+                client.sendall(server_utils.encode_message("info", "Invalid username or password."))
+                return None
+
+        else:
+            client.sendall(server_utils.encode_message("info", "Invalid response."))
+            return None
+
+    async def upload_file_from_client(self, filename, session, reader):
+        """Upload a file from a client to the server.
+
+        Input Arguments:
+        - filename (str): The name of the file to upload.
+        - session (Session): The session of the client uploading the file.
+        - reader (asyncio.StreamReader): The client stream reader.
+
+        Output Arguments:
+        - None
+        """
+        with self.blobs.writer() as blob:
+            session.record_received(await file_transfer.receive_file_body_async(
+                reader, blob, throttle=server_utils.file_throttle(session, "upload")))
+            server_utils.store_entry(self.blobs, blob.commit(), session.username, filename)
+
+        server_utils.broadcast_message("info", f"Server: File '{filename}' uploaded by {session.username}\n", self.registry)
+
+    async def resume_upload(self, payload, session, reader):
+        """Receive a resumable upload from a client, see server_utils.resume_upload().
+
+        Input Arguments:
+        - payload (str): The file_transfer payload.
+        - session (Session): The session of the client uploading the file.
+        - reader (asyncio.StreamReader): The client stream reader.
+
+        Output Arguments:
+        - None
+        """
+        try:
+            identifier, filename, partial_path, offset = server_utils.partial_upload(payload, session)
+        except ValueError:
+            session.sendall(server_utils.encode_message("error", f"Server: Invalid upload request: {payload}\n"))
+            return
+
+        session.sendall(server_utils.encode_message("file_transfer", f"offset:{identifier}:{offset}\n"))
+
+        digest = error = None
+        with open(partial_path, "r+b" if offset else "w+b") as file:
+            try:
+                received, digest = await file_transfer.receive_resumable_body_async(
+                    reader, file, offset, throttle=server_utils.file_throttle(session, "upload"))
+                session.record_received(received)
+            except file_transfer.IntegrityError as exception:
+                error = exception
+        server_utils.finish_upload(filename, partial_path, session, self.registry, self.blobs, digest, error)
+
+    async def send_file_to_client(self, recipient_name, filename, reader, sender):
+        """Relay a file from one client to another.
+
+        Input Arguments:
+        - recipient_name (str): The username of the recipient.
+        - filename (str): The name of the file to send.
+        - reader (asyncio.StreamReader): The sender stream reader.
+        - sender (Session): The session of the sender.
+
+        Output Arguments:
+        - None
+        """
+        recipient = self.registry.get(recipient_name)
+
+        throttle = server_utils.file_throttle(sender, "upload")
+        with server_utils.archive_writer(self.blobs) as archive:
+            if recipient is None:
+                # The body is already on its way, so it still has to be consumed.
+                sender.record_received(await file_transfer.relay_file_body_async(reader, None, archive, throttle=throttle))
+            else:
+                # The recipient's writer task runs write_chunks_async as one job, so
+                # nothing else is written to its stream until the body has gone out.
+                chunks = asyncio.Queue(file_transfer.RELAY_QUEUE_DEPTH)
+                delivered = recipient.run_async(functools.partial(file_transfer.write_chunks_async, chunks))
+                await chunks.put(recipient.codec.wire(server_utils.encode_message("file_transfer", f"file_to:{sender.username}:{filename}\n")))
+                sender.record_received(await file_transfer.relay_file_body_async(reader, chunks, archive, throttle=throttle))
+
+            if archive is not None:
+                server_utils.store_entry(self.blobs, archive.commit(), sender.username, filename)
+
+        if recipient is None:
+            sender.sendall(server_utils.encode_message("info", f"Server: {recipient_name} is not online, file '{filename}' was not delivered.\n"))
+            return
+
+        try:
+            recipient.record_sent(await delivered)
+        except OSError:
+            sender.sendall(server_utils.encode_message("info", f"Server: File '{filename}' could not be delivered to {recipient_name}\n"))
+            return
+
+        sender.sendall(server_utils.encode_message("info", f"Server: File '{filename}' sent to {recipient_name}\n"))
+
+    async def handle_file_transfer(self, payload, reader, session):
+        """Handle file transfer requests.
+
+        Input Arguments:
+        - payload (str): The file transfer payload.
+        - reader (asyncio.StreamReader): The client stream reader.
+        - session (Session): The session of the sender.
+
+        Output Arguments:
+        - None
+        """
+        if payload.startswith("file_to_server"):
+            await self.upload_file_from_client(payload.split(":")[1], session, reader)
+
+        elif payload.startswith("upload:"):
+            await self.resume_upload(payload, session, reader)
+
+        elif payload.startswith("resume_download:"):
+            # Adding a file the blob store has not seen reads it, so not on the loop.
+            await asyncio.get_running_loop().run_in_executor(None, server_utils.resume_download, payload, session, self.blobs)
+
+        elif payload.startswith("send:"):
+            await self.loop.run_in_executor(None, server_utils.start_transfer, payload, session, self.registry, self.blobs)
+
+        elif payload.startswith("sent:"):
+            await self.loop.run_in_executor(None, server_utils.finish_transfer, payload, session, self.registry, self.blobs)
+
+        elif payload.startswith("file_to"):
+            recipient, filename = payload.split(":")[1:]
+            await self.send_file_to_client(recipient, filename, reader, session)
+
+    async def handle(self, reader, writer):
+        """Handle a client connection.
+
+        Input Arguments:
+        - reader (asyncio.StreamReader): The client stream reader.
+        - writer (asyncio.StreamWriter): The client stream writer.
+
+        Output Arguments:
+        - None
+        """
+        client_address = writer.get_extra_info("peername")[:2]
+        if not self.limiter.acquire(client_address):
+            writer.write(server_utils.encode_message("info", connection_limits.REFUSED))
+            writer.close()
+            return
+        client = StreamClient(writer, self.loop)
+        connected_at = time.time()
+        session = None
+        self.writers.add(writer)
+
+        try:
+            try:
+                # A client that never finishes logging in would hold its connection forever.
+                username = await asyncio.wait_for(self.authenticate(reader, client), connection_limits.AUTH_TIMEOUT or None)
+            except asyncio.TimeoutError:
+                metrics.SESSIONS_REAPED.inc("login")
+                logger.info("Client %s did not log in within %s seconds.", client_address[0], connection_limits.AUTH_TIMEOUT)
+                return
+            if username is None:
+                return
+
+            session = AsyncSession(username, client, client_address, connected_at)
+            session.rate_limits = self.limits.user()
+            # A cluster registry asks the hub before it adds a session.
+            if not await self.loop.run_in_executor(None, self.registry.add, session):
+                session.sendall(server_utils.encode_message("info", f"Server: {username} is already logged in.\n"))
+                return
+
+            if self.reaper is not None:
+                self.reaper.watch(session)
+            session.sendall(server_utils.encode_message("info", "Server: You joined the server.\n"))
+            server_utils.broadcast_message("info", f"Server: Client {username} joined the server.\n", self.registry, exclude=session)
+
+            while True:
+                # Chunk payloads are file data and stay bytes.
+                header, payload, size = await framing.read_frame_async(reader, client.codec.version, decode=False)
+                session.record_received(size)
+                if header != mux_transfers.CHUNK_HEADER:
+                    payload = payload.decode()
+                valid = server_utils.validate_message(header)
+                metrics.frame_received(header, valid)
+
+                if valid:
+                    # Waiting here stops reading from the client, so TCP holds back the rest.
+                    wait = server_utils.admit_frame(header, session)
+                    if wait is None:
+                        continue
+                    if wait:
+                        await asyncio.sleep(wait)
+
+                    if header == mux_transfers.CHUNK_HEADER:
+                        # The blob is written on a worker thread, not on the loop.
+                        wait = await self.loop.run_in_executor(None, server_utils.receive_chunk, payload, session)
+                        if wait:
+                            await asyncio.sleep(wait)
+
+                    elif header == "msg":
+                        server_utils.broadcast_message("msg", f"Client {username}: {payload}\n", self.registry, exclude=session)
+                        if self.history is not None:
+                            self.history.append(username, payload)
+                        logger.debug("Client %s: %s", username, payload)
+
+                    elif header == "cmd":
+                        if payload == "disconnect":
+                            self.registry.remove(session)
+                            server_utils.broadcast_message("info", f"Server: Client {username} left the server.\n", self.registry)
+                            logger.info("Client %s disconnected.", username)
+                            break
+                        elif payload.split(" ", 1)[0] == "history":
+                            server_utils.send_history(payload, session, self.history)
+                        elif payload.split(" ", 1)[0] == "leaderboard":
+                            server_utils.send_leaderboard(payload, session, self.quizzes)
+                        elif payload.split(":", 1)[0] in ("join", "leave", "rooms"):
+                            server_utils.room_command(payload, session, self.registry)
+                        elif payload == "ping":
+                            # Heartbeat; receiving it has already marked the session active.
+                            session.sendall(server_utils.encode_message("cmd", "pong"))
+
+                    elif header == "file_transfer":
+                        session.receiving_file = True
+                        try:
+                            await self.handle_file_transfer(payload, reader, session)
+                        finally:
+                            session.receiving_file = False
+
+                    elif header == "to":
+                        recipient, message = payload.split(":", 1)
+                        if not server_utils.send_message_to_client(recipient, message, username, self.registry):
+                            session.sendall(server_utils.encode_message("info", f"Server: {recipient} is not online.\n"))
+
+                    elif header == "room":
+                        server_utils.send_room_message(payload, session, self.registry)
+
+                    elif header == "quiz_answer":
+                        server_utils.evaluate_quiz(payload, session, self.quizzes)
+
+                    else:
+                        logger.debug("Unknown header: %s", header)
+
+                else:
+                    invalid_message = "Server: Invalid message format. Please adhere to the message protocol.\n"
+                    session.sendall(server_utils.encode_message("error", invalid_message))
+
+        except Exception as e:
+            logger.warning("Error: %s", e)
+
+        finally:
+            # A dropped connection never sent cmd:disconnect
+            if session is not None:
+                server_utils.abandon_transfers(session)
+                if self.registry.remove(session):
+                    server_utils.broadcast_message("info", f"Server: Client {session.username} left the server.\n", self.registry)
+                # Flush what is still queued for the client before the stream closes
+                session.close()
+                await session.wait_closed()
+            self.writers.discard(writer)
+            writer.close()
+            self.limiter.release(client_address)
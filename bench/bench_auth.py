@@ -0,0 +1,94 @@
+"""Measure sustained registrations/sec and logins/sec through the server.
+
+Usage: python bench/bench_auth.py [--users N] [--concurrency C] [--rounds R] [--modes threaded asyncio] [--json]
+
+For every mode a fresh server is started. N clients register with distinct
+usernames, at most C handshakes at a time, and disconnect; then the same N
+users log in again R times. A handshake counts once the server has sent its
+welcome, and the rate is completed handshakes per second of wall time.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from common import BenchClient, ServerProcess, raise_file_limit
+
+
+async def handshakes(port, usernames, concurrency, login):
+    """Run one handshake per username and return (completed, failures, seconds)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    completed = 0
+    failures = 0
+
+    async def handshake(username):
+        nonlocal completed, failures
+        async with semaphore:
+            client = None
+            try:
+                client = await BenchClient.connect(port)
+                if login:
+                    await asyncio.wait_for(client.login(username), timeout=60)
+                else:
+                    await asyncio.wait_for(client.register(username), timeout=60)
+                completed += 1
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, RuntimeError):
+                failures += 1
+            finally:
+                if client is not None:
+                    await client.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(handshake(username) for username in usernames))
+    return completed, failures, time.perf_counter() - started
+
+
+async def run_mode(mode, users, concurrency, rounds):
+    raise_file_limit()
+    usernames = [f"user{index}" for index in range(users)]
+    with ServerProcess("--mode", mode) as server:
+        registered, register_failures, register_seconds = await handshakes(server.port, usernames, concurrency, False)
+        logged_in = login_failures = 0
+        login_seconds = 0.0
+        for _ in range(rounds):
+            completed, failures, seconds = await handshakes(server.port, usernames, concurrency, True)
+            logged_in += completed
+            login_failures += failures
+            login_seconds += seconds
+
+    return {
+        "mode": mode,
+        "users": users,
+        "concurrency": concurrency,
+        "registrations": registered,
+        "registration_failures": register_failures,
+        "registrations_per_sec": round(registered / register_seconds, 1),
+        "logins": logged_in,
+        "login_failures": login_failures,
+        "logins_per_sec": round(logged_in / login_seconds, 1) if login_seconds else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100, help="simultaneous handshakes")
+    parser.add_argument("--rounds", type=int, default=2, help="login rounds after registration")
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    results = [asyncio.run(run_mode(mode, args.users, args.concurrency, args.rounds)) for mode in args.modes]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(f"[{result['mode']}]")
+            for key, value in result.items():
+                if key != "mode":
+                    print(f"  {key:22} {value}")
+
+
+if __name__ == "__main__":
+    main()
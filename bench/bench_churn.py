@@ -0,0 +1,85 @@
+"""Measure server threads and open files under clients that go away without closing.
+
+Usage: python bench/bench_churn.py [--waves 5] [--clients 100] [--gap 3] [--modes threaded asyncio] [--json]
+
+Every wave connects --clients clients: half log in and then send nothing,
+like a phone that lost its network, and half stop in the middle of the
+login. The bench keeps all their sockets open, so the server never sees
+them close. Without timeouts (--idle-timeout 0 --auth-timeout 0) the
+server keeps every one of them; with --idle-timeout and --auth-timeout
+of --gap seconds it closes them, so its threads and open files after
+each wave stay level. Threads and open files are read from /proc.
+"""
+import argparse
+import asyncio
+import json
+import os
+
+from common import BenchClient, ServerProcess, raise_file_limit
+
+
+def process_usage(pid):
+    """Return the threads and the open file descriptors of a process."""
+    with open(f"/proc/{pid}/status") as file:
+        threads = next(int(line.split()[1]) for line in file if line.startswith("Threads:"))
+    return threads, len(os.listdir(f"/proc/{pid}/fd"))
+
+
+async def wave(server, number, args):
+    clients = [await BenchClient.connect(server.port) for _ in range(args.clients)]
+    await asyncio.gather(*(client.register(f"wave{number}-{index}")
+                           for index, client in enumerate(clients[:args.clients // 2])))
+    # The other half got the first prompt and never answer it.
+    await asyncio.gather(*(client.read_until(lambda header, payload: payload.endswith("(yes/no):"))
+                           for client in clients[args.clients // 2:]))
+    return clients
+
+
+async def run(server, args):
+    kept = []
+    usage = []
+    for number in range(args.waves):
+        kept.extend(await wave(server, number, args))
+        await asyncio.sleep(args.gap * 1.5)
+        usage.append(process_usage(server.process.pid))
+    for client in kept:
+        client.writer.close()
+    return usage
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--waves", type=int, default=5)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--gap", type=float, default=3, help="seconds between waves, and the timeouts of the reaping run")
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+    raise_file_limit()
+
+    results = []
+    for mode in args.modes:
+        for timeout in (0, args.gap):
+            # Cheap password hashing keeps the registrations out of the way.
+            with ServerProcess("--mode", mode, "--scrypt-n", "1024", "--idle-timeout", timeout,
+                               "--auth-timeout", timeout) as server:
+                usage = asyncio.run(run(server, args))
+            results.append({
+                "mode": mode,
+                "timeout_sec": timeout,
+                "clients": args.waves * args.clients,
+                "threads": [threads for threads, _ in usage],
+                "open_files": [files for _, files in usage],
+            })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':>9} {'timeout s':>10} {'clients':>8}  threads / open files after each wave")
+        for row in results:
+            waves = "  ".join(f"{threads}/{files}" for threads, files in zip(row["threads"], row["open_files"]))
+            print(f"{row['mode']:>9} {row['timeout_sec'] or 'off':>10} {row['clients']:>8}  {waves}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Measure group chat throughput and latency with and without write coalescing.
+
+Usage: python bench/bench_coalescing.py [--clients N] [--senders S] [--messages M] [--interval SECONDS] [--windows 0 1 5] [--modes threaded asyncio] [--json]
+
+For every mode and --coalesce-ms window a fresh server is started and N
+clients register. S of them then send M group messages each, as fast as the
+server takes them or one every --interval seconds, and every client
+timestamps each message it receives. Flat out shows the throughput gained;
+paced below saturation shows the latency paid.
+The report gives deliveries per second, p50/p99 delivery latency and the
+server's CPU time per thousand deliveries, read from /proc.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from bench_server_modes import connect_clients
+from common import ServerProcess, percentile, raise_file_limit
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def cpu_seconds(pid):
+    """Return the user plus system CPU seconds used by a process so far."""
+    with open(f"/proc/{pid}/stat") as file:
+        fields = file.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+async def collect(client, latencies, expected, done):
+    """Record the latency of every benchmark message the client receives."""
+    try:
+        while True:
+            header, payload = await client.read_message()
+            if header == "msg" and "bench-msg " in payload:
+                latencies.append(time.perf_counter() - float(payload.rsplit(" ", 1)[1]))
+                if len(latencies) >= expected:
+                    done.set()
+    except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+        pass
+
+
+async def send(client, messages, interval):
+    for sequence in range(messages):
+        client.send("msg", f"bench-msg {sequence} {time.perf_counter()}")
+        await client.writer.drain()
+        # Let the receivers run between sends so timestamps stay honest.
+        await asyncio.sleep(interval)
+
+
+async def run(mode, window, args):
+    raise_file_limit()
+    # Cheap password hashing keeps the registrations, which are not measured, short.
+    with ServerProcess("--mode", mode, "--coalesce-ms", window, "--send-queue-size", 1 << 20,
+                       "--scrypt-n", 1024) as server:
+        clients, failures, _ = await connect_clients(server.port, args.clients, args.concurrency)
+        result = {"mode": mode, "coalesce_ms": window, "interval": args.interval, "clients": len(clients),
+                  "connect_failures": failures}
+        if len(clients) <= args.senders:
+            return result
+
+        senders = clients[:args.senders]
+        latencies = []
+        done = asyncio.Event()
+        expected = args.senders * args.messages * (len(clients) - 1)
+        tasks = [asyncio.ensure_future(collect(client, latencies, expected, done)) for client in clients]
+
+        cpu_before = cpu_seconds(server.process.pid)
+        started = time.perf_counter()
+        await asyncio.gather(*(send(client, args.messages, args.interval) for client in senders))
+        try:
+            await asyncio.wait_for(done.wait(), timeout=args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds(server.process.pid) - cpu_before
+
+        for task in tasks:
+            task.cancel()
+        for client in clients:
+            await client.close()
+
+    result.update({
+        "deliveries_expected": expected,
+        "deliveries_received": len(latencies),
+        "deliveries_per_sec": round(len(latencies) / elapsed, 1),
+        "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "server_cpu_ms_per_1k": round(cpu * 1000 / max(1, len(latencies)) * 1000, 2),
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=100, help="group messages per sender")
+    parser.add_argument("--interval", type=float, default=0, help="seconds between a sender's messages (default 0, flat out)")
+    parser.add_argument("--windows", nargs="+", type=float, default=[0, 1, 5], help="--coalesce-ms values")
+    parser.add_argument("--concurrency", type=int, default=100, help="simultaneous handshakes")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for outstanding deliveries")
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    results = [asyncio.run(run(mode, window, args)) for mode in args.modes for window in args.windows]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':>9} {'window ms':>9} {'deliveries/s':>13} {'p50 ms':>9} {'p99 ms':>9} {'cpu ms/1k':>10} {'received':>10}")
+        for row in results:
+            if "deliveries_per_sec" not in row:
+                print(f"{row['mode']:>9} {row['coalesce_ms']:>9}  only {row['clients']} clients connected")
+                continue
+            print(f"{row['mode']:>9} {row['coalesce_ms']:>9} {row['deliveries_per_sec']:>13} {row['latency_p50_ms']:>9} "
+                  f"{row['latency_p99_ms']:>9} {row['server_cpu_ms_per_1k']:>10} "
+                  f"{row['deliveries_received']}/{row['deliveries_expected']}")
+
+
+if __name__ == "__main__":
+    main()
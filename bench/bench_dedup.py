@@ -0,0 +1,124 @@
+"""Measure server storage for repeated uploads and disk reads of a broadcast file send.
+
+Usage: python bench/bench_dedup.py [--clients 20] [--size 16M] [--modes threaded asyncio] [--json]
+
+Every client uploads the same file, as a class handing in the same course
+material would, and the space the server directory takes on disk is
+compared with the space the uploads would take as separate copies. Then
+send_file:all sends one of the uploads back to every client, and the
+bytes the server process read (rchar in /proc/PID/io) during the
+broadcast are compared with the file size: reading the file once per
+client, as before the blob store, reads --clients times the size.
+"""
+import argparse
+import asyncio
+import json
+import os
+import struct
+import tempfile
+import time
+
+from bench_file_transfer import make_file, parse_size
+from common import BenchClient, ServerProcess
+
+
+def read_bytes(pid):
+    """Return the bytes a process has read with read() and similar calls."""
+    with open(f"/proc/{pid}/io") as file:
+        for line in file:
+            if line.startswith("rchar:"):
+                return int(line.split()[1])
+    return 0
+
+
+def disk_usage(directory):
+    """Return the bytes allocated to the files under directory, each inode counted once."""
+    seen = set()
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            status = os.lstat(os.path.join(root, name))
+            if status.st_ino not in seen:
+                seen.add(status.st_ino)
+                total += status.st_blocks * 512
+    return total
+
+
+async def upload(client, username, path, size):
+    client.send("file_transfer", "file_to_server:course.bin")
+    client.writer.write(struct.pack("!Q", size))
+    with open(path, "rb") as file:
+        await asyncio.get_running_loop().sendfile(client.writer.transport, file)
+    await client.read_until(lambda header, payload: payload.startswith(f"Server: File 'course.bin' uploaded by {username}"))
+
+
+async def receive(client):
+    await client.read_until(lambda header, payload: header == "file_transfer")
+    remaining = struct.unpack("!Q", await client.reader.readexactly(8))[0]
+    while remaining:
+        data = await client.reader.read(min(remaining, 1024 * 1024))
+        if not data:
+            raise ConnectionError("broadcast interrupted")
+        remaining -= len(data)
+
+
+async def run(server, path, args):
+    clients = []
+    for index in range(args.clients):
+        client = await BenchClient.connect(server.port)
+        await client.register(f"student{index}")
+        clients.append(client)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(upload(client, f"student{index}", path, args.size) for index, client in enumerate(clients)))
+    uploaded = time.perf_counter() - started
+    used = disk_usage(server.path)
+
+    before = read_bytes(server.process.pid)
+    started = time.perf_counter()
+    receiving = asyncio.gather(*(receive(client) for client in clients))
+    server.command("send_file:all:student0:course.bin")
+    await receiving
+    broadcast = time.perf_counter() - started
+    read = read_bytes(server.process.pid) - before
+
+    for client in clients:
+        await client.close()
+    return {
+        "clients": args.clients,
+        "bytes": args.size,
+        "uploads_mb": round(args.clients * args.size / 1e6, 1),
+        "on_disk_mb": round(used / 1e6, 1),
+        "upload_sec": round(uploaded, 3),
+        "broadcast_sec": round(broadcast, 3),
+        "broadcast_read_mb": round(read / 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--size", type=parse_size, default=parse_size("16M"))
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="chat-bench-") as directory:
+        path = make_file(directory, args.size)
+        for mode in args.modes:
+            # Cheap password hashing keeps the registrations out of the way.
+            with ServerProcess("--mode", mode, "--scrypt-n", "1024") as server:
+                results.append({"mode": mode, **asyncio.run(run(server, path, args))})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':>9} {'uploads MB':>11} {'on disk MB':>11} {'upload s':>9} {'broadcast s':>12} {'read MB':>8}")
+        for row in results:
+            print(f"{row['mode']:>9} {row['uploads_mb']:>11} {row['on_disk_mb']:>11} {row['upload_sec']:>9} "
+                  f"{row['broadcast_sec']:>12} {row['broadcast_read_mb']:>8}")
+
+
+if __name__ == "__main__":
+    main()
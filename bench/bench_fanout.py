@@ -0,0 +1,110 @@
+"""Compare pushing a server file to clients one after another with one fan-out.
+
+Usage: python bench/bench_fanout.py [--clients 20] [--size 16M] [--client-rate 50] [--modes threaded asyncio] [--json]
+
+The sequential run types send_file:USER for one client at a time and waits
+until that client has the whole file, which is how send_file:all used to
+work. The fan-out run defines a group of every client and types
+send_file:@GROUP once, so all transfers run together from one mapping of
+the file. Both report the time until every client has received the file
+and the aggregate throughput.
+
+Every client reads at most --client-rate MB/s, like a client behind its
+own network link; over loopback with the clients on the same machine the
+server would otherwise only be limited by the CPU they share. Use
+--client-rate 0 to read flat out.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+from bench_file_transfer import make_file, parse_size
+from common import BenchClient, ServerProcess
+
+
+async def receive(client, rate):
+    await client.read_until(lambda header, payload: header == "file_transfer")
+    remaining = struct.unpack("!Q", await client.reader.readexactly(8))[0]
+    started = time.perf_counter()
+    received = 0
+    while remaining:
+        data = await client.reader.read(min(remaining, 256 * 1024))
+        if not data:
+            raise ConnectionError("transfer interrupted")
+        remaining -= len(data)
+        received += len(data)
+        if rate:
+            # Sleep until the bytes received so far fit the rate.
+            await asyncio.sleep(max(0.0, received / rate - (time.perf_counter() - started)))
+
+
+async def run(server, args):
+    clients = []
+    for index in range(args.clients):
+        client = await BenchClient.connect(server.port)
+        await client.register(f"student{index}")
+        clients.append(client)
+    usernames = [f"student{index}" for index in range(args.clients)]
+
+    started = time.perf_counter()
+    for username, client in zip(usernames, clients):
+        receiving = asyncio.ensure_future(receive(client, args.client_rate * 1e6))
+        server.command(f"send_file:{username}:files:course.bin")
+        await receiving
+    sequential = time.perf_counter() - started
+
+    server.command(f"group:class:{','.join(usernames)}")
+    started = time.perf_counter()
+    receiving = asyncio.gather(*(receive(client, args.client_rate * 1e6) for client in clients))
+    server.command("send_file:@class:files:course.bin")
+    await receiving
+    fanout = time.perf_counter() - started
+
+    for client in clients:
+        await client.close()
+    total = args.clients * args.size
+    return {
+        "clients": args.clients,
+        "bytes": args.size,
+        "sequential_sec": round(sequential, 3),
+        "sequential_mb_per_sec": round(total / sequential / 1e6, 1),
+        "fanout_sec": round(fanout, 3),
+        "fanout_mb_per_sec": round(total / fanout / 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--size", type=parse_size, default=parse_size("16M"))
+    parser.add_argument("--client-rate", type=float, default=50, help="MB/s each client reads at most, 0 for no limit")
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="chat-bench-") as directory:
+        path = make_file(directory, args.size)
+        for mode in args.modes:
+            # Cheap password hashing keeps the registrations out of the way.
+            with ServerProcess("--mode", mode, "--scrypt-n", "1024") as server:
+                os.makedirs(os.path.join(server.path, "files"))
+                shutil.copyfile(path, os.path.join(server.path, "files", "course.bin"))
+                results.append({"mode": mode, **asyncio.run(run(server, args))})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':>9} {'sequential s':>13} {'MB/s':>8} {'fan-out s':>10} {'MB/s':>8}")
+        for row in results:
+            print(f"{row['mode']:>9} {row['sequential_sec']:>13} {row['sequential_mb_per_sec']:>8} "
+                  f"{row['fanout_sec']:>10} {row['fanout_mb_per_sec']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Measure file transfer throughput of the size-prefixed protocol.
+
+Usage: python bench/bench_file_transfer.py [--sizes 1M 16M 256M 2G] [--chunk-size BYTES] [--json]
+
+Each file is sent over a localhost TCP connection three times: with the
+previous protocol (1024 byte reads and writes terminated by a b'EOF' marker,
+reproduced below), with file_transfer.send_file_body and receive_file_body,
+and with the resumable body, which both sides hash with BLAKE2b while it
+streams. The reported figure is MB/s from the first byte sent to the last
+byte written on the receiving side.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import file_transfer  # noqa: E402
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text):
+    """Parse sizes such as 512K, 16M or 2G."""
+    if text[-1].upper() in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1].upper()])
+    return int(text)
+
+
+def legacy_send(sock, file):
+    while True:
+        data = file.read(1024)
+        if not data:
+            break
+        sock.sendall(data)
+    sock.sendall(b'EOF')
+
+
+def legacy_receive(sock, file):
+    while True:
+        data = sock.recv(1024)
+        if not data:
+            break
+        if data.endswith(b'EOF'):
+            file.write(data[:-3])
+            break
+        file.write(data)
+
+
+def new_send(sock, file):
+    file_transfer.send_file_body(sock, file)
+
+
+def new_receive(sock, file):
+    file_transfer.receive_file_body(sock, file)
+
+
+def resumable_send(sock, file):
+    file_transfer.send_resumable_body(sock, file)
+
+
+def resumable_receive(sock, file):
+    file_transfer.receive_resumable_body(sock, file)
+
+
+def make_file(directory, size):
+    """Create a file of the given size filled with a repeating non-marker pattern."""
+    path = os.path.join(directory, f"source-{size}")
+    block = bytes(range(256)) * 4096
+    with open(path, "wb") as file:
+        remaining = size
+        while remaining:
+            written = file.write(block[:min(len(block), remaining)])
+            remaining -= written
+    return path
+
+
+def transfer(path, destination, send, receive):
+    """Send path to destination over localhost TCP and return the elapsed seconds."""
+    with socket.create_server(("localhost", 0)) as listener:
+        port = listener.getsockname()[1]
+        finished = threading.Event()
+
+        def receiver():
+            connection, _ = listener.accept()
+            with connection, open(destination, "wb") as file:
+                receive(connection, file)
+            finished.set()
+
+        thread = threading.Thread(target=receiver)
+        thread.start()
+        with socket.create_connection(("localhost", port)) as sock, open(path, "rb") as file:
+            started = time.perf_counter()
+            send(sock, file)
+            finished.wait()
+            elapsed = time.perf_counter() - started
+        thread.join()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", default=["1M", "16M", "256M"])
+    parser.add_argument("--chunk-size", type=parse_size, default=file_transfer.CHUNK_SIZE)
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    file_transfer.CHUNK_SIZE = args.chunk_size
+    results = []
+
+    with tempfile.TemporaryDirectory(prefix="chat-bench-") as directory:
+        for text in args.sizes:
+            size = parse_size(text)
+            source = make_file(directory, size)
+            destination = os.path.join(directory, "received")
+            row = {"size": text, "bytes": size}
+            for name, send, receive in (("legacy", legacy_send, legacy_receive), ("sized", new_send, new_receive),
+                                        ("resumable", resumable_send, resumable_receive)):
+                elapsed = transfer(source, destination, send, receive)
+                row[f"{name}_mb_per_sec"] = round(size / elapsed / 1e6, 1)
+                row[f"{name}_intact"] = os.path.getsize(destination) == size
+            os.remove(source)
+            results.append(row)
+
+    if args.json:
+        print(json.dumps({"chunk_size": args.chunk_size, "results": results}, indent=2))
+    else:
+        print(f"{'size':>6} {'legacy MB/s':>12} {'sized MB/s':>12} {'resumable MB/s':>15}")
+        for row in results:
+            print(f"{row['size']:>6} {row['legacy_mb_per_sec']:>12} {row['sized_mb_per_sec']:>12} "
+                  f"{row['resumable_mb_per_sec']:>15}")
+
+
+if __name__ == "__main__":
+    main()
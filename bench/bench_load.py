@@ -0,0 +1,331 @@
+"""Drive the server with a mixed chat, private message, file and quiz workload.
+
+Usage: python bench/bench_load.py [--clients N] [--ops M] [--mix msg=60 to=25 file=5 quiz=10] [--modes threaded asyncio] [--json] [--output FILE] [--baseline FILE]
+
+For every mode a fresh server is started. N clients register and disconnect,
+then log in again and stay connected; the server console starts the quiz in
+quiz_dir. Every client then performs M operations picked by the --mix
+weights, pausing --interval seconds between them:
+
+- msg: a group message, timed until every other client has it (fan-out).
+- to: a private message to a random client, timed until it arrives.
+- file: a file_to relay of --file-size bytes to a random client, timed
+  until the recipient has the last byte.
+- quiz: a quiz_answer submission, timed until the server acknowledges it.
+
+All times are taken in this process, so the clients share one clock. The
+report carries the git revision of the tree; --output saves it as JSON and
+--baseline prints the change of every figure against a saved report.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import time
+
+from bench_file_transfer import parse_size
+from common import REPO_DIR, BenchClient, ServerProcess, percentile, raise_file_limit
+
+OPERATIONS = ("msg", "to", "file", "quiz")
+QUIZ_DIR = os.path.join(REPO_DIR, "quiz_dir")
+QUIZ_COMMAND = "Quiz:quiz_dir:quiz_ques.txt:quiz_ans.txt:load_scores.csv"
+
+# Figures where a larger value is an improvement, for --baseline.
+HIGHER_IS_BETTER = ("per_sec",)
+
+
+def parse_mix(text):
+    """Parse one NAME=WEIGHT item of --mix."""
+    name, _, weight = text.partition("=")
+    if name not in OPERATIONS or not weight.isdigit():
+        raise argparse.ArgumentTypeError(f"expected one of {', '.join(OPERATIONS)}=WEIGHT, got {text!r}")
+    return name, int(weight)
+
+
+def git_revision():
+    """Return the short git revision of the tree, with -dirty for local changes."""
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Workload:
+    """Send times and arrival records shared by every simulated client."""
+
+    def __init__(self, clients):
+        self.receivers = len(clients) - 1
+        self.sent_at = {}
+        self.expected = 0
+        self.received = 0
+        self.group_latencies = []
+        self.group_arrivals = collections.defaultdict(list)
+        self.private_latencies = []
+        self.file_transfers = []
+        self.quiz_latencies = []
+        self.quiz_pending = {client: collections.deque() for client in clients}
+        self.quiz_started = 0
+        self.all_sent = False
+        self.done = asyncio.Event()
+
+    def expect(self, operation, count=1):
+        self.sent_at[operation] = time.perf_counter()
+        self.expected += count
+
+    def arrived(self):
+        self.received += 1
+        if self.all_sent and self.received >= self.expected:
+            self.done.set()
+
+    def finish_sending(self):
+        self.all_sent = True
+        if self.received >= self.expected:
+            self.done.set()
+
+
+async def receive(client, workload):
+    """Read frames for one client and record every workload arrival."""
+    try:
+        while True:
+            header, payload = await client.read_message()
+            now = time.perf_counter()
+
+            if header == "file_transfer" and payload.startswith("file_to:"):
+                operation = payload.strip().rsplit(":", 1)[1]
+                remaining = size = struct.unpack("!Q", await client.reader.readexactly(8))[0]
+                while remaining:
+                    remaining -= len(await client.reader.readexactly(min(remaining, 1024 * 1024)))
+                workload.file_transfers.append((size, time.perf_counter() - workload.sent_at[operation]))
+                workload.arrived()
+
+            elif header in ("msg", "info") and ": load-" in payload:
+                operation = payload.strip().rsplit(": ", 1)[1]
+                latency = now - workload.sent_at[operation]
+                if header == "msg":
+                    workload.group_latencies.append(latency)
+                    workload.group_arrivals[operation].append(latency)
+                else:
+                    workload.private_latencies.append(latency)
+                workload.arrived()
+
+            elif header == "quiz_question":
+                workload.quiz_started += 1
+
+            elif payload.startswith("Quiz is over"):
+                workload.quiz_latencies.append(now - workload.quiz_pending[client].popleft())
+                workload.arrived()
+    except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+        pass
+
+
+async def drive(index, client, usernames, workload, args, body, quiz_answer):
+    """Perform one client's share of the operations."""
+    rng = random.Random(args.seed + index)
+    names, weights = zip(*args.mix)
+    others = [username for username in usernames if username != client.username]
+
+    for sequence in range(args.ops):
+        kind = rng.choices(names, weights)[0]
+        operation = f"load-{index}-{sequence}"
+
+        if kind == "msg":
+            workload.expect(operation, workload.receivers)
+            client.send("msg", operation)
+        elif kind == "to":
+            workload.expect(operation)
+            client.send("to", f"{rng.choice(others)}:{operation}")
+        elif kind == "file":
+            workload.expect(operation)
+            client.send("file_transfer", f"file_to:{rng.choice(others)}:{operation}")
+            client.writer.write(struct.pack("!Q", len(body)))
+            client.writer.write(body)
+        else:
+            workload.expected += 1
+            workload.quiz_pending[client].append(time.perf_counter())
+            client.send("quiz_answer", quiz_answer)
+
+        await client.writer.drain()
+        await asyncio.sleep(args.interval)
+
+
+async def handshakes(port, usernames, concurrency, login):
+    """Run one handshake per username; return the connected clients, failures and seconds."""
+    semaphore = asyncio.Semaphore(concurrency)
+    clients = []
+    failures = 0
+
+    async def handshake(username):
+        nonlocal failures
+        async with semaphore:
+            client = None
+            try:
+                client = await BenchClient.connect(port)
+                if login:
+                    await asyncio.wait_for(client.login(username), timeout=60)
+                else:
+                    await asyncio.wait_for(client.register(username), timeout=60)
+                client.username = username
+                clients.append(client)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, RuntimeError):
+                failures += 1
+                if client is not None:
+                    client.writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(handshake(username) for username in usernames))
+    return clients, failures, time.perf_counter() - started
+
+
+def milliseconds(values, fraction):
+    return round(percentile(values, fraction) * 1000, 3) if values else None
+
+
+async def run_mode(mode, args):
+    raise_file_limit()
+    usernames = [f"load{index}" for index in range(args.clients)]
+    with open(os.path.join(QUIZ_DIR, "quiz_ans.txt")) as file:
+        quiz_answer = " ".join("a" for _ in file.read().split())
+    body = os.urandom(args.file_size)
+
+    with ServerProcess("--mode", mode, *args.server_arg) as server:
+        shutil.copytree(QUIZ_DIR, os.path.join(server.path, "quiz_dir"))
+
+        registered, register_failures, register_seconds = await handshakes(
+            server.port, usernames, args.concurrency, False)
+        for client in registered:
+            await client.close()
+
+        clients, login_failures, login_seconds = await handshakes(server.port, usernames, args.concurrency, True)
+        result = {
+            "mode": mode,
+            "clients": args.clients,
+            "registrations_per_sec": round(len(registered) / register_seconds, 1),
+            "registration_failures": register_failures,
+            "connections_per_sec": round(len(clients) / login_seconds, 1),
+            "connection_failures": login_failures,
+        }
+        if login_failures or register_failures or len(clients) < 2:
+            for client in clients:
+                await client.close()
+            return result
+
+        workload = Workload(clients)
+        readers = [asyncio.ensure_future(receive(client, workload)) for client in clients]
+
+        # evaluate_quiz needs the answers, so wait until the quiz is out.
+        if dict(args.mix).get("quiz"):
+            server.command(QUIZ_COMMAND)
+            deadline = time.monotonic() + args.timeout
+            while workload.quiz_started < len(clients) and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(drive(index, client, usernames, workload, args, body, quiz_answer)
+                                   for index, client in enumerate(clients)))
+            sent_seconds = time.perf_counter() - started
+            workload.finish_sending()
+            await asyncio.wait_for(workload.done.wait(), timeout=args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        except ConnectionError as error:
+            result["error"] = repr(error)
+            sent_seconds = time.perf_counter() - started
+        elapsed = time.perf_counter() - started
+
+        for task in readers:
+            task.cancel()
+        for client in clients:
+            await client.close()
+
+    fanouts = [max(arrivals) for arrivals in workload.group_arrivals.values()
+               if len(arrivals) == workload.receivers]
+    file_bytes = sum(size for size, _ in workload.file_transfers)
+    operations = args.clients * args.ops
+    result.update({
+        "operations": operations,
+        "operations_per_sec": round(operations / sent_seconds, 1),
+        "deliveries_expected": workload.expected,
+        "deliveries_received": workload.received,
+        "seconds": round(elapsed, 3),
+        "group_latency_p50_ms": milliseconds(workload.group_latencies, 0.50),
+        "group_latency_p99_ms": milliseconds(workload.group_latencies, 0.99),
+        "fanout_p50_ms": milliseconds(fanouts, 0.50),
+        "fanout_p99_ms": milliseconds(fanouts, 0.99),
+        "private_latency_p50_ms": milliseconds(workload.private_latencies, 0.50),
+        "private_latency_p99_ms": milliseconds(workload.private_latencies, 0.99),
+        "files": len(workload.file_transfers),
+        "file_mb_per_sec": round(file_bytes / sum(seconds for _, seconds in workload.file_transfers) / 1e6, 1)
+        if workload.file_transfers else None,
+        "quiz_latency_p50_ms": milliseconds(workload.quiz_latencies, 0.50),
+        "quiz_latency_p99_ms": milliseconds(workload.quiz_latencies, 0.99),
+    })
+    return result
+
+
+def compare(results, baseline):
+    """Print every figure next to the same figure of a saved report."""
+    previous = {result["mode"]: result for result in baseline["results"]}
+    print(f"baseline {baseline.get('revision')} -> {git_revision()}")
+    for result in results:
+        old = previous.get(result["mode"])
+        if old is None:
+            continue
+        print(f"[{result['mode']}]")
+        for key, value in result.items():
+            if not isinstance(value, (int, float)) or not isinstance(old.get(key), (int, float)) or not old[key]:
+                continue
+            change = (value - old[key]) / old[key] * 100
+            verdict = ""
+            if key.endswith(HIGHER_IS_BETTER + ("_ms",)) and change:
+                verdict = "better" if (change > 0) == key.endswith(HIGHER_IS_BETTER) else "worse"
+            print(f"  {key:24} {old[key]:>10} -> {value:>10} ({change:+.1f}%) {verdict}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--ops", type=int, default=50, help="operations per client")
+    parser.add_argument("--mix", nargs="+", type=parse_mix,
+                        default=[parse_mix(text) for text in ("msg=60", "to=25", "file=5", "quiz=10")])
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between a client's operations")
+    parser.add_argument("--file-size", type=parse_size, default=parse_size("1M"))
+    parser.add_argument("--concurrency", type=int, default=100, help="simultaneous handshakes")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for outstanding deliveries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="extra server.py argument, may be repeated (e.g. --server-arg=--scrypt-n=1024)")
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    parser.add_argument("--output", help="also save the report as JSON to this file")
+    parser.add_argument("--baseline", help="compare with a report saved by --output")
+    args = parser.parse_args()
+
+    results = [asyncio.run(run_mode(mode, args)) for mode in args.modes]
+    report = {"revision": git_revision(), "cpus": os.cpu_count(), "args": vars(args), "results": results}
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    elif args.baseline:
+        with open(args.baseline) as file:
+            compare(results, json.load(file))
+    else:
+        for result in results:
+            print(f"[{result['mode']}]")
+            for key, value in result.items():
+                if key != "mode":
+                    print(f"  {key:24} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""Measure chat latency on a connection that is downloading files, with raw file bodies and with chunk frames.
+
+Usage: python bench/bench_mux_transfers.py [--size 32M] [--downloads 2] [--client-rate 20] [--modes threaded asyncio] [--json]
+
+A receiving client that reads at most --client-rate MB/s logs in and the
+server console sends it --downloads files of --size bytes at once, while
+another client posts a timestamped group message every --interval seconds. With raw bodies ("raw", what
+client.py agrees on) the files go out one after the other and no frame
+reaches the receiver while a body is on the wire; with chunk frames ("mux",
+what client.py --async agrees on) the files share the connection with the
+chat messages. The bench reports the latency of the group messages at the
+receiver during the downloads and the time until the last file is in.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from bench_file_transfer import make_file, parse_size
+from common import BenchClient, ServerProcess, percentile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import file_transfer  # noqa: E402
+import framing  # noqa: E402
+import mux_transfers  # noqa: E402
+
+TRANSFERS = ("raw", "mux")
+
+RECEIVE_BUFFER = 256 * 1024
+
+
+async def connect(port, username, mux):
+    """Log in as a new user in the version 2 format, with or without chunked transfers."""
+    # A small receive buffer stands in for the window of a slow link;
+    # loopback would otherwise buffer megabytes the client has not read.
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+    sock.connect(("localhost", port))
+    reader, writer = await asyncio.open_connection(sock=sock)
+    writer.write(framing.encode_message(framing.HELLO, framing.Codec(2, False, False, mux).hello()))
+    await framing.read_message_async(reader)
+    _, hello = await framing.read_message_async(reader)
+    codec = framing.Codec.from_hello(hello)
+
+    def send(header, message):
+        writer.write(codec.wire(framing.encode_message(header, message)))
+
+    send("info", "no")
+    send("info", username)
+    while not (await framing.read_message_async(reader, 2))[1].startswith("Username"):
+        pass
+    send("info", "bench")
+    while not (await framing.read_message_async(reader, 2))[1].startswith("Server: You joined"):
+        pass
+    return reader, writer
+
+
+class Pacer:
+    """Spaces out reads so that file data arrives at most rate bytes per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next = time.perf_counter()
+
+    def __call__(self, count):
+        """Return the seconds to wait after reading count bytes."""
+        now = time.perf_counter()
+        self.next = max(self.next, now) + count / self.rate
+        return self.next - now
+
+
+async def receive(reader, files, rate, latencies, done):
+    """Read frames, at most rate bytes per second of file data, until cancelled.
+
+    Records (sent at, latency) of every group message and sets done when
+    the last file is in.
+    """
+    remaining = files
+    pace = Pacer(rate)
+    with tempfile.TemporaryFile() as sink:
+        while True:
+            header, payload = await framing.read_message_async(reader, 2, decode=False)
+            if header == mux_transfers.CHUNK_HEADER:
+                await asyncio.sleep(pace(len(payload)))
+                continue
+            payload = payload.decode()
+            if header == "msg" and "bench-msg " in payload:
+                sent = float(payload.split()[-1])
+                latencies.append((sent, time.perf_counter() - sent))
+            elif header == "file_transfer" and payload.startswith("file from server:"):
+                sink.seek(0)
+                await file_transfer.receive_file_body_async(reader, sink, throttle=pace)
+                remaining -= 1
+            elif header == "file_transfer" and payload.startswith("end:"):
+                remaining -= 1
+            if not remaining:
+                done.set()
+
+
+async def chat(client, interval, stop):
+    sent = 0
+    while not stop.is_set():
+        client.send("msg", f"bench-msg {sent} {time.perf_counter()}")
+        sent += 1
+        await client.writer.drain()
+        await asyncio.sleep(interval)
+
+
+async def run_case(mode, transfer, source, args):
+    with ServerProcess("--mode", mode, "--scrypt-n", "1024") as server:
+        os.makedirs(os.path.join(server.path, "files"))
+        for index in range(args.downloads):
+            shutil.copyfile(source, os.path.join(server.path, "files", f"file{index}"))
+
+        reader, writer = await connect(server.port, "receiver", transfer == "mux")
+        sender = await BenchClient.connect(server.port)
+        await sender.register("sender")
+
+        latencies = []
+        done = asyncio.Event()
+        receiving = asyncio.ensure_future(receive(reader, args.downloads, args.client_rate * 1e6, latencies, done))
+        stop = asyncio.Event()
+        chatting = asyncio.ensure_future(chat(sender, args.interval, stop))
+        await asyncio.sleep(0.5)
+
+        started = time.perf_counter()
+        for index in range(args.downloads):
+            server.command(f"send_file:receiver:files:file{index}")
+        await done.wait()
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await chatting
+        # Let the messages held up behind the files arrive.
+        await asyncio.sleep(2)
+        receiving.cancel()
+
+        writer.close()
+        await sender.close()
+
+    during = [latency for sent, latency in latencies if started <= sent <= started + elapsed]
+    return {
+        "mode": mode,
+        "transfer": transfer,
+        "downloads": args.downloads,
+        "size": args.size,
+        "client_rate_mb": args.client_rate,
+        "download_sec": round(elapsed, 3),
+        "messages": len(during),
+        "latency_p50_ms": round(percentile(during, 0.50) * 1000, 2),
+        "latency_max_ms": round(max(during, default=float("nan")) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=parse_size, default=parse_size("32M"))
+    parser.add_argument("--downloads", type=int, default=2)
+    parser.add_argument("--client-rate", type=float, default=20, help="MB/s of file data the receiver reads")
+    parser.add_argument("--interval", type=float, default=0.05, help="seconds between group messages")
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="chat-bench-src-") as directory:
+        source = make_file(directory, args.size)
+        results = [asyncio.run(run_case(mode, transfer, source, args)) for mode in args.modes for transfer in TRANSFERS]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':>9} {'transfer':>9} {'downloads':>10} {'download s':>11} {'messages':>9} {'p50 ms':>8} {'max ms':>8}")
+        for row in results:
+            print(f"{row['mode']:>9} {row['transfer']:>9} {row['downloads']:>10} {row['download_sec']:>11} "
+                  f"{row['messages']:>9} {row['latency_p50_ms']:>8} {row['latency_max_ms']:>8}")
+
+
+if __name__ == "__main__":
+    main()
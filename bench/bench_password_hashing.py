@@ -0,0 +1,88 @@
+"""Measure logins/sec of the password hasher at different KDF costs and pool sizes.
+
+Usage: python bench/bench_password_hashing.py [--kdfs scrypt:4096 scrypt:16384 pbkdf2:600000] [--workers 1 2 4] [--logins N] [--json]
+
+Every combination starts a password_hashing.Hasher, stores one hash and
+then checks the password N times from 32 concurrent threads, as concurrent
+logins on the threaded server would. The legacy unsalted sha256 digest is
+reported for reference; it runs inline because it costs microseconds.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import password_hashing  # noqa: E402
+
+PASSWORD = "correct horse battery staple"
+CLIENT_THREADS = 32
+
+
+def parse_kdf(text):
+    """Parse scrypt:N or pbkdf2:ITERATIONS."""
+    name, _, cost = text.partition(":")
+    if name not in ("scrypt", "pbkdf2") or not cost.isdigit():
+        raise argparse.ArgumentTypeError(f"expected scrypt:N or pbkdf2:ITERATIONS, got {text!r}")
+    return name, int(cost)
+
+
+def logins_per_sec(check, logins):
+    """Run check() logins times from CLIENT_THREADS threads and return the rate."""
+    with ThreadPoolExecutor(CLIENT_THREADS) as clients:
+        started = time.perf_counter()
+        results = list(clients.map(lambda _: check(), range(logins)))
+        elapsed = time.perf_counter() - started
+    if not all(results):
+        raise RuntimeError("a password check failed")
+    return logins / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--kdfs", nargs="+", type=parse_kdf,
+                        default=[parse_kdf(text) for text in ("scrypt:4096", "scrypt:16384", "pbkdf2:100000", "pbkdf2:600000")])
+    parser.add_argument("--workers", nargs="+", type=int, default=sorted({1, 2, os.cpu_count() or 1}))
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    legacy = hashlib.sha256(PASSWORD.encode()).hexdigest()
+    results = [{
+        "kdf": "sha256 (legacy)",
+        "cost": None,
+        "workers": 0,
+        "logins_per_sec": round(logins_per_sec(
+            lambda: hashlib.sha256(PASSWORD.encode()).hexdigest() == legacy, args.logins * 10), 1),
+    }]
+
+    for name, cost in args.kdfs:
+        password_hashing.KDF = name
+        if name == "scrypt":
+            password_hashing.SCRYPT_N = cost
+        else:
+            password_hashing.PBKDF2_ITERATIONS = cost
+
+        for workers in args.workers:
+            hasher = password_hashing.Hasher(workers, max_pending=CLIENT_THREADS)
+            try:
+                stored = hasher.hash(PASSWORD)
+                rate = logins_per_sec(lambda: hasher.verify(PASSWORD, stored)[0], args.logins)
+            finally:
+                hasher.close()
+            results.append({"kdf": name, "cost": cost, "workers": workers, "logins_per_sec": round(rate, 1)})
+
+    if args.json:
+        print(json.dumps({"cpus": os.cpu_count(), "results": results}, indent=2))
+    else:
+        print(f"{'kdf':>16} {'cost':>8} {'workers':>8} {'logins/s':>10}")
+        for row in results:
+            print(f"{row['kdf']:>16} {str(row['cost'] or '-'):>8} {row['workers']:>8} {row['logins_per_sec']:>10}")
+
+
+if __name__ == "__main__":
+    main()
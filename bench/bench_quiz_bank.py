@@ -0,0 +1,108 @@
+"""Compare the cost of starting a quiz from the files and from the quiz bank.
+
+Usage: python bench/bench_quiz_bank.py [--questions 10 100 1000] [--starts N] [--json]
+
+For every size a quiz with that many questions is written to a scratch
+directory. Each start is then timed three ways, without the fan-out:
+the original path (read and parse both files, build the message with +=
+and encode it), the first load into a QuizBank (the same work plus
+validation and the compact encodings), and a later lookup, which only
+checks the files' modification times.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import framing  # noqa: E402
+import quiz_bank  # noqa: E402
+
+
+def legacy_start(directory_name, filename, answer_file):
+    """The quiz start path before the quiz bank, minus the broadcast."""
+    quiz_questions = []
+    quiz_options = []
+    with open(os.path.join(directory_name, filename), 'r') as file:
+        question = ""
+        options = []
+        for line in file.readlines():
+            line = line.strip()
+            if line:
+                if line.startswith("a.") or line.startswith("b.") or line.startswith("c.") or line.startswith("d."):
+                    options.append(line)
+                else:
+                    if question:
+                        quiz_questions.append(question)
+                        quiz_options.append(options)
+                        question = ""
+                        options = []
+                    question = line
+        if question:
+            quiz_questions.append(question)
+            quiz_options.append(options)
+    with open(os.path.join(directory_name, answer_file), 'r') as file:
+        answers = file.read().strip().split()
+
+    quiz_message = ""
+    for i, question in enumerate(quiz_questions):
+        quiz_message += f"Question {i+1}: {question}\n\nOptions: {' '.join(quiz_options[i])}\n\n-----------------------------\n\n"
+    framing.encode_message("quiz_question", quiz_message)
+    return answers
+
+
+def write_quiz(directory_name, questions):
+    with open(os.path.join(directory_name, "bench_ques.txt"), "w") as file:
+        for number in range(questions):
+            file.write(f"What is the answer to question {number}?\n"
+                       f"a. The first option b. The second option c. The third option d. The fourth option\n\n")
+    with open(os.path.join(directory_name, "bench_ans.txt"), "w") as file:
+        file.write(" ".join("abcd"[number % 4] for number in range(questions)))
+
+
+def per_call(function, starts):
+    started = time.perf_counter()
+    for _ in range(starts):
+        function()
+    return (time.perf_counter() - started) / starts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--questions", nargs="+", type=int, default=[10, 100, 1000])
+    parser.add_argument("--starts", type=int, default=200)
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="chat-bench-") as base:
+        os.makedirs(os.path.join(base, "quizzes"))
+        for questions in args.questions:
+            write_quiz(os.path.join(base, "quizzes"), questions)
+            legacy = per_call(lambda: legacy_start(os.path.join(base, "quizzes"), "bench_ques.txt", "bench_ans.txt"),
+                              args.starts)
+            first = per_call(lambda: quiz_bank.QuizBank(base).load("quizzes", "bench_ques.txt", "bench_ans.txt"),
+                             args.starts)
+            bank = quiz_bank.QuizBank(base)
+            bank.load_directory("quizzes")
+            cached = per_call(lambda: bank.get("quizzes/bench"), args.starts)
+            results.append({
+                "questions": questions,
+                "legacy_us": round(legacy * 1e6, 1),
+                "first_load_us": round(first * 1e6, 1),
+                "cached_us": round(cached * 1e6, 1),
+            })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'questions':>10} {'legacy us':>10} {'first load us':>14} {'cached us':>10}")
+        for row in results:
+            print(f"{row['questions']:>10} {row['legacy_us']:>10} {row['first_load_us']:>14} {row['cached_us']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Compare scoring quiz answers one submission at a time with the batch scoring engine.
+
+Usage: python bench/bench_quiz_scoring.py [--submissions 10000] [--questions 100] [--batch 1024] [--repeat 3] [--json]
+
+The submissions are random answers, a tenth of them short. The original
+loop compares answer by answer with .lower() (padded so that short
+submissions do not raise IndexError); the engine encodes each submission as
+one byte per question and marks --batch of them at once. The engine is
+timed with and without per-question statistics, and its encoding step on
+its own. The best of --repeat runs is reported.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import quiz_bank  # noqa: E402
+import quiz_scoring  # noqa: E402
+
+
+def legacy_score(answer, answers):
+    """The scoring loop of the original evaluate_quiz, without the file write."""
+    score = 0
+    given = answer.split()
+    given += [""] * (len(answers) - len(given))
+    for i in range(len(answers)):
+        if given[i].lower() == answers[i]:
+            score += 1
+    return score
+
+
+def make_quiz(questions):
+    options = [["a. yes b. no c. maybe d. never"] for _ in range(questions)]
+    answers = ["abcd"[number % 4] for number in range(questions)]
+    return quiz_bank.Quiz("bench/quiz", [f"Question {number}?" for number in range(questions)], options, answers)
+
+
+def best(function, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - started)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--submissions", type=int, default=10000)
+    parser.add_argument("--questions", type=int, default=100)
+    parser.add_argument("--batch", type=int, default=1024, help="submissions marked at once")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    quiz = make_quiz(args.questions)
+    key = quiz_scoring.AnswerKey(quiz)
+    submissions = []
+    for index in range(args.submissions):
+        length = args.questions if index % 10 else rng.randrange(args.questions)
+        submissions.append(" ".join(rng.choice("abcdABCD") for _ in range(length)))
+    batches = [submissions[start:start + args.batch] for start in range(0, len(submissions), args.batch)]
+
+    legacy, expected = best(lambda: [legacy_score(answer, quiz.answers) for answer in submissions], args.repeat)
+    encode, _ = best(lambda: [b"".join(map(key.encode, batch)) for batch in batches], args.repeat)
+    engine, scores = best(lambda: [score for batch in batches for score in quiz_scoring.score_batch(key, batch)],
+                          args.repeat)
+    with_statistics, _ = best(lambda: [quiz_scoring.score_batch(key, batch, quiz_scoring.ItemStatistics(key))
+                                       for batch in batches], args.repeat)
+    assert scores == expected, "the engine and the loop disagree"
+
+    result = {
+        "submissions": args.submissions,
+        "questions": args.questions,
+        "batch": args.batch,
+        "legacy_ms": round(legacy * 1000, 1),
+        "engine_encode_ms": round(encode * 1000, 1),
+        "engine_ms": round(engine * 1000, 1),
+        "engine_with_statistics_ms": round(with_statistics * 1000, 1),
+        "speedup": round(legacy / engine, 2),
+    }
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for name, value in result.items():
+            print(f"  {name:<26} {value}")
+
+
+if __name__ == "__main__":
+    main()
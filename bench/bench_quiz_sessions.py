@@ -0,0 +1,141 @@
+"""Compare scoring quiz answers one file append at a time with the quiz session manager.
+
+Usage: python bench/bench_quiz_sessions.py [--submissions 5000] [--questions 20] [--threads 1 50] [--json]
+
+Every run scores --submissions answers from as many clients, submitted
+from --threads threads released together, in a scratch directory. The
+original path scores each answer and opens the score file to append its
+line; the session manager buffers it and leaves scoring and the file to its
+writer. The time includes writing every score out. The report also gives
+how often the score file was opened and how long a top 10 leaderboard of
+all the scores takes.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import quiz_bank  # noqa: E402
+import quiz_sessions  # noqa: E402
+
+
+class NullClient:
+    def sendall(self, data):
+        pass
+
+
+def legacy_evaluate(answer, filename, client, client_name, answers):
+    """The scoring path before the quiz session manager."""
+    scores = {client_name: 0}
+    given = answer.split()
+    for i in range(len(answers)):
+        if given[i].lower() == answers[i]:
+            scores[client_name] += 1
+
+    directory_name = "all_quiz_scores"
+    file_path = os.path.join(os.getcwd(), directory_name, filename)
+    if not os.path.exists(directory_name):
+        os.makedirs(directory_name)
+    with open(file_path, "a") as csv_file:
+        for username, score in scores.items():
+            csv_file.write(f"{username},{score}\n")
+    client.sendall(b"Quiz is over. Thank you for participating!\n")
+
+
+def make_quiz(questions):
+    options = [["a. yes b. no c. maybe d. never"] for _ in range(questions)]
+    answers = ["abcd"[number % 4] for number in range(questions)]
+    return quiz_bank.Quiz("bench/quiz", [f"Question {number}?" for number in range(questions)], options, answers)
+
+
+def submissions(count, questions):
+    return [(f"user{index}", " ".join("abcd"[(index + number) % 4] for number in range(questions)))
+            for index in range(count)]
+
+
+def concurrently(work, threads):
+    """Split work over threads started together; return the seconds until all finished."""
+    barrier = threading.Barrier(threads + 1)
+
+    def run(part):
+        barrier.wait()
+        for item in part:
+            item()
+
+    workers = [threading.Thread(target=run, args=(work[index::threads],)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return started
+
+
+def run(threads, args):
+    quiz = make_quiz(args.questions)
+    entries = submissions(args.submissions, args.questions)
+    client = NullClient()
+
+    legacy_work = [lambda name=name, answer=answer: legacy_evaluate(answer, "legacy.csv", client, name, quiz.answers)
+                   for name, answer in entries]
+    started = concurrently(legacy_work, threads)
+    legacy = time.perf_counter() - started
+
+    manager = quiz_sessions.QuizSessions()
+    session = manager.start(quiz, "sessions.csv")
+    work = [lambda name=name, answer=answer: manager.submit(session, name, answer) for name, answer in entries]
+    started = concurrently(work, threads)
+    accepted = time.perf_counter() - started
+    manager.close()
+    flushed = time.perf_counter() - started
+
+    leaderboard_started = time.perf_counter()
+    session.leaderboard(10)
+    leaderboard = time.perf_counter() - leaderboard_started
+
+    return {
+        "submissions": args.submissions,
+        "questions": args.questions,
+        "threads": threads,
+        "legacy_per_sec": round(args.submissions / legacy, 1),
+        "legacy_file_opens": args.submissions,
+        "sessions_accepted_per_sec": round(args.submissions / accepted, 1),
+        "sessions_flushed_per_sec": round(args.submissions / flushed, 1),
+        "sessions_file_opens": manager.batches_written,
+        "leaderboard_top10_ms": round(leaderboard * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--submissions", type=int, default=5000)
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--threads", nargs="+", type=int, default=[1, 50])
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="chat-bench-") as base:
+        os.chdir(base)
+        for threads in args.threads:
+            results.append(run(threads, args))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'threads':>8} {'legacy/s':>10} {'opens':>6} {'accepted/s':>10} {'flushed/s':>10} {'opens':>6} "
+              f"{'top10 ms':>9}")
+        for row in results:
+            print(f"{row['threads']:>8} {row['legacy_per_sec']:>10} {row['legacy_file_opens']:>6} "
+                  f"{row['sessions_accepted_per_sec']:>10} {row['sessions_flushed_per_sec']:>10} "
+                  f"{row['sessions_file_opens']:>6} {row['leaderboard_top10_ms']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Measure message latency for quiet clients while one client floods the server.
+
+Usage: python bench/bench_rate_limits.py [--clients 200] [--seconds 5] [--size 1024] [--modes threaded asyncio] [--json]
+
+--clients clients register and read everything they are sent. One of them
+posts a timestamped group message every --probe-interval seconds, which
+stays under the default msg limit, while one more client sends group
+messages of --size bytes as fast as its connection takes them for
+--seconds. Every quiet client records the latency of the probes, and one
+of them counts the flood messages it got until 2 seconds after the
+flood. The run is repeated without rate limits, with the delay policy
+(the server stops reading from the flooding client) and with the reject
+policy (it drops the extra frames).
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from bench_server_modes import collect, connect_clients
+from common import BenchClient, ServerProcess, percentile, raise_file_limit
+
+POLICIES = ("off", "delay", "reject")
+
+
+async def drain(client, counter=None):
+    """Read frames until the connection closes, counting flood messages if a counter is given."""
+    try:
+        while True:
+            header, payload = await client.read_message()
+            if counter is not None and header == "msg" and "noise " in payload:
+                counter[0] += 1
+    except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+        pass
+
+
+async def flood(client, seconds, size):
+    """Send messages until the deadline; under the delay policy the writes block once the socket buffers are full."""
+    padding = "x" * size
+    sent = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        client.send("msg", f"noise {sent} {padding}")
+        sent += 1
+        try:
+            await asyncio.wait_for(client.writer.drain(), max(0.001, deadline - time.perf_counter()))
+        except asyncio.TimeoutError:
+            break
+    return sent
+
+
+async def probe(client, seconds, interval):
+    sent = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        client.send("msg", f"bench-msg {sent} {time.perf_counter()}")
+        sent += 1
+        await client.writer.drain()
+        await asyncio.sleep(interval)
+    return sent
+
+
+async def run_case(mode, policy, args):
+    server_args = ["--mode", mode, "--scrypt-n", "1024"]
+    if policy != "off":
+        server_args += ["--rate-limit-policy", policy]
+    with ServerProcess(*server_args, rate_limits=policy != "off") as server:
+        clients, failures, _ = await connect_clients(server.port, args.clients, 50)
+        noisy = await BenchClient.connect(server.port)
+        await noisy.register("noisy")
+        prober, receivers = clients[0], clients[1:]
+
+        latencies = []
+        noise_seen = [0]
+        tasks = [asyncio.ensure_future(collect(client, latencies, float("inf"), asyncio.Event()))
+                 for client in receivers[1:]]
+        tasks.append(asyncio.ensure_future(drain(receivers[0], noise_seen)))
+        tasks += [asyncio.ensure_future(drain(client)) for client in (prober, noisy)]
+
+        flooding = asyncio.ensure_future(flood(noisy, args.seconds, args.size))
+        probes = await probe(prober, args.seconds, args.probe_interval)
+        flood_sent = await flooding
+        # Let what the server already accepted arrive.
+        await asyncio.sleep(2)
+        flood_delivered = noise_seen[0]
+
+        for task in tasks:
+            task.cancel()
+        for client in clients + [noisy]:
+            await client.close()
+
+    return {
+        "mode": mode,
+        "policy": policy,
+        "clients": len(receivers),
+        "connect_failures": failures,
+        "flood_written": flood_sent,
+        "flood_delivered": flood_delivered,
+        "probes_expected": probes * (len(receivers) - 1),
+        "probes_received": len(latencies),
+        "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--size", type=int, default=1024, help="bytes of padding in every flood message")
+    parser.add_argument("--probe-interval", type=float, default=0.25)
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--policies", nargs="+", choices=POLICIES, default=list(POLICIES))
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+    raise_file_limit()
+
+    results = [asyncio.run(run_case(mode, policy, args)) for mode in args.modes for policy in args.policies]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':>9} {'policy':>7} {'flood written':>14} {'delivered':>10} {'probes':>14} "
+              f"{'p50 ms':>8} {'p99 ms':>8}")
+        for row in results:
+            print(f"{row['mode']:>9} {row['policy']:>7} {row['flood_written']:>14} {row['flood_delivered']:>10} "
+                  f"{row['probes_received']:>6}/{row['probes_expected']:<7} "
+                  f"{row['latency_p50_ms']:>8} {row['latency_p99_ms']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Measure private message recipient lookup cost against the number of sessions.
+
+Usage: python bench/bench_registry.py [--sessions 100 1000 10000] [--json]
+
+Compares the former ACTIVE_USERS/CLIENTS scan used by send_message_to_client
+with SessionRegistry.get(). Lookups target random users so the linear scan
+pays its average cost.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import session_registry  # noqa: E402
+
+LOOKUPS = 2000
+
+
+class IdleSession(session_registry.Session):
+    """A session that is only looked up, never written to."""
+
+    queue_depth = 0
+
+    def _enqueue(self, item):
+        pass
+
+    def run(self, job):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def legacy_lookup(recipient_name, active_users, clients):
+    recipient_addr = list(active_users.keys())[list(active_users.values()).index(recipient_name)]
+    for client, address in clients:
+        if address[0] == recipient_addr[0] and address[1] == recipient_addr[1]:
+            return client
+
+
+def time_per_lookup(function, names):
+    started = time.perf_counter()
+    for name in names:
+        function(name)
+    return (time.perf_counter() - started) / len(names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", nargs="+", type=int, default=[100, 1000, 10000])
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    results = []
+    for count in args.sessions:
+        active_users = {}
+        clients = []
+        registry = session_registry.SessionRegistry()
+        for index in range(count):
+            address = ("10.0.0.1", 20000 + index)
+            client = object()
+            active_users[address] = f"user{index}"
+            clients.append((client, address))
+            registry.add(IdleSession(f"user{index}", client, address))
+
+        names = [f"user{random.randrange(count)}" for _ in range(LOOKUPS)]
+        results.append({
+            "sessions": count,
+            "legacy_us": round(time_per_lookup(lambda name: legacy_lookup(name, active_users, clients), names) * 1e6, 3),
+            "registry_us": round(time_per_lookup(registry.get, names) * 1e6, 3),
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'sessions':>9} {'legacy us':>11} {'registry us':>12}")
+        for row in results:
+            print(f"{row['sessions']:>9} {row['legacy_us']:>11} {row['registry_us']:>12}")
+
+
+if __name__ == "__main__":
+    main()
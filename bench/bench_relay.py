@@ -0,0 +1,86 @@
+"""Measure client-to-client file relay latency through the server.
+
+Usage: python bench/bench_relay.py [--size 256M] [--modes threaded asyncio] [--no-relay-archive] [--json]
+
+Two clients register, the first sends a file_to relay to the second, and the
+second records the time from the start of the upload to the first body byte
+(time to first byte) and to the last body byte (total transfer time).
+"""
+import argparse
+import asyncio
+import json
+import os
+import struct
+import tempfile
+import time
+
+from bench_file_transfer import make_file, parse_size
+from common import BenchClient, ServerProcess
+
+
+async def relay_once(port, path, size):
+    sender = await BenchClient.connect(port)
+    await sender.register("sender")
+    recipient = await BenchClient.connect(port)
+    await recipient.register("recipient")
+
+    async def receive():
+        await recipient.read_until(lambda header, payload: header == "file_transfer")
+        body_size = struct.unpack("!Q", await recipient.reader.readexactly(8))[0]
+        first = None
+        remaining = body_size
+        while remaining:
+            data = await recipient.reader.read(min(remaining, 1024 * 1024))
+            if not data:
+                raise ConnectionError("relay interrupted")
+            if first is None:
+                first = time.perf_counter()
+            remaining -= len(data)
+        return first, time.perf_counter()
+
+    receiving = asyncio.ensure_future(receive())
+    started = time.perf_counter()
+    sender.send("file_transfer", f"file_to:recipient:{os.path.basename(path)}")
+    sender.writer.write(struct.pack("!Q", size))
+    with open(path, "rb") as file:
+        await asyncio.get_running_loop().sendfile(sender.writer.transport, file)
+    first, last = await receiving
+
+    await sender.close()
+    await recipient.close()
+    return first - started, last - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=parse_size, default=parse_size("256M"))
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--no-relay-archive", action="store_true", help="pass --no-relay-archive to the server")
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="chat-bench-") as directory:
+        path = make_file(directory, args.size)
+        for mode in args.modes:
+            server_args = ["--mode", mode] + (["--no-relay-archive"] if args.no_relay_archive else [])
+            with ServerProcess(*server_args) as server:
+                ttfb, total = asyncio.run(relay_once(server.port, path, args.size))
+            results.append({
+                "mode": mode,
+                "archive": not args.no_relay_archive,
+                "bytes": args.size,
+                "ttfb_ms": round(ttfb * 1000, 2),
+                "total_ms": round(total * 1000, 2),
+                "mb_per_sec": round(args.size / total / 1e6, 1),
+            })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for row in results:
+            print(f"{row['mode']:>9}  ttfb {row['ttfb_ms']:>9} ms  total {row['total_ms']:>9} ms  {row['mb_per_sec']:>7} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Compare the cost of a message broadcast to every session with one posted to a room.
+
+Usage: python bench/bench_rooms.py [--sessions 1000 10000] [--room-size 30] [--json]
+
+The sessions are split into rooms of --room-size members, like class
+sections sharing one server. Before rooms, a message for a section had to
+go out as a msg broadcast, queued for every session; posting it to the
+section's room queues it for the members only. Both are timed through the
+session registry with sessions whose outbound queue only counts frames.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server_utils  # noqa: E402
+import session_registry  # noqa: E402
+
+MESSAGES = 2000
+
+
+class CountingSession(session_registry.Session):
+    queued = 0
+
+    @property
+    def queue_depth(self):
+        return 0
+
+    def _enqueue(self, item):
+        CountingSession.queued += 1
+
+    def run(self, job):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def time_per_message(function, senders):
+    CountingSession.queued = 0
+    started = time.perf_counter()
+    for sender in senders:
+        function(sender)
+    return (time.perf_counter() - started) / len(senders), CountingSession.queued / len(senders)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", nargs="+", type=int, default=[1000, 10000])
+    parser.add_argument("--room-size", type=int, default=30)
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    results = []
+    for count in args.sessions:
+        registry = session_registry.SessionRegistry()
+        sessions = []
+        for index in range(count):
+            session = CountingSession(f"user{index}", object(), ("10.0.0.1", 20000 + index))
+            registry.add(session)
+            registry.rooms.join(session, f"section{index // args.room_size}")
+            sessions.append(session)
+
+        senders = [random.choice(sessions) for _ in range(MESSAGES)]
+        broadcast_sec, broadcast_frames = time_per_message(
+            lambda sender: server_utils.broadcast_message("msg", f"Client {sender.username}: hello\n", registry, sender),
+            senders)
+        room_sec, room_frames = time_per_message(
+            lambda sender: server_utils.send_room_message(f"{registry.rooms.rooms_of(sender)[0]}:hello", sender, registry),
+            senders)
+        results.append({
+            "sessions": count,
+            "room_size": args.room_size,
+            "broadcast_us": round(broadcast_sec * 1e6, 1),
+            "broadcast_frames": round(broadcast_frames, 1),
+            "room_us": round(room_sec * 1e6, 1),
+            "room_frames": round(room_frames, 1),
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'sessions':>9} {'broadcast us':>13} {'frames':>7} {'room us':>8} {'frames':>7}")
+        for row in results:
+            print(f"{row['sessions']:>9} {row['broadcast_us']:>13} {row['broadcast_frames']:>7} "
+                  f"{row['room_us']:>8} {row['room_frames']:>7}")
+
+
+if __name__ == "__main__":
+    main()
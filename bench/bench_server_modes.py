@@ -0,0 +1,125 @@
+"""Compare connection capacity and message latency of the server modes.
+
+Usage: python bench/bench_server_modes.py [--clients N] [--messages M] [--modes threaded asyncio] [--json]
+
+For every mode a fresh server is started, N clients register concurrently and
+stay connected, then one of them sends M group messages. Every other client
+timestamps the arrival of each message, which gives the broadcast delivery
+latency distribution as seen by the receivers.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from common import BenchClient, ServerProcess, percentile, raise_file_limit
+
+
+async def connect_clients(port, count, concurrency):
+    """Register count clients, at most concurrency handshakes at a time."""
+    semaphore = asyncio.Semaphore(concurrency)
+    clients = []
+    failures = 0
+
+    async def connect(index):
+        nonlocal failures
+        async with semaphore:
+            client = None
+            try:
+                client = await BenchClient.connect(port)
+                await asyncio.wait_for(client.register(f"bench{index}"), timeout=30)
+                clients.append(client)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, RuntimeError):
+                failures += 1
+                if client is not None:
+                    client.writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connect(index) for index in range(count)))
+    return clients, failures, time.perf_counter() - started
+
+
+async def collect(client, latencies, expected, done):
+    """Record the latency of every benchmark message the client receives."""
+    try:
+        while True:
+            header, payload = await client.read_message()
+            if header == "msg" and "bench-msg " in payload:
+                sent_at = float(payload.rsplit(" ", 1)[1])
+                latencies.append(time.perf_counter() - sent_at)
+                if len(latencies) >= expected:
+                    done.set()
+    except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+        pass
+
+
+async def run_mode(mode, clients_count, messages, concurrency):
+    raise_file_limit()
+    with ServerProcess("--mode", mode) as server:
+        clients, failures, elapsed = await connect_clients(server.port, clients_count, concurrency)
+        result = {
+            "mode": mode,
+            "clients_requested": clients_count,
+            "clients_connected": len(clients),
+            "connect_failures": failures,
+            "connect_seconds": round(elapsed, 3),
+            "connections_per_sec": round(len(clients) / elapsed, 1) if elapsed else None,
+        }
+        if len(clients) < 2:
+            return result
+
+        sender, receivers = clients[0], clients[1:]
+        latencies = []
+        done = asyncio.Event()
+        expected = messages * len(receivers)
+        tasks = [asyncio.ensure_future(collect(client, latencies, expected, done)) for client in receivers]
+        sender_task = asyncio.ensure_future(collect(sender, [], 1, asyncio.Event()))
+
+        try:
+            for sequence in range(messages):
+                sender.send("msg", f"bench-msg {sequence} {time.perf_counter()}")
+                await sender.writer.drain()
+                await asyncio.sleep(0.01)
+            await asyncio.wait_for(done.wait(), timeout=60)
+        except asyncio.TimeoutError:
+            pass
+        except ConnectionError as error:
+            result["sender_error"] = repr(error)
+
+        for task in tasks + [sender_task]:
+            task.cancel()
+        for client in clients:
+            await client.close()
+
+        result.update({
+            "deliveries_expected": expected,
+            "deliveries_received": len(latencies),
+            "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        })
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=200, help="simultaneous handshakes")
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    results = [asyncio.run(run_mode(mode, args.clients, args.messages, args.concurrency)) for mode in args.modes]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(f"[{result['mode']}]")
+            for key, value in result.items():
+                if key != "mode":
+                    print(f"  {key:22} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Measure group message latency while one client has stopped reading.
+
+Usage: python bench/bench_slow_consumer.py [--clients N] [--messages M] [--size BYTES] [--modes threaded asyncio] [--policies drop disconnect] [--json]
+
+N clients register, one more registers and then never reads its socket.
+A sender broadcasts M messages padded to the given size, so the stalled
+client's socket buffers fill after a few hundred kilobytes. The healthy
+clients timestamp every arrival, which shows whether the stalled client
+holds up delivery to everybody else, and the sender records how long its
+own writes took.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from bench_server_modes import collect, connect_clients
+from common import BenchClient, ServerProcess, percentile, raise_file_limit
+
+
+async def run_case(mode, policy, clients_count, messages, size, queue_size):
+    raise_file_limit()
+    server_args = ["--mode", mode, "--slow-client-policy", policy, "--send-queue-size", queue_size]
+    with ServerProcess(*server_args) as server:
+        clients, failures, _ = await connect_clients(server.port, clients_count + 1, 50)
+        stalled = await BenchClient.connect(server.port)
+        await stalled.register("stalled")
+        # The stream reader stops pulling from the socket once its buffer is
+        # full, so from here on the server sees a client that never reads.
+
+        sender, receivers = clients[0], clients[1:]
+        latencies = []
+        done = asyncio.Event()
+        expected = messages * len(receivers)
+        tasks = [asyncio.ensure_future(collect(client, latencies, expected, done)) for client in receivers]
+        sender_task = asyncio.ensure_future(collect(sender, [], 1, asyncio.Event()))
+        padding = "x" * size
+
+        result = {"mode": mode, "policy": policy, "clients": len(receivers), "connect_failures": failures}
+        started = time.perf_counter()
+        try:
+            for sequence in range(messages):
+                sender.send("msg", f"{padding} bench-msg {sequence} {time.perf_counter()}")
+                await sender.writer.drain()
+            result["send_seconds"] = round(time.perf_counter() - started, 3)
+            await asyncio.wait_for(done.wait(), timeout=60)
+        except asyncio.TimeoutError:
+            pass
+        except ConnectionError as error:
+            result["sender_error"] = repr(error)
+
+        for task in tasks + [sender_task]:
+            task.cancel()
+        for client in clients + [stalled]:
+            await client.close()
+
+        result.update({
+            "deliveries_expected": expected,
+            "deliveries_received": len(latencies),
+            "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        })
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=8192, help="message padding in bytes")
+    parser.add_argument("--send-queue-size", type=int, default=1024, help="passed to the server")
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--policies", nargs="+", default=["drop", "disconnect"])
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    results = [
+        asyncio.run(run_case(mode, policy, args.clients, args.messages, args.size, args.send_queue_size))
+        for mode in args.modes
+        for policy in args.policies
+    ]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(f"[{result['mode']} / {result['policy']}]")
+            for key, value in result.items():
+                if key not in ("mode", "policy"):
+                    print(f"  {key:22} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Compare frame sizes and codec speed of the version 1 and version 2 wire formats.
+
+Usage: python bench/bench_wire_format.py [--frames N] [--json]
+
+Every sample frame is encoded in the version 1 format, the version 2 format
+and the version 2 format with zlib compression, then decoded N times
+through a FrameReader over a socketpair. Sizes are bytes on the wire; the
+times are per frame and include the socket round trip. Header validation is
+timed separately with the old list lookup and the VALID_HEADERS set.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import framing  # noqa: E402
+import quiz_bank  # noqa: E402
+import server_utils  # noqa: E402
+
+OLD_HEADERS = ["msg", "cmd", "to", "info", "file_transfer", "quiz_answer", "quiz_question"]
+
+
+def sample_frames():
+    """Return (name, frame) pairs typical of the chat traffic."""
+    bank = quiz_bank.QuizBank(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    quiz = bank.load("quiz_dir", "quiz_ques.txt", "quiz_ans.txt").message
+    return [
+        ("chat msg", framing.encode_message("msg", "Client alice: hi all\n")),
+        ("private msg", framing.encode_message("info", "alice (private): see you at 5?\n")),
+        ("file header", framing.encode_message("file_transfer", "file_to:alice:report.pdf\n")),
+        ("quiz questions", framing.encode_message("quiz_question", quiz)),
+        ("long broadcast", framing.encode_message("msg", "Client alice: " + "the quick brown fox " * 200 + "\n")),
+    ]
+
+
+def decode_rate(wire, version, frames):
+    """Send wire frames times over a socketpair and time reading them back."""
+    left, right = socket.socketpair()
+    reader = framing.FrameReader(right)
+    reader.version = version
+    sender = threading.Thread(target=lambda: left.sendall(wire * frames), daemon=True)
+    started = time.perf_counter()
+    sender.start()
+    for _ in range(frames):
+        reader.read_frame()
+    elapsed = time.perf_counter() - started
+    sender.join()
+    left.close()
+    right.close()
+    return elapsed / frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=20000)
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    results = []
+    for name, frame in sample_frames():
+        for label, version, compress in (("v1", 1, False), ("v2", 2, False), ("v2+zlib", 2, True)):
+            wire = framing.Codec(version, compress).wire(frame)
+            results.append({
+                "frame": name,
+                "format": label,
+                "bytes": len(wire),
+                "decode_us": round(decode_rate(wire, version, args.frames) * 1e6, 3),
+            })
+
+    validation = {
+        "list_ns": round(timeit.timeit(lambda: "quiz_answer" in OLD_HEADERS, number=10 ** 6) * 1000, 1),
+        "set_ns": round(timeit.timeit(lambda: "quiz_answer" in server_utils.VALID_HEADERS, number=10 ** 6) * 1000, 1),
+    }
+
+    if args.json:
+        print(json.dumps({"frames": results, "validate_quiz_answer": validation}, indent=2))
+    else:
+        print(f"{'frame':>16} {'format':>8} {'bytes':>7} {'decode us':>10}")
+        for row in results:
+            print(f"{row['frame']:>16} {row['format']:>8} {row['bytes']:>7} {row['decode_us']:>10}")
+        print(f"validate 'quiz_answer': list {validation['list_ns']} ns, set {validation['set_ns']} ns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""Measure how group chat throughput scales with the number of server worker processes.
+
+Usage: python bench/bench_workers.py [--workers 1 2 4] [--clients N] [--senders S] [--messages M] [--load-processes P] [--modes threaded asyncio] [--json]
+
+For every mode and --workers count a fresh server is started. The N
+clients are spread over P load generator processes so that the generator
+is not what runs out of CPU first. S senders then send M group messages
+each as fast as the server takes them, and every client counts the
+messages it receives; with more than one worker most of them cross the
+hub. The report gives deliveries per second and the CPU time the server
+processes (parent, workers and their hashing pools) used per thousand
+deliveries, read from /proc. Scaling needs at least as many free cores as
+workers plus load processes.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+
+from bench_coalescing import cpu_seconds
+from common import BenchClient, ServerProcess, raise_file_limit
+
+
+def process_tree(pid):
+    """Return pid and the pids of all its descendants."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as file:
+                    parent = int(file.read().rsplit(")", 1)[1].split()[1])
+            except OSError:
+                continue
+            children.setdefault(parent, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def tree_cpu_seconds(pids):
+    total = 0.0
+    for pid in pids:
+        try:
+            total += cpu_seconds(pid)
+        except OSError:
+            pass
+    return total
+
+
+async def load(index, port, names, senders, messages, total, barrier, results, timeout):
+    """Connect this process's clients, send its share and count deliveries."""
+    raise_file_limit()
+    clients = []
+    for name in names:
+        client = await BenchClient.connect(port)
+        await client.register(name)
+        clients.append(client)
+
+    # Every client gets every message except the ones it sent itself.
+    expected = sum(total - (messages if name in senders else 0) for name in names)
+    received = 0
+    done = asyncio.Event()
+
+    async def collect(client):
+        nonlocal received
+        try:
+            while True:
+                header, payload = await client.read_message()
+                if header == "msg" and "bench-msg " in payload:
+                    received += 1
+                    if received >= expected:
+                        done.set()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def send(client):
+        for sequence in range(messages):
+            client.send("msg", f"bench-msg {sequence}")
+            await client.writer.drain()
+            await asyncio.sleep(0)
+
+    tasks = [asyncio.ensure_future(collect(client)) for client in clients]
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    started = time.perf_counter()
+    await asyncio.gather(*(send(client) for client, name in zip(clients, names) if name in senders))
+    try:
+        await asyncio.wait_for(done.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+    results.put((index, received, expected, started, time.perf_counter()))
+
+    for task in tasks:
+        task.cancel()
+    for client in clients:
+        await client.close()
+
+
+def load_process(*args):
+    asyncio.run(load(*args))
+
+
+def run(mode, workers, args):
+    names = [f"bench{index}" for index in range(args.clients)]
+    senders = set(names[:args.senders])
+    total = args.senders * args.messages
+    # Cheap password hashing keeps the registrations, which are not measured, short.
+    with ServerProcess("--mode", mode, "--workers", workers, "--send-queue-size", 1 << 20, "--scrypt-n", 1024) as server:
+        # The port is open once the first worker listens; give the others time.
+        time.sleep(0.5 + 0.2 * workers)
+        barrier = multiprocessing.Barrier(args.load_processes + 1)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=load_process, args=(
+            index, server.port, names[index::args.load_processes], senders, args.messages, total,
+            barrier, results, args.timeout)) for index in range(args.load_processes)]
+        for process in processes:
+            process.start()
+
+        barrier.wait()
+        pids = process_tree(server.process.pid)
+        cpu_before = tree_cpu_seconds(pids)
+        reports = [results.get() for _ in processes]
+        cpu = tree_cpu_seconds(pids) - cpu_before
+        for process in processes:
+            process.join()
+
+    received = sum(report[1] for report in reports)
+    elapsed = max(report[4] for report in reports) - min(report[3] for report in reports)
+    return {
+        "mode": mode,
+        "workers": workers,
+        "clients": args.clients,
+        "deliveries_expected": sum(report[2] for report in reports),
+        "deliveries_received": received,
+        "seconds": round(elapsed, 3),
+        "deliveries_per_sec": round(received / elapsed, 1),
+        "server_cpu_ms_per_1k": round(cpu * 1000 / max(1, received) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4], help="--workers values")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=200, help="group messages per sender")
+    parser.add_argument("--load-processes", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="load generator processes (default half the CPUs)")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for outstanding deliveries")
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--json", action="store_true", help="print one JSON document instead of a table")
+    args = parser.parse_args()
+
+    results = [run(mode, workers, args) for mode in args.modes for workers in args.workers]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':>9} {'workers':>8} {'deliveries/s':>13} {'seconds':>9} {'cpu ms/1k':>10} {'received':>14}")
+        for row in results:
+            print(f"{row['mode']:>9} {row['workers']:>8} {row['deliveries_per_sec']:>13} {row['seconds']:>9} "
+                  f"{row['server_cpu_ms_per_1k']:>10} {row['deliveries_received']}/{row['deliveries_expected']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Helpers shared by the benchmark scripts.
+
+The benchmarks start server.py as a subprocess inside a scratch directory so
+that users.db and uploaded files never touch the working tree, and talk to it
+with asyncio clients that speak the same frames as client_utils.
+"""
+import asyncio
+import os
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_SCRIPT = os.path.join(REPO_DIR, "server.py")
+
+
+def raise_file_limit():
+    """Raise the soft open file limit to the hard limit."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def free_port():
+    """Return a TCP port that is currently free on localhost."""
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def is_listening(port):
+    """Return True if a socket is listening on the TCP port.
+
+    Reads the kernel socket tables instead of connecting: a probe connection
+    would show up on the server as a client that vanished mid-handshake.
+    """
+    for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(table) as file:
+                next(file)
+                for line in file:
+                    fields = line.split()
+                    if fields[3] == "0A" and int(fields[1].rsplit(":", 1)[1], 16) == port:
+                        return True
+        except OSError:
+            continue
+    return False
+
+
+class ServerProcess:
+    """Run server.py in a scratch directory for the duration of a with block.
+
+    The benchmarks send as fast as they can, so the per-user rate limits
+    are turned off unless rate_limits is True.
+    """
+
+    def __init__(self, *server_args, port=None, rate_limits=False):
+        self.port = port or free_port()
+        self.server_args = [str(arg) for arg in server_args]
+        if not rate_limits:
+            self.server_args.append("--no-rate-limits")
+        self.workdir = tempfile.TemporaryDirectory(prefix="chat-bench-")
+        self.process = None
+
+    def __enter__(self):
+        command = [sys.executable, SERVER_SCRIPT, str(self.port), "localhost"] + self.server_args
+        # stdin stays open: the console loop exits on EOF.
+        self.process = subprocess.Popen(command, cwd=self.workdir.name, stdin=subprocess.PIPE,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if is_listening(self.port):
+                return self
+            time.sleep(0.05)
+        self.__exit__()
+        raise RuntimeError("server did not start")
+
+    def __exit__(self, *exc_info):
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.workdir.cleanup()
+
+    def command(self, line):
+        """Type a line on the server console, e.g. a Quiz: command."""
+        self.process.stdin.write(line.encode() + b"\n")
+        self.process.stdin.flush()
+
+    @property
+    def path(self):
+        """The scratch directory the server runs in."""
+        return self.workdir.name
+
+
+def encode_message(header, message):
+    """Encode a frame exactly like client_utils.encode_message."""
+    if isinstance(message, str):
+        message = message.encode()
+    header = header.encode()
+    return struct.pack("!H", len(header)) + header + struct.pack("!I", len(message)) + message
+
+
+class BenchClient:
+    """Minimal asyncio chat client used to drive the server."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, port, host="localhost"):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def read_message(self):
+        header_length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+        header = (await self.reader.readexactly(header_length)).decode()
+        payload_length = struct.unpack("!I", await self.reader.readexactly(4))[0]
+        payload = await self.reader.readexactly(payload_length)
+        return header, payload.decode(errors="replace")
+
+    async def read_until(self, predicate):
+        """Read frames until predicate(header, payload) is true and return that frame."""
+        while True:
+            header, payload = await self.read_message()
+            if predicate(header, payload):
+                return header, payload
+
+    def send(self, header, message):
+        self.writer.write(encode_message(header, message))
+
+    async def register(self, username, password="bench"):
+        """Run the registration conversation from client_utils.authenticate."""
+        await self.read_until(lambda header, payload: payload.endswith("(yes/no):"))
+        self.send("info", "no")
+        self.send("info", username)
+        # Join notices for other clients can arrive in the middle of the handshake.
+        header, message = await self.read_until(lambda header, payload: payload.startswith("Username"))
+        if message != "Username registered successfully.":
+            raise RuntimeError(message)
+        self.send("info", password)
+        await self.read_until(lambda header, payload: payload.startswith("Server: You joined"))
+
+    async def login(self, username, password="bench"):
+        """Run the login conversation from client_utils.authenticate."""
+        await self.read_until(lambda header, payload: payload.endswith("(yes/no):"))
+        self.send("info", "yes")
+        self.send("info", username)
+        self.send("info", password)
+        header, payload = await self.read_until(
+            lambda header, payload: payload.startswith(("Server: You joined", "Invalid")))
+        if not payload.startswith("Server: You joined"):
+            raise RuntimeError(payload)
+
+    async def close(self):
+        try:
+            self.send("cmd", "disconnect")
+            await self.writer.drain()
+        except (ConnectionError, RuntimeError):
+            pass
+        self.writer.close()
+
+
+def percentile(values, fraction):
+    """Return the given percentile (0..1) of a list of numbers."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
@@ -0,0 +1,255 @@
+import collections
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import file_transfer
+import metrics
+
+# Blobs are stored as BLOB_DIRECTORY/<first two hex digits>/<hex digest>,
+# named by the BLAKE2b digest of their contents, which is the same digest
+# resumable transfers check. Files being received are written to
+# BLOB_DIRECTORY/tmp first.
+BLOB_DIRECTORY = ".blobs"
+
+# Server files (send_file:...) whose digest is remembered by path, size,
+# modification time and inode, so sending one again does not read it again.
+KNOWN_FILES_LIMIT = 1024
+
+# collect_blobs leaves unreferenced blobs younger than this (seconds) alone,
+# so that it cannot remove a blob between its commit and its first link.
+COLLECT_MIN_AGE = 3600
+
+
+class Blob:
+    """A blob mapped into memory, shared by every transfer that sends it.
+
+    Blobs never change once stored, so the mapping can be sliced and handed
+    to any number of sockets at once; it is unmapped when the last view of
+    it is released.
+    """
+
+    def __init__(self, path, digest):
+        """Map a stored blob.
+
+        Input Arguments:
+        - path (str): The blob file.
+        - digest (str): Its hex digest.
+        """
+        self.digest = digest
+        with open(path, "rb") as file:
+            self.size = file_transfer.file_size(file)
+            # mmap cannot map an empty file.
+            self.view = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b"")
+
+    def __repr__(self):
+        return f"Blob({self.digest[:16]}, {self.size} bytes)"
+
+
+class BlobWriter:
+    """A file being received into the store, hashed as it is written.
+
+    Has the write() of a binary file, so file_transfer's receive and relay
+    functions can write to it. commit() stores it under its digest; close()
+    without a commit discards it.
+    """
+
+    def __init__(self, store):
+        """Open a temporary file in the store.
+
+        Input Arguments:
+        - store (BlobStore): The store the blob is committed to.
+        """
+        self.store = store
+        self.hasher = file_transfer.new_hash()
+        descriptor, self.path = tempfile.mkstemp(dir=store.temp_directory)
+        self.file = os.fdopen(descriptor, "wb")
+        self.digest = None
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.file.write(data)
+
+    def commit(self):
+        """Store the data written so far.
+
+        Output Arguments:
+        - str: The hex digest of the blob.
+        """
+        self.file.close()
+        self.digest = self.hasher.hexdigest()
+        self.store.adopt(self.path, self.digest)
+        return self.digest
+
+    def close(self):
+        """Discard the file unless it was committed."""
+        self.file.close()
+        if self.digest is None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+class BlobStore:
+    """Files stored once per distinct content.
+
+    Uploads and relay copies are received into the store and the
+    <username>/<filename> entry is a hard link to the blob, so the same
+    course material uploaded by every student takes the space of one copy.
+    Entries are only ever replaced, never written through, since that would
+    change the blob for every other entry too.
+    """
+
+    def __init__(self, root=BLOB_DIRECTORY):
+        """Create the store's directories if needed.
+
+        Input Arguments:
+        - root (str): The directory blobs are kept in.
+        """
+        self.root = root
+        self.temp_directory = os.path.join(root, "tmp")
+        os.makedirs(self.temp_directory, exist_ok=True)
+        self._known = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, digest):
+        """Return the file of a blob."""
+        return os.path.join(self.root, digest[:2], digest)
+
+    def writer(self):
+        """Return a BlobWriter for a new blob."""
+        return BlobWriter(self)
+
+    def adopt(self, path, digest):
+        """Move a complete file whose digest is known into the store.
+
+        If the blob is already stored the file is removed instead, which is
+        where identical uploads are deduplicated.
+
+        Input Arguments:
+        - path (str): The file, on the same file system as the store.
+        - digest (str): The hex digest of its contents.
+        """
+        blob_path = self.path(digest)
+        if os.path.exists(blob_path):
+            os.remove(path)
+            # A fresh modification time keeps collect() off it until linked.
+            os.utime(blob_path)
+            metrics.BLOBS_DEDUPLICATED.inc()
+            return
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(path, blob_path)
+
+    def link(self, digest, path):
+        """Make path an entry for a blob, replacing whatever it was.
+
+        The link is made under a temporary name and renamed over path, so
+        readers see either the old file or the new one. Where hard links
+        are not possible the blob is copied.
+
+        Input Arguments:
+        - digest (str): The hex digest of the blob.
+        - path (str): The entry, e.g. <username>/<filename>.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.link"
+        try:
+            os.link(self.path(digest), temp_path)
+        except FileExistsError:
+            os.remove(temp_path)
+            os.link(self.path(digest), temp_path)
+        except OSError:
+            shutil.copyfile(self.path(digest), temp_path)
+        os.replace(temp_path, path)
+
+    def add_file(self, path):
+        """Store a file from anywhere on the server and return its digest.
+
+        The file is read once, while it is copied into the store; the
+        digest is remembered until the file changes.
+
+        Input Arguments:
+        - path (str): The file.
+
+        Output Arguments:
+        - str: The hex digest of the blob.
+        """
+        path = os.path.abspath(path)
+        status = os.stat(path)
+        key = (status.st_size, status.st_mtime_ns, status.st_ino)
+        with self._lock:
+            known = self._known.get(path)
+            if known is not None:
+                self._known.move_to_end(path)
+        if known is not None and known[0] == key and os.path.exists(self.path(known[1])):
+            return known[1]
+
+        with self.writer() as blob, open(path, "rb") as file:
+            shutil.copyfileobj(file, blob, file_transfer.CHUNK_SIZE)
+            digest = blob.commit()
+        with self._lock:
+            self._known[path] = (key, digest)
+            while len(self._known) > KNOWN_FILES_LIMIT:
+                self._known.popitem(last=False)
+        return digest
+
+    def open(self, digest):
+        """Return the Blob of a digest, mapped into memory."""
+        return Blob(self.path(digest), digest)
+
+    def _blob_files(self):
+        """Yield (path, os.stat_result) for every stored blob."""
+        for directory in os.scandir(self.root):
+            if not directory.is_dir() or directory.name == "tmp":
+                continue
+            for entry in os.scandir(directory.path):
+                try:
+                    yield entry.path, entry.stat()
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        """Return how many blobs are stored and how much space they save.
+
+        Output Arguments:
+        - dict: blobs, references (entries linked to a blob), stored_bytes
+          and referenced_bytes (the size of every entry added up).
+        """
+        stats = {"blobs": 0, "references": 0, "stored_bytes": 0, "referenced_bytes": 0}
+        for _, status in self._blob_files():
+            stats["blobs"] += 1
+            stats["references"] += status.st_nlink - 1
+            stats["stored_bytes"] += status.st_size
+            stats["referenced_bytes"] += status.st_size * (status.st_nlink - 1)
+        return stats
+
+    def collect(self, min_age=COLLECT_MIN_AGE):
+        """Remove blobs no entry links to any more.
+
+        Input Arguments:
+        - min_age (float): Keep blobs stored less than this many seconds ago.
+
+        Output Arguments:
+        - tuple: The number of blobs removed and the bytes freed.
+        """
+        removed = freed = 0
+        cutoff = time.time() - min_age
+        for path, status in self._blob_files():
+            if status.st_nlink == 1 and status.st_mtime < cutoff:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                removed += 1
+                freed += status.st_size
+        return removed, freed
@@ -0,0 +1,195 @@
+import datetime
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+
+# Messages waiting for the writer; once full, new messages are not logged
+# rather than slowing the broadcast down.
+QUEUE_SIZE = 10000
+
+# Most messages committed in one transaction, and how long (seconds) the
+# writer waits for more messages once it has one. Each commit is one fsync.
+BATCH_SIZE = 256
+BATCH_INTERVAL = 0.05
+
+# Messages per replay frame, and how many "cmd:history" replays by default.
+PAGE_SIZE = 100
+DEFAULT_COUNT = 20
+
+BUSY_TIMEOUT = 30
+
+CREATE_TABLE = ("CREATE TABLE IF NOT EXISTS messages "
+                "(id INTEGER PRIMARY KEY, sent_at REAL NOT NULL, sender TEXT NOT NULL, body TEXT NOT NULL)")
+CREATE_INDEX = "CREATE INDEX IF NOT EXISTS messages_sent_at ON messages (sent_at)"
+INSERT_MESSAGE = "INSERT INTO messages (sent_at, sender, body) VALUES (?, ?, ?)"
+SELECT_NTH_LAST_ID = "SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?"
+SELECT_FIRST_ID_SINCE = "SELECT id FROM messages WHERE sent_at >= ? ORDER BY sent_at, id LIMIT 1"
+SELECT_PAGE = "SELECT id, sent_at, sender, body FROM messages WHERE id >= ? AND id < ? ORDER BY id LIMIT ?"
+
+# Larger than any row id.
+LAST_ID = 2 ** 63 - 1
+
+USAGE = "Server: Usage: cmd:history [COUNT] or cmd:history FROM [TO], times as YYYY-MM-DDTHH:MM[:SS].\n"
+
+
+def connect(db_path):
+    """Open a connection to the history database in WAL mode.
+
+    synchronous=FULL makes every commit durable; the writer commits in
+    batches, so that is one fsync per batch rather than per message.
+
+    Input Arguments:
+    - db_path (str): Path of the history database.
+
+    Output Arguments:
+    - sqlite3.Connection: The connection.
+    """
+    connection = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=FULL")
+    return connection
+
+
+def parse_time(text):
+    """Parse an ISO 8601 local time or epoch seconds into epoch seconds."""
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.datetime.fromisoformat(text).timestamp()
+
+
+def format_message(sent_at, sender, body):
+    """Return one replayed message as a line of text."""
+    stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sent_at))
+    return f"[{stamp}] Client {sender}: {body}\n"
+
+
+class ChatHistory:
+    """Append-only log of group messages in an SQLite table indexed by time.
+
+    append() only puts the message on a bounded queue; a writer thread
+    commits whatever has queued up in one transaction. Replays read the
+    table in pages of PAGE_SIZE rows on their own connection, so neither the
+    broadcast path nor a long replay holds the whole log in memory.
+    """
+
+    def __init__(self, db_path="history.db"):
+        """Create the table and index if needed and start the writer.
+
+        Input Arguments:
+        - db_path (str): Path of the history database.
+        """
+        self.db_path = db_path
+        self._connection = connect(db_path)
+        self._connection.execute(CREATE_TABLE)
+        self._connection.execute(CREATE_INDEX)
+        self._connection.commit()
+
+        self._pending = queue.Queue(QUEUE_SIZE)
+        self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def append(self, sender, body, sent_at=None):
+        """Log a group message without waiting for it to be written.
+
+        Input Arguments:
+        - sender (str): The username of the sender.
+        - body (str): The message text.
+        - sent_at (float): Epoch seconds, now by default.
+
+        Output Arguments:
+        - bool: False if the queue was full and the message was not logged.
+        """
+        try:
+            self._pending.put_nowait((sent_at or time.time(), sender, body))
+            return True
+        except queue.Full:
+            metrics.HISTORY_DROPPED.inc()
+            return False
+
+    def _write_loop(self):
+        """Commit queued messages in batches until close()."""
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            batch = [item]
+
+            deadline = time.monotonic() + BATCH_INTERVAL
+            while len(batch) < BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._pending.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._pending.put(None)
+                    break
+                batch.append(item)
+
+            with metrics.DB_SECONDS.time("history"):
+                try:
+                    with self._connection:
+                        self._connection.executemany(INSERT_MESSAGE, batch)
+                except sqlite3.Error:
+                    metrics.HISTORY_DROPPED.inc(amount=len(batch))
+
+    def pages(self, count=None, start=None, end=None):
+        """Yield the requested messages in pages, oldest first.
+
+        Either the last count messages, or the messages sent from start up
+        to end, are returned.
+
+        Input Arguments:
+        - count (int): How many of the latest messages to return.
+        - start (float): Epoch seconds of the first message to return.
+        - end (float): Epoch seconds to stop before, no limit by default.
+
+        Output Arguments:
+        - iterator: Lists of (sent_at, sender, body) tuples, at most
+          PAGE_SIZE each.
+        """
+        connection = connect(self.db_path)
+        try:
+            # Ids grow with time, so both requests become an id range that is
+            # then read page by page along the primary key.
+            with metrics.DB_SECONDS.time("history"):
+                if start is None:
+                    row = connection.execute(SELECT_NTH_LAST_ID, (count - 1,)).fetchone()
+                    next_id = row[0] if row else 0
+                else:
+                    row = connection.execute(SELECT_FIRST_ID_SINCE, (start,)).fetchone()
+                    if row is None:
+                        return
+                    next_id = row[0]
+                stop_id = LAST_ID
+                if end is not None:
+                    row = connection.execute(SELECT_FIRST_ID_SINCE, (end,)).fetchone()
+                    stop_id = row[0] if row else LAST_ID
+
+            remaining = count if start is None else None
+            while remaining is None or remaining > 0:
+                limit = PAGE_SIZE if remaining is None else min(PAGE_SIZE, remaining)
+                with metrics.DB_SECONDS.time("history"):
+                    rows = connection.execute(SELECT_PAGE, (next_id, stop_id, limit)).fetchall()
+                if not rows:
+                    return
+                yield [row[1:] for row in rows]
+                next_id = rows[-1][0] + 1
+                if remaining is not None:
+                    remaining -= len(rows)
+                if len(rows) < limit:
+                    return
+        finally:
+            connection.close()
+
+    def close(self):
+        """Commit outstanding messages and close the database."""
+        self._pending.put(None)
+        self._writer.join()
+        self._connection.close()
@@ -0,0 +1,204 @@
+import collections
+import re
+import threading
+
+# Room messages kept per room and replayed to whoever joins it. server.py
+# overrides it from --room-history; room_history:ROOM:N on the console
+# changes it for one room.
+HISTORY_LIMIT = 50
+
+# Rooms one session may be in at once.
+ROOMS_PER_SESSION = 64
+
+# Rooms without members are kept, with their history, until there are
+# more than this many of them; the ones idle longest are forgotten first.
+IDLE_ROOMS_LIMIT = 1000
+
+NAME_PATTERN = re.compile(r"[A-Za-z0-9_.-]{1,32}")
+
+USAGE = ("Server: Use cmd:join:ROOM and cmd:leave:ROOM, send to a room with room:ROOM:message and list "
+         "your rooms with cmd:rooms. Room names are up to 32 letters, digits, '.', '_' or '-'.\n")
+
+
+def valid_name(name):
+    """Return True if name can be used as a room name."""
+    return NAME_PATTERN.fullmatch(name) is not None
+
+
+class Room:
+    """The members of a room and the frames of its latest messages."""
+
+    def __init__(self, name, limit=None):
+        """Initialize an empty room.
+
+        Input Arguments:
+        - name (str): The room name.
+        - limit (int): Messages kept for replay, HISTORY_LIMIT by default.
+        """
+        self.name = name
+        self.members = set()
+        self.recent = collections.deque(maxlen=HISTORY_LIMIT if limit is None else limit)
+
+    @property
+    def limit(self):
+        return self.recent.maxlen
+
+    def set_limit(self, limit):
+        """Keep at most limit messages, dropping the oldest ones."""
+        self.recent = collections.deque(self.recent, maxlen=limit)
+
+
+class Rooms:
+    """Thread-safe index of rooms by name and of the rooms of each session.
+
+    Membership is updated one join or leave at a time, so posting to a
+    room costs one queue append per member of that room, however many
+    sessions the server has. A message is encoded once and the same frame
+    is queued for every member and kept for replay, which sends the kept
+    frames as they are.
+    """
+
+    def __init__(self):
+        """Initialize without rooms."""
+        self._lock = threading.Lock()
+        self._rooms = {}
+        # session -> names of the rooms it is in
+        self._joined = {}
+        # names of the rooms without members, longest idle first
+        self._idle = collections.OrderedDict()
+        # name -> history limit set with set_limit()
+        self._limits = {}
+
+    def join(self, session, name):
+        """Add a session to a room, creating the room if needed.
+
+        Input Arguments:
+        - session (Session): The joining session.
+        - name (str): A valid room name.
+
+        Output Arguments:
+        - list: The frames kept for replay, oldest first, or None if the
+          session was already in the room. Raises ValueError if the
+          session is in ROOMS_PER_SESSION rooms already.
+        """
+        with self._lock:
+            joined = self._joined.setdefault(session, set())
+            if name in joined:
+                return None
+            if len(joined) >= ROOMS_PER_SESSION:
+                raise ValueError(f"at most {ROOMS_PER_SESSION} rooms at once")
+            room = self._room(name)
+            room.members.add(session)
+            joined.add(name)
+            self._idle.pop(name, None)
+            return list(room.recent)
+
+    def leave(self, session, name):
+        """Take a session out of a room.
+
+        Output Arguments:
+        - bool: False if the session was not in the room.
+        """
+        with self._lock:
+            joined = self._joined.get(session)
+            if joined is None or name not in joined:
+                return False
+            joined.discard(name)
+            if not joined:
+                del self._joined[session]
+            self._remove_member(name, session)
+            return True
+
+    def leave_all(self, session):
+        """Take a session out of every room it is in; returns their names."""
+        with self._lock:
+            names = self._joined.pop(session, ())
+            for name in names:
+                self._remove_member(name, session)
+            return sorted(names)
+
+    def rooms_of(self, session):
+        """Return the names of the rooms a session is in, sorted."""
+        with self._lock:
+            return sorted(self._joined.get(session, ()))
+
+    def is_member(self, session, name):
+        """Return True if the session is in the room."""
+        return name in self._joined.get(session, ())
+
+    def publish(self, name, frame, exclude=None, record=False):
+        """Queue a frame for every member of a room except one.
+
+        Input Arguments:
+        - name (str): The room name.
+        - frame (bytes): The encoded frame.
+        - exclude (Session): The member to skip, if any.
+        - record (bool): Keep the frame for replay to later members; the
+          room is created if it does not exist.
+
+        Output Arguments:
+        - int: The number of members the frame was queued for.
+        """
+        with self._lock:
+            room = self._room(name) if record else self._rooms.get(name)
+            if room is None:
+                return 0
+            if record:
+                room.recent.append(frame)
+            members = list(room.members)
+            if not members:
+                self._forget_idle(name)
+        count = 0
+        for session in members:
+            if session is not exclude:
+                session.send(frame)
+                count += 1
+        return count
+
+    def set_limit(self, name, limit):
+        """Change how many messages a room keeps for replay, now and whenever it is created again."""
+        with self._lock:
+            self._limits[name] = limit
+            room = self._rooms.get(name)
+            if room is not None:
+                room.set_limit(limit)
+                if not room.members:
+                    self._forget_idle(name)
+
+    def rooms(self):
+        """Return (name, members, kept messages, limit) of every room, sorted by name."""
+        with self._lock:
+            return sorted((room.name, len(room.members), len(room.recent), room.limit) for room in self._rooms.values())
+
+    def _room(self, name):
+        """Return a room, creating it; call with the lock held."""
+        room = self._rooms.get(name)
+        if room is None:
+            room = self._rooms[name] = Room(name, self._limits.get(name))
+        return room
+
+    def _remove_member(self, name, session):
+        """Take a session out of a room's members; call with the lock held."""
+        room = self._rooms[name]
+        room.members.discard(session)
+        if not room.members:
+            self._forget_idle(name)
+
+    def _forget_idle(self, name):
+        """Note a room without members; call with the lock held.
+
+        A room without history is dropped at once, otherwise it is kept
+        until IDLE_ROOMS_LIMIT idle rooms are exceeded.
+        """
+        if not self._rooms[name].recent:
+            del self._rooms[name]
+            self._idle.pop(name, None)
+            return
+        self._idle[name] = None
+        self._idle.move_to_end(name)
+        while len(self._idle) > IDLE_ROOMS_LIMIT:
+            oldest, _ = self._idle.popitem(last=False)
+            del self._rooms[oldest]
+
+    def __len__(self):
+        return len(self._rooms)
@@ -1,12 +1,20 @@
+import asyncio
+import os
 import socket
 import sys
 import threading
+import async_client
 import client_utils
 
-# Usage: ./client.py [PORT] [HOST]
+# Usage: ./client.py [PORT] [HOST] [--async]
+# --async runs async_client, which keeps chat going while files transfer.
 
 if __name__ == "__main__":
 
+    use_async = "--async" in sys.argv
+    if use_async:
+        sys.argv.remove("--async")
+
     if len(sys.argv) == 1:
         HOST = ("localhost", 10000)
     elif len(sys.argv) == 2:
@@ -14,6 +22,9 @@ if __name__ == "__main__":
     else:
         HOST = (sys.argv[2], int(sys.argv[1]))
 
+    if use_async:
+        exit(asyncio.run(async_client.main(HOST)))
+
     main_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     try:
@@ -30,6 +41,8 @@ if __name__ == "__main__":
         receive_thread = threading.Thread(target=client_utils.receive_messages, args=(main_socket,))
         # receive_thread.daemon_threads = True  # Set the thread as daemon    
         receive_thread.start()
+        client_utils.resume_downloads(main_socket)
+        threading.Thread(target=client_utils.send_heartbeats, args=(main_socket,), daemon=True).start()
     
     else:
         sys.stdout.write("Could not connect to " + HOST[0] + ":" + str(HOST[1]) + '\n')
@@ -42,23 +55,36 @@ if __name__ == "__main__":
             if ':' not in msg:
                 continue
             header, message = msg.split(":", 1)
-            encoded_message = client_utils.encode_message(header, message)
-            main_socket.sendall(encoded_message)
 
-            if header == 'cmd' and message == 'disconnect':
-                break
+            if header == 'file_transfer' and not os.path.isfile(message.split(":")[-1]):
+                sys.stdout.write("No such file: " + message.split(":")[-1] + '\n')
+                sys.stdout.flush()
+                continue
+
+            # Holding the lock keeps heartbeats out of the middle of a file body.
+            with client_utils.SEND_LOCK:
+                if header == 'file_transfer' and message.startswith('file_to_server') and client_utils.CODEC.resume:
+                    client_utils.upload_file(filename=message.split(":")[1], main_socket=main_socket)
+                    continue
+
+                encoded_message = client_utils.encode_message(header, message)
+                main_socket.sendall(encoded_message)
+
+                if header == 'cmd' and message == 'disconnect':
+                    break
+
+                elif header == 'file_transfer' and message.startswith('file_to_server'):
+
+                    client_utils.send_file(filename=message.split(":")[1], main_socket=main_socket)
 
-            elif header == 'file_transfer' and message.startswith('file_to_server'):
+                elif header == 'file_transfer' and message.startswith('file_to'):
 
-                client_utils.send_file(filename=message.split(":")[1], main_socket=main_socket)
+                    client_utils.send_file(filename=message.split(":")[2], main_socket=main_socket)
 
-            elif header == 'file_transfer' and message.startswith('file_to'):
-                
-                client_utils.send_file(filename=message.split(":")[2], main_socket=main_socket)
-                
         except KeyboardInterrupt:
             encoded_message = client_utils.encode_message("cmd", "disconnect")
-            main_socket.sendall(encoded_message)
+            with client_utils.SEND_LOCK:
+                main_socket.sendall(encoded_message)
             break
     
     receive_thread.join()
@@ -1,5 +1,26 @@
-import struct
 import os
+import queue
+import threading
+import time
+import framing
+import file_transfer
+
+# The frame format agreed with the server, set by authenticate().
+CODEC = framing.V1
+
+# Seconds to wait for the server to say where an upload continues from.
+OFFSET_TIMEOUT = 30
+
+# Transfer id -> queue the receive thread puts the server's offset on.
+PENDING_UPLOADS = {}
+
+# Seconds between the cmd:ping heartbeats that keep the server from closing
+# the session as idle; well below the server's default --idle-timeout.
+HEARTBEAT_INTERVAL = 60
+
+# Held by whoever writes to the socket, so that a heartbeat never lands in
+# the middle of a file body.
+SEND_LOCK = threading.Lock()
 
 
 def receive_messages(main_socket):
@@ -16,18 +37,30 @@ def receive_messages(main_socket):
             header, payload = decode_message(main_socket)
 
             if validate_message(header):
+                if header == "cmd":
+                    # The server's pong to a heartbeat.
+                    continue
                 print("=================")
 
-                if header == "file_transfer" and (payload.startswith("file_to") or payload.startswith("file from server")):
+                if header == "file_transfer" and payload.startswith("offset:"):
+                    _, identifier, offset = payload.strip().split(":")
+                    waiting = PENDING_UPLOADS.get(identifier)
+                    if waiting is not None:
+                        waiting.put(int(offset))
+
+                elif header == "file_transfer" and (payload.startswith("file_to") or payload.startswith("file from server")):
                     print(payload, end="")
 
                     if payload.startswith("file_to"):
-                        sender, filename = payload.split(":")[1:]
+                        sender, filename = payload.strip().split(":")[1:]
+                        receive_file_from_server(filename, main_socket, sender)
+                    elif payload.count(":") == 3:
+                        # file from server:FILENAME:TRANSFER_ID:OFFSET
+                        filename, identifier, offset = payload.strip().split(":")[1:]
+                        receive_resumable_download(filename, identifier, int(offset), main_socket)
                     else:
-                        filename = payload.split(":")[1]
-                        sender = 'Server'
-
-                    receive_file_from_server(filename, main_socket, sender)
+                        filename = payload.strip().split(":")[1]
+                        receive_file_from_server(filename, main_socket, 'Server')
         
                 else:
                     print(payload, end="")
@@ -40,39 +73,54 @@ def receive_messages(main_socket):
             break
 
 
+def send_heartbeats(main_socket):
+    """Send cmd:ping every HEARTBEAT_INTERVAL seconds until the socket fails.
+
+    A heartbeat is skipped while something else is being sent, which the
+    server counts as activity anyway.
+
+    Input Arguments:
+    - main_socket (socket): The main socket used for communication.
+
+    Output Arguments:
+    - None
+    """
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        if not SEND_LOCK.acquire(blocking=False):
+            continue
+        try:
+            main_socket.sendall(encode_message("cmd", "ping"))
+        except OSError:
+            return
+        finally:
+            SEND_LOCK.release()
+
+
 def encode_message(header, message):
     """Encode a message for sending over the network.
 
     Input Arguments:
     - header (str): The header of the message.
-    - message (str): The payload of the message.
+    - message (str or bytes): The payload of the message.
 
     Output Arguments:
     - bytes: The encoded message.
     """
-    header_length = len(header).to_bytes(2, byteorder="big")
-    payload_length = len(message).to_bytes(4, byteorder="big")
-    return header_length + header.encode() + payload_length + message.encode()
+    return CODEC.wire(framing.encode_message(header, message))
 
 
-def decode_message(main_socket):
+def decode_message(main_socket, decode=True):
     """Decode a message received over the network.
 
     Input Arguments:
     - main_socket (socket): The main socket used for communication.
+    - decode (bool): Decode the payload to str; pass False to get the raw bytes.
 
     Output Arguments:
     - tuple: A tuple containing the header and payload of the decoded message.
     """
-    header_length = main_socket.recv(2)
-    header_length = struct.unpack("!H", header_length)[0]
-    header = main_socket.recv(header_length).decode()
-
-    payload_length = main_socket.recv(4)
-    payload_length = struct.unpack("!I", payload_length)[0]
-    payload = main_socket.recv(payload_length).decode()
-
-    return header, payload
+    return framing.reader_for(main_socket).read_frame(decode)
 
 
 def validate_message(header):
@@ -86,7 +134,7 @@ def validate_message(header):
     """
     if header == "msg":
         return True
-    elif header in ["info", "error", "file_transfer", "quiz_question", "quiz_answer"]:
+    elif header in ["info", "error", "cmd", "file_transfer", "quiz_question", "quiz_answer"]:
         return True  # Allow these headers for system messages
     else:
         return False
@@ -101,10 +149,19 @@ def authenticate(main_socket):
     Output Arguments:
     - bool: True if authentication is successful, False otherwise.
     """
+    global CODEC
+
+    # Ask for the compact frame format; the server answers after its prompt.
+    main_socket.sendall(encode_message(framing.HELLO, framing.Codec(framing.VERSION, True, True).hello()))
     header, response = decode_message(main_socket)
 
     if header != "info":
         return False
+
+    header, hello = decode_message(main_socket)
+    if header == framing.HELLO:
+        CODEC = framing.Codec.from_hello(hello)
+        framing.reader_for(main_socket).version = CODEC.version
     
     print(response)
 
@@ -150,16 +207,9 @@ def receive_file_from_server(filename, main_socket, sender):
     Output Arguments:
     - None
     """
+    filename = os.path.basename(filename)
     with open(filename, "wb") as file:
-        while True:
-            data = main_socket.recv(1024)
-            if not data:
-                break
-            if data.endswith(b'EOF'):  # Check for end of file marker
-                file.write(data[:-3])  # Write all data except the EOF marker  
-                break
-
-            file.write(data)
+        file_transfer.receive_file_body(main_socket, file)
 
     print(f"File '{filename}' received from {sender}.\n")
 
@@ -177,15 +227,93 @@ def send_file(filename, main_socket):
     file_path = os.path.join(os.getcwd(), filename)
     
     with open(file_path, "rb") as file:
-        while True:
-            data = file.read(1024)
-            if not data:
-                break
-            if data.endswith(b'EOF'):  # Check for end of file marker
-                main_socket.sendall(data) 
-                break
-            main_socket.sendall(data)
-                    
-        main_socket.sendall(b'EOF')  # Send end of file marker
-       
-    print(f"File '{filename}' sent to server.\n")
\ No newline at end of file
+        file_transfer.send_file_body(main_socket, file)
+
+    print(f"File '{filename}' sent to server.\n")
+
+
+def receive_resumable_download(filename, identifier, offset, main_socket):
+    """Receive a file from the server that can be resumed if the connection drops.
+
+    The file is written to FILENAME.TRANSFER_ID.part and renamed once its
+    digest matches; resume_downloads() asks for the rest of any part file
+    left behind.
+
+    Input Arguments:
+    - filename (str): The name of the file.
+    - identifier (str): The transfer id.
+    - offset (int): The number of bytes the part file already holds.
+    - main_socket (socket): The main socket used for communication.
+
+    Output Arguments:
+    - None
+    """
+    filename = os.path.basename(filename)
+    part_path = os.path.basename(f"{filename}.{identifier}.{file_transfer.PARTIAL_SUFFIX}")
+    with open(part_path, "r+b" if offset and os.path.exists(part_path) else "w+b") as file:
+        try:
+            file_transfer.receive_resumable_body(main_socket, file, offset)
+            error = None
+        except file_transfer.IntegrityError as exception:
+            error = exception
+
+    if error is not None:
+        os.remove(part_path)
+        print(f"File '{filename}' from Server was damaged in transit and discarded.\n")
+        return
+
+    os.replace(part_path, filename)
+    print(f"File '{filename}' received from Server{f' (resumed at byte {offset})' if offset else ''}.\n")
+
+
+def resume_downloads(main_socket):
+    """Ask the server for the rest of every download left unfinished in the working directory.
+
+    Input Arguments:
+    - main_socket (socket): The main socket used for communication.
+
+    Output Arguments:
+    - None
+    """
+    if not CODEC.resume:
+        return
+    for name in os.listdir("."):
+        fields = name.rsplit(".", 2)
+        if len(fields) == 3 and fields[2] == file_transfer.PARTIAL_SUFFIX:
+            offset = os.path.getsize(name)
+            print(f"Resuming download of '{fields[0]}' from byte {offset}.")
+            main_socket.sendall(encode_message("file_transfer", f"resume_download:{fields[1]}:{offset}"))
+
+
+def upload_file(filename, main_socket):
+    """Send a file to the server so that an interrupted upload can be resumed.
+
+    The server answers the upload request with the number of bytes it
+    already has of this file (transfer ids only change with the file's
+    size or modification time), and only the rest is sent.
+
+    Input Arguments:
+    - filename (str): The name of the file to send.
+    - main_socket (socket): The main socket used for communication.
+
+    Output Arguments:
+    - None
+    """
+    file_path = os.path.join(os.getcwd(), filename)
+    identifier = file_transfer.transfer_id(file_path)
+    PENDING_UPLOADS[identifier] = queue.Queue(1)
+
+    try:
+        main_socket.sendall(encode_message("file_transfer", f"upload:{identifier}:{os.path.getsize(file_path)}:{filename}"))
+        try:
+            offset = PENDING_UPLOADS[identifier].get(timeout=OFFSET_TIMEOUT)
+        except queue.Empty:
+            print(f"The server did not accept the upload of '{filename}'.\n")
+            return
+    finally:
+        del PENDING_UPLOADS[identifier]
+
+    with open(file_path, "rb") as file:
+        file_transfer.send_resumable_body(main_socket, file, offset)
+
+    print(f"File '{filename}' sent to server{f' (resumed at byte {offset})' if offset else ''}.\n")
@@ -0,0 +1,669 @@
+import asyncio
+import functools
+import itertools
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+import file_fanout
+import file_transfer
+import framing
+import session_registry
+
+# Bytes a link may have waiting to be written before file streams over it
+# pause. Chat frames are always queued, like Session.sendall().
+LINK_HIGH_WATER = 4 * 1024 * 1024
+
+# Seconds a worker waits for the hub to confirm a username at login.
+CLAIM_TIMEOUT = 10
+
+# Separates the text fields of a link frame from each other and from the
+# binary body that may follow them.
+SEPARATOR = b"\0"
+
+logger = logging.getLogger("chat")
+
+
+def pack(*fields, body=b""):
+    """Join text fields and an optional binary body into a link payload."""
+    return SEPARATOR.join(field.encode() for field in fields) + SEPARATOR + bytes(body)
+
+
+def unpack(payload, count):
+    """Split a link payload into count text fields and the body after them."""
+    parts = bytes(payload).split(SEPARATOR, count)
+    return [part.decode() for part in parts[:count]] + [parts[count]]
+
+
+class Link:
+    """Framed connection between the hub and one worker process.
+
+    send() only queues the frame; a sender thread writes everything queued
+    so far with one sendall(), so callers on an event loop never block and
+    a burst of broadcasts costs one syscall per batch. A receiver thread
+    passes every frame to handler(kind, payload); the payload is a
+    memoryview that is only valid until the handler returns.
+    """
+
+    def __init__(self, sock, handler, name, on_close=None):
+        """Initialize the link; call start() to run it.
+
+        Input Arguments:
+        - sock (socket): One end of a connected stream socket pair.
+        - handler (callable): Called with (kind, payload) for every frame.
+        - name (str): Prefix of the thread names.
+        - on_close (callable): Called once the peer has gone away.
+        """
+        self.sock = sock
+        self.handler = handler
+        self.on_close = on_close
+        self._pending = []
+        self._pending_bytes = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._room = threading.Condition(self._lock)
+        self._sender = threading.Thread(target=self._send_loop, name=f"{name}-send", daemon=True)
+        self._receiver = threading.Thread(target=self._receive_loop, name=f"{name}-receive", daemon=True)
+
+    def start(self):
+        """Start the sender and receiver threads."""
+        self._sender.start()
+        self._receiver.start()
+
+    def send(self, kind, payload=b""):
+        """Queue a frame for the peer.
+
+        Input Arguments:
+        - kind (str): The frame header.
+        - payload (bytes): The frame payload.
+
+        Output Arguments:
+        - None
+        """
+        frame = framing.encode_message(kind, payload)
+        with self._lock:
+            if self._closed:
+                return
+            self._pending.append(frame)
+            self._pending_bytes += len(frame)
+            self._ready.notify()
+
+    def wait_for_room(self):
+        """Block while more than LINK_HIGH_WATER bytes are waiting to be written."""
+        with self._lock:
+            while self._pending_bytes > LINK_HIGH_WATER and not self._closed:
+                self._room.wait()
+
+    @property
+    def congested(self):
+        """True while more than LINK_HIGH_WATER bytes are waiting to be written."""
+        return self._pending_bytes > LINK_HIGH_WATER
+
+    def _send_loop(self):
+        """Write queued frames in batches until close()."""
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._ready.wait()
+                if not self._pending:
+                    return
+                frames, self._pending = self._pending, []
+            data = frames[0] if len(frames) == 1 else b"".join(frames)
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self._shut()
+                return
+            with self._lock:
+                self._pending_bytes -= len(data)
+                self._room.notify_all()
+
+    def _receive_loop(self):
+        """Hand received frames to the handler until the peer goes away."""
+        reader = framing.FrameReader(self.sock)
+        try:
+            while True:
+                kind, payload = reader.read_frame(decode=False)
+                try:
+                    self.handler(kind, payload)
+                except Exception:
+                    logger.exception("Error handling %s frame from the cluster", kind)
+        except (ConnectionError, OSError):
+            pass
+        self._shut()
+        if self.on_close is not None:
+            self.on_close()
+
+    def _shut(self):
+        """Stop queueing and wake everybody who waits on the link."""
+        with self._lock:
+            self._closed = True
+            self._pending_bytes = 0
+            self._ready.notify_all()
+            self._room.notify_all()
+
+    def close(self):
+        """Write what is still queued, then close the socket."""
+        with self._lock:
+            self._closed = True
+            self._ready.notify_all()
+            self._room.notify_all()
+        if threading.current_thread() is not self._sender:
+            self._sender.join(session_registry.CLOSE_TIMEOUT)
+        self.sock.close()
+
+
+class Hub:
+    """Routes traffic between worker processes and owns the session directory.
+
+    Runs in the parent process with one Link per worker. The directory maps
+    every logged in username to the worker that owns its connection: a
+    login only succeeds once the hub has claimed the name, which keeps
+    usernames unique across workers, and every claim and release is
+    announced to the other workers so they can address remote users
+    without asking. Broadcasts and room messages are forwarded to every
+    other worker, private frames and file streams only to the owner of the
+    recipient.
+    """
+
+    def __init__(self, sockets):
+        """Start a link to every worker.
+
+        Input Arguments:
+        - sockets (list): The hub end of each worker's socket pair, in
+          worker order.
+        """
+        self._lock = threading.Lock()
+        # username -> (worker index, hello payload of the user's codec)
+        self.directory = {}
+        # stream id -> (worker that sends it, worker that receives it)
+        self._streams = {}
+        # Named recipient groups of send_file, kept here since the hub
+        # splits every send_file by the workers of the recipients.
+        self.groups = file_fanout.Groups()
+        self.links = [Link(sock, functools.partial(self._route, index), f"hub-{index}",
+                           functools.partial(self._worker_gone, index))
+                      for index, sock in enumerate(sockets)]
+        for link in self.links:
+            link.start()
+
+    def _others(self, index):
+        return [link for other, link in enumerate(self.links) if other != index]
+
+    def _route(self, index, kind, payload):
+        """Act on a frame received from worker index."""
+        if kind in ("broadcast", "room"):
+            frame = bytes(payload)
+            for link in self._others(index):
+                link.send(kind, frame)
+
+        elif kind == "deliver":
+            username, _ = unpack(payload, 1)
+            owner = self.directory.get(username)
+            if owner is not None:
+                self.links[owner[0]].send("deliver", bytes(payload))
+
+        elif kind in ("data", "end", "credit", "closed"):
+            stream, _ = unpack(payload[:64], 1)
+            with self._lock:
+                # The receiver only reports "closed" after the sender's
+                # "end", or before any data if the recipient left; either
+                # way nothing else is routed on the stream after it.
+                route = self._streams.pop(stream, None) if kind == "closed" else self._streams.get(stream)
+            if route is not None:
+                self.links[route[0] if kind in ("credit", "closed") else route[1]].send(kind, bytes(payload))
+
+        elif kind == "open":
+            stream, username, _ = unpack(payload, 2)
+            owner = self.directory.get(username)
+            if owner is None:
+                self.links[index].send("closed", pack(stream, "-1"))
+                return
+            with self._lock:
+                self._streams[stream] = (index, owner[0])
+            self.links[owner[0]].send("open", bytes(payload))
+
+        elif kind == "claim":
+            request, username, hello, _ = unpack(payload, 3)
+            with self._lock:
+                claimed = username not in self.directory
+                if claimed:
+                    self.directory[username] = (index, hello)
+            self.links[index].send("claimed", pack(request, "1" if claimed else "0"))
+            if claimed:
+                for link in self._others(index):
+                    link.send("joined", pack(username, str(index), hello))
+
+        elif kind == "release":
+            username, _ = unpack(payload, 1)
+            with self._lock:
+                released = self.directory.get(username, (None,))[0] == index
+                if released:
+                    del self.directory[username]
+            if released:
+                for link in self._others(index):
+                    link.send("left", pack(username))
+
+    def _worker_gone(self, index):
+        """Release the usernames of a worker whose link closed."""
+        with self._lock:
+            usernames = [username for username, (owner, _) in self.directory.items() if owner == index]
+            for username in usernames:
+                del self.directory[username]
+        for username in usernames:
+            for link in self._others(index):
+                link.send("left", pack(username))
+
+    def console(self, message):
+        """Run a console command on the workers.
+
+        "send_file:USERS:..." goes to the workers that own the users, each
+        with only its own ones in the list, and @GROUP names are expanded
+        first; every other command goes to all workers, which apply it to
+        their own clients.
+
+        Input Arguments:
+        - message (str): The console line.
+
+        Output Arguments:
+        - list: The users named by the command that are not online. Raises
+          KeyError for an unknown group.
+        """
+        if message.startswith("send_file:"):
+            _, recipient, rest = message.split(":", 2)
+            if recipient != "all":
+                by_owner = {}
+                offline = []
+                for username in self.groups.expand(recipient):
+                    owner = self.directory.get(username)
+                    if owner is None:
+                        offline.append(username)
+                    else:
+                        by_owner.setdefault(owner[0], []).append(username)
+                for index, usernames in by_owner.items():
+                    self.links[index].send("console", f"send_file:{','.join(usernames)}:{rest}")
+                return offline
+        for link in self.links:
+            link.send("console", message)
+        return []
+
+    def stop(self):
+        """Tell every worker to shut down and close the links."""
+        for link in self.links:
+            link.send("stop")
+        for link in self.links:
+            link.close()
+
+
+class RemoteSession(session_registry.Session):
+    """Stand-in for a session owned by another worker process.
+
+    ClusterRegistry.get() returns one for a username that is logged in on
+    another worker. Frames queued on it are routed through the hub to the
+    owner, which queues them on the real session; run() streams whatever
+    the job writes, such as a relayed file, the same way.
+    """
+
+    local = False
+
+    def __init__(self, username, registry, worker, codec):
+        """Initialize the stand-in.
+
+        Input Arguments:
+        - username (str): The remote username.
+        - registry (ClusterRegistry): The registry of this worker.
+        - worker (int): The index of the worker that owns the session.
+        - codec (framing.Codec): The frame format of the remote client.
+        """
+        super().__init__(username, None, ("worker", worker), codec=codec)
+        self.registry = registry
+
+    @property
+    def queue_depth(self):
+        # The owner applies the slow client policy to the real queue.
+        return 0
+
+    def _enqueue(self, item):
+        self.registry.link.send("deliver", pack(self.username, body=item))
+
+    def run(self, job):
+        writer, delivered = self.registry.open_stream(self.username)
+        future = Future()
+
+        def stream():
+            try:
+                job(writer)
+            finally:
+                writer.end()
+            try:
+                future.set_result(delivered.result())
+            except BaseException as error:
+                future.set_exception(error)
+
+        threading.Thread(target=stream, name=f"stream-{self.username}", daemon=True).start()
+        return future
+
+    def run_async(self, job):
+        """Like run(), for a coroutine job that writes to a stream writer."""
+        writer, delivered = self.registry.open_stream(self.username)
+
+        async def stream():
+            try:
+                await job(writer)
+            finally:
+                writer.end()
+            return await asyncio.wrap_future(delivered)
+
+        return asyncio.ensure_future(stream())
+
+    def disconnect(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StreamWriter:
+    """Socket-like and stream-writer-like end of a stream to a remote session.
+
+    Offers sendall() for blocking jobs and write()/drain() for coroutine
+    jobs, so both file_transfer.write_chunks() and write_chunks_async() can
+    write to a remote client unchanged.
+
+    At most file_transfer.RELAY_QUEUE_DEPTH chunks are in flight: the
+    receiving worker returns a "credit" for every chunk its job takes, and
+    writers wait for one, so a slow recipient slows the sender down instead
+    of piling chunks up on its worker.
+    """
+
+    def __init__(self, link, stream):
+        self.link = link
+        self.stream = stream
+        self._in_flight = 0
+        self._closed = False
+        self._room = threading.Condition()
+
+    def write(self, data):
+        with self._room:
+            self._in_flight += 1
+        self.link.send("data", pack(self.stream, body=data))
+
+    async def drain(self):
+        if self._in_flight >= file_transfer.RELAY_QUEUE_DEPTH or self.link.congested:
+            await asyncio.get_running_loop().run_in_executor(None, self.wait_for_room)
+
+    def sendall(self, data):
+        self.write(data)
+        self.wait_for_room()
+
+    def wait_for_room(self):
+        """Block while the receiver holds no credit for a chunk or the link is congested."""
+        with self._room:
+            while self._in_flight >= file_transfer.RELAY_QUEUE_DEPTH and not self._closed:
+                self._room.wait()
+        self.link.wait_for_room()
+
+    def credit(self):
+        """Note that the receiving job took a chunk off its queue."""
+        with self._room:
+            self._in_flight -= 1
+            self._room.notify_all()
+
+    def close(self):
+        """Stop waiting for credits once the stream is closed or the hub is gone."""
+        with self._room:
+            self._closed = True
+            self._room.notify_all()
+
+    def end(self):
+        """Tell the receiving worker that the stream is complete."""
+        self.link.send("end", pack(self.stream))
+
+
+class CreditQueue(queue.Queue):
+    """Chunk queue of an incoming stream that credits the sender for every chunk taken.
+
+    It holds the RELAY_QUEUE_DEPTH chunks a StreamWriter may have in flight
+    and the None that ends the stream.
+    """
+
+    def __init__(self, link, stream):
+        super().__init__(file_transfer.RELAY_QUEUE_DEPTH + 1)
+        self.link = link
+        self.stream = stream
+
+    def get(self, block=True, timeout=None):
+        chunk = super().get(block, timeout)
+        if chunk is not None:
+            self.link.send("credit", pack(self.stream))
+        return chunk
+
+
+class LocalSessions:
+    """The sessions a ClusterRegistry holds in this process and nothing else.
+
+    Console commands are sent to every worker, so each one must only reach
+    the worker's own clients: broadcasts through this view are not
+    published to the other workers.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def broadcast(self, frame, exclude=None):
+        session_registry.SessionRegistry.broadcast(self.registry, frame, exclude)
+
+    def get(self, username):
+        return session_registry.SessionRegistry.get(self.registry, username)
+
+    def __getattr__(self, name):
+        return getattr(self.registry, name)
+
+
+class ClusterRegistry(session_registry.SessionRegistry):
+    """Session registry of one worker process in a cluster.
+
+    Sessions of this worker are kept by the base class. Usernames are
+    claimed at the hub when they are added, and the worker keeps a replica
+    of the hub's directory, so get() can return a RemoteSession for a user
+    on another worker without a round trip. broadcast() also publishes the
+    frame to the other workers, which queue it for their own clients.
+    """
+
+    def __init__(self, sock, index, console=None, on_stop=None):
+        """Connect to the hub.
+
+        Input Arguments:
+        - sock (socket): The worker end of the socket pair to the hub.
+        - index (int): The index of this worker.
+        - console (callable): Runs a console command sent by the hub.
+        - on_stop (callable): Called when the hub says stop or goes away.
+        """
+        super().__init__()
+        self.index = index
+        self.console = console
+        self.on_stop = on_stop
+        self.local = LocalSessions(self)
+        # username -> (worker index, codec) of users on other workers
+        self._remote = {}
+        self._claims = {}
+        # stream id -> chunk queue of incoming streams
+        self._incoming = {}
+        # stream id -> Future of outgoing streams, resolved by "closed"
+        self._outgoing = {}
+        # stream id -> StreamWriter of outgoing streams, credited by "credit"
+        self._writers = {}
+        self._ids = itertools.count()
+        # Console commands may block, e.g. on a file transfer, so they run
+        # on their own thread rather than on the link's receiver.
+        self._console_queue = queue.Queue()
+        threading.Thread(target=self._console_loop, name="cluster-console", daemon=True).start()
+        self.link = Link(sock, self._dispatch, f"worker-{index}", self._hub_gone)
+        self.link.start()
+
+    def add(self, session):
+        # Added locally first, so nothing routed here after the claim is
+        # lost; taken out again if another worker has the name.
+        if not super().add(session):
+            return False
+        request = f"{self.index}-{next(self._ids)}"
+        claimed = self._claims[request] = Future()
+        self.link.send("claim", pack(request, session.username, session.codec.hello()))
+        try:
+            accepted = claimed.result(CLAIM_TIMEOUT)
+        except Exception:
+            self._claims.pop(request, None)
+            accepted = False
+        if not accepted:
+            super().remove(session)
+        return accepted
+
+    def remove(self, session):
+        if not super().remove(session):
+            return False
+        self.link.send("release", pack(session.username))
+        return True
+
+    def get(self, username):
+        session = super().get(username)
+        if session is not None:
+            return session
+        remote = self._remote.get(username)
+        if remote is None:
+            return None
+        return RemoteSession(username, self, *remote)
+
+    def broadcast(self, frame, exclude=None):
+        super().broadcast(frame, exclude)
+        self.link.send("broadcast", frame)
+
+    def publish(self, room, frame, exclude=None, record=False):
+        # Every worker gets room messages so that each can replay the
+        # room's history to the members that join it there; it only
+        # queues them for its own members.
+        super().publish(room, frame, exclude, record)
+        self.link.send("room", pack(room, "1" if record else "0", body=frame))
+
+    def open_stream(self, username):
+        """Start a stream of raw bytes to a user on another worker.
+
+        Input Arguments:
+        - username (str): The remote recipient.
+
+        Output Arguments:
+        - tuple: The StreamWriter to write to, and a Future that resolves
+          to the bytes the owner wrote to the client once the stream has
+          ended, or fails with ConnectionError if it could not.
+        """
+        stream = f"{self.index}-{next(self._ids)}"
+        delivered = self._outgoing[stream] = Future()
+        writer = self._writers[stream] = StreamWriter(self.link, stream)
+        self.link.send("open", pack(stream, username))
+        return writer, delivered
+
+    def _dispatch(self, kind, payload):
+        """Act on a frame received from the hub."""
+        if kind == "broadcast":
+            super().broadcast(framing.Frame(payload))
+
+        elif kind == "room":
+            room, record, frame = unpack(payload, 2)
+            super().publish(room, framing.Frame(frame), record=record == "1")
+
+        elif kind == "deliver":
+            username, frame = unpack(payload, 1)
+            session = super().get(username)
+            if session is not None:
+                session.sendall(framing.Frame(frame))
+
+        elif kind == "data":
+            stream, data = unpack(payload, 1)
+            chunks = self._incoming.get(stream)
+            if chunks is not None:
+                # The sender waits for credits, so this never blocks the link.
+                chunks.put_nowait(data)
+
+        elif kind == "open":
+            stream, username, _ = unpack(payload, 2)
+            self._open_incoming(stream, username)
+
+        elif kind == "end":
+            stream, _ = unpack(payload, 1)
+            chunks = self._incoming.pop(stream, None)
+            if chunks is not None:
+                chunks.put_nowait(None)
+
+        elif kind == "credit":
+            stream, _ = unpack(payload, 1)
+            writer = self._writers.get(stream)
+            if writer is not None:
+                writer.credit()
+
+        elif kind == "closed":
+            stream, written, _ = unpack(payload, 2)
+            writer = self._writers.pop(stream, None)
+            if writer is not None:
+                writer.close()
+            delivered = self._outgoing.pop(stream, None)
+            if delivered is None:
+                return
+            if int(written) < 0:
+                delivered.set_exception(ConnectionError(f"stream {stream} was not delivered"))
+            else:
+                delivered.set_result(int(written))
+
+        elif kind == "joined":
+            username, worker, hello, _ = unpack(payload, 3)
+            self._remote[username] = (int(worker), framing.Codec.from_hello(hello))
+
+        elif kind == "left":
+            username, _ = unpack(payload, 1)
+            self._remote.pop(username, None)
+
+        elif kind == "claimed":
+            request, accepted, _ = unpack(payload, 2)
+            claimed = self._claims.pop(request, None)
+            if claimed is not None:
+                claimed.set_result(accepted == "1")
+
+        elif kind == "console":
+            self._console_queue.put(str(payload, "utf-8"))
+
+        elif kind == "stop":
+            if self.on_stop is not None:
+                self.on_stop()
+
+    def _open_incoming(self, stream, username):
+        """Run a job on a local session that writes an incoming stream to it."""
+        session = super().get(username)
+        if session is None:
+            self.link.send("closed", pack(stream, "-1"))
+            return
+
+        chunks = self._incoming[stream] = CreditQueue(self.link, stream)
+
+        def finished(future):
+            written = -1 if future.exception() is not None else future.result()
+            self.link.send("closed", pack(stream, str(written)))
+
+        session.run(functools.partial(file_transfer.write_chunks, chunks)).add_done_callback(finished)
+
+    def _console_loop(self):
+        while True:
+            message = self._console_queue.get()
+            try:
+                self.console(message)
+            except Exception as error:
+                logger.warning("Error: %s", error)
+
+    def _hub_gone(self):
+        """Fail what waits on the hub and stop the worker."""
+        for writer in list(self._writers.values()):
+            writer.close()
+        for pending in list(self._claims.values()) + list(self._outgoing.values()):
+            if not pending.done():
+                pending.set_exception(ConnectionError("the cluster hub went away"))
+        if self.on_stop is not None:
+            self.on_stop()
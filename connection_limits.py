@@ -0,0 +1,164 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import metrics
+
+# Connections served at once, and at once from one IP address; 0 for no
+# limit. Connections over a limit are refused as soon as they are
+# accepted. server.py overrides them from --max-connections and
+# --max-connections-per-ip; with --workers they apply to each worker.
+MAX_CONNECTIONS = 10000
+MAX_CONNECTIONS_PER_IP = 0
+
+# Seconds a new connection has to log in. server.py overrides it from
+# --auth-timeout; 0 waits forever.
+AUTH_TIMEOUT = 60
+
+# Seconds a session may send nothing before it is disconnected. Clients
+# send cmd:ping every client_utils.HEARTBEAT_INTERVAL seconds while idle.
+# server.py overrides it from --idle-timeout; 0 never disconnects.
+IDLE_TIMEOUT = 600
+
+REFUSED = "Server: Too many connections, try again later.\n"
+
+logger = logging.getLogger("chat")
+
+
+class ConnectionLimiter:
+    """Counts open connections, in total and by IP address, against the limits."""
+
+    def __init__(self, max_connections=None, max_per_ip=None):
+        """Initialize the counts.
+
+        Input Arguments:
+        - max_connections (int): The total limit, MAX_CONNECTIONS by default.
+        - max_per_ip (int): The limit per IP, MAX_CONNECTIONS_PER_IP by default.
+        """
+        self.max_connections = MAX_CONNECTIONS if max_connections is None else max_connections
+        self.max_per_ip = MAX_CONNECTIONS_PER_IP if max_per_ip is None else max_per_ip
+        self.connections = 0
+        self.refused = 0
+        self._by_ip = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, address):
+        """Count a new connection unless it would exceed a limit.
+
+        Input Arguments:
+        - address (tuple): The client address.
+
+        Output Arguments:
+        - bool: False if the connection must be refused; it is then not
+          counted and must not be released.
+        """
+        ip = address[0]
+        with self._lock:
+            if self.max_connections and self.connections >= self.max_connections:
+                limit = "total"
+            elif self.max_per_ip and self._by_ip.get(ip, 0) >= self.max_per_ip:
+                limit = "per_ip"
+            else:
+                self.connections += 1
+                self._by_ip[ip] = self._by_ip.get(ip, 0) + 1
+                return True
+            self.refused += 1
+        metrics.CONNECTIONS_REJECTED.inc(limit)
+        logger.info("Refused a connection from %s: %s connection limit reached.", ip, limit.replace("_", " "))
+        return False
+
+    def release(self, address):
+        """Stop counting a connection that acquire() accepted."""
+        ip = address[0]
+        with self._lock:
+            self.connections -= 1
+            if self._by_ip[ip] == 1:
+                del self._by_ip[ip]
+            else:
+                self._by_ip[ip] -= 1
+
+    def stats(self):
+        """Return the open connections, the IP addresses they come from and the connections refused so far."""
+        with self._lock:
+            return self.connections, len(self._by_ip), self.refused
+
+
+class IdleReaper:
+    """Disconnects sessions that have sent nothing for IDLE_TIMEOUT seconds.
+
+    Every watched session has one entry in a heap, ordered by when it
+    would expire if it stayed silent. Receiving a frame only stamps the
+    session (Session.last_active), so the message path never touches the
+    heap. When an entry comes due, the reaper either finds the session was
+    active since and pushes it back with its new deadline, or disconnects
+    it; each check costs O(log n) for the entry that came due, never a
+    scan of every session. The handler of a disconnected session cleans
+    up as it does for a dropped connection.
+    """
+
+    def __init__(self, timeout=None):
+        """Start the reaper thread, unless the timeout is 0.
+
+        Input Arguments:
+        - timeout (float): Seconds of silence allowed, IDLE_TIMEOUT by default.
+        """
+        self.timeout = IDLE_TIMEOUT if timeout is None else timeout
+        self.reaped = 0
+        self._heap = []
+        self._ids = itertools.count()
+        self._closed = False
+        self._ready = threading.Condition()
+        if self.timeout > 0:
+            threading.Thread(target=self._run, name="idle-reaper", daemon=True).start()
+
+    def watch(self, session):
+        """Start watching a session that has just been registered."""
+        if self.timeout > 0:
+            self._push(session, session.last_active + self.timeout)
+
+    def _push(self, session, deadline):
+        with self._ready:
+            heapq.heappush(self._heap, (deadline, next(self._ids), session))
+            if self._heap[0][2] is session:
+                self._ready.notify()
+
+    def _run(self):
+        """Check sessions as their entries come due until close()."""
+        while True:
+            with self._ready:
+                while not self._closed and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    self._ready.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                if self._closed:
+                    return
+                _, _, session = heapq.heappop(self._heap)
+            self._check(session)
+
+    def _check(self, session):
+        """Disconnect a session that has been silent too long, or watch it again."""
+        if session.closing:
+            # It has gone already; the entry is simply dropped.
+            return
+        now = time.monotonic()
+        if session.busy:
+            # A file still being received or sent counts as activity.
+            self._push(session, now + self.timeout)
+            return
+        deadline = session.last_active + self.timeout
+        if deadline > now:
+            self._push(session, deadline)
+            return
+        self.reaped += 1
+        metrics.SESSIONS_REAPED.inc("idle")
+        logger.info("Client %s disconnected after %s seconds without activity.", session.username, self.timeout)
+        session.disconnect()
+
+    def close(self):
+        """Stop the reaper thread."""
+        with self._ready:
+            self._closed = True
+            self._ready.notify()
+
+    def __len__(self):
+        return len(self._heap)
@@ -0,0 +1,198 @@
+import collections
+import itertools
+import threading
+import time
+
+# Finished fan-outs kept for the transfers console command.
+FINISHED_LIMIT = 16
+
+GROUP_USAGE = "Server: Use group:NAME:USER,USER... to define a group, group:NAME to show it, ungroup:NAME or groups"
+
+
+class Groups:
+    """Named lists of usernames that a file can be sent to as @NAME."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._groups = {}
+
+    def set(self, name, members):
+        """Define or redefine a group; duplicate members are dropped."""
+        with self._lock:
+            self._groups[name] = list(dict.fromkeys(members))
+
+    def remove(self, name):
+        """Forget a group; return False if there was none."""
+        with self._lock:
+            return self._groups.pop(name, None) is not None
+
+    def get(self, name):
+        """Return the members of a group, or None."""
+        with self._lock:
+            return self._groups.get(name)
+
+    def items(self):
+        """Return (name, members) of every group, sorted by name."""
+        with self._lock:
+            return sorted(self._groups.items())
+
+    def expand(self, field):
+        """Turn a recipient field into usernames.
+
+        Input Arguments:
+        - field (str): Comma separated usernames and @GROUP names, e.g.
+          "alice,@tutors".
+
+        Output Arguments:
+        - list: The usernames in order, each once. Raises KeyError for an
+          unknown group.
+        """
+        usernames = []
+        for name in filter(None, field.split(",")):
+            if name.startswith("@"):
+                members = self.get(name[1:])
+                if members is None:
+                    raise KeyError(name[1:])
+                usernames.extend(members)
+            else:
+                usernames.append(name)
+        return list(dict.fromkeys(usernames))
+
+
+def group_command(message, groups):
+    """Run a group console command and return what to print.
+
+    Input Arguments:
+    - message (str): "group:NAME:USER,USER...", "group:NAME", "ungroup:NAME" or "groups".
+    - groups (Groups): The groups of the server.
+
+    Output Arguments:
+    - str: The lines to print, without a trailing newline.
+    """
+    if message == "groups":
+        return "\n".join(f"@{name}: {','.join(members)}" for name, members in groups.items()) or "Server: No groups."
+    command, _, arguments = message.partition(":")
+    name, _, members = arguments.partition(":")
+    if not name or "," in name or name.startswith("@"):
+        return GROUP_USAGE
+    if command == "ungroup" and not members:
+        return f"Server: Group @{name} removed." if groups.remove(name) else f"Server: No group @{name}."
+    if command == "group" and not members:
+        members = groups.get(name)
+        return f"@{name}: {','.join(members)}" if members is not None else f"Server: No group @{name}."
+    if command == "group":
+        groups.set(name, filter(None, members.split(",")))
+        return f"Server: Group @{name} has {len(groups.get(name))} members."
+    return GROUP_USAGE
+
+
+class Progress:
+    """How far a file has got to one recipient of a fan-out."""
+
+    def __init__(self, username):
+        self.username = username
+        self.sent = 0
+        self.state = "queued"
+        self.error = None
+
+    def add(self, count):
+        """Count bytes written to the recipient; called by the transfer."""
+        self.state = "sending"
+        self.sent += count
+
+
+class Fanout:
+    """One file sent to several clients at once, with the progress of each."""
+
+    def __init__(self, fanout_id, filename, size, usernames):
+        """Start tracking a fan-out.
+
+        Input Arguments:
+        - fanout_id (int): The id shown by the transfers command.
+        - filename (str): The name of the file.
+        - size (int): The size of the file in bytes.
+        - usernames (list): The recipients.
+        """
+        self.id = fanout_id
+        self.filename = filename
+        self.size = size
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.recipients = {username: Progress(username) for username in usernames}
+        self._pending = len(self.recipients)
+        self._lock = threading.Lock()
+
+    def finish(self, username, error=None):
+        """Record the end of one recipient's transfer.
+
+        Output Arguments:
+        - bool: True for the last recipient to finish.
+        """
+        progress = self.recipients[username]
+        progress.state = "failed" if error is not None else "done"
+        progress.error = error
+        with self._lock:
+            self._pending -= 1
+            if self._pending:
+                return False
+            self.finished_at = time.monotonic()
+            return True
+
+    def counts(self):
+        """Return how many recipients are in each state."""
+        return collections.Counter(progress.state for progress in self.recipients.values())
+
+    def elapsed(self):
+        """Return the seconds since the fan-out started, until it finished."""
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def summary(self):
+        """Return one line about the whole fan-out."""
+        counts = self.counts()
+        total = self.size * len(self.recipients)
+        sent = sum(min(progress.sent, self.size) for progress in self.recipients.values())
+        percent = 100 * sent / total if total else 100.0
+        return (f"Transfer {self.id}: '{self.filename}' ({self.size} bytes) to {len(self.recipients)} clients, "
+                f"{counts['done']} done, {counts['failed']} failed, {counts['sending'] + counts['queued']} in progress, "
+                f"{percent:.1f}% sent in {self.elapsed():.1f} s")
+
+    def format(self):
+        """Return the summary and one line per recipient."""
+        lines = [self.summary()]
+        for progress in self.recipients.values():
+            percent = 100 * min(progress.sent, self.size) / self.size if self.size else 100.0
+            line = f"  {progress.username}: {progress.state}, {percent:.1f}%"
+            if progress.error is not None:
+                line += f" ({progress.error})"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+class Fanouts:
+    """The fan-outs of a server, running and recently finished."""
+
+    def __init__(self, finished_limit=FINISHED_LIMIT):
+        self.finished_limit = finished_limit
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._fanouts = collections.OrderedDict()
+
+    def start(self, filename, size, usernames):
+        """Start tracking a fan-out and return its Fanout."""
+        with self._lock:
+            fanout = Fanout(next(self._ids), filename, size, usernames)
+            self._fanouts[fanout.id] = fanout
+            finished = [key for key, old in self._fanouts.items() if old.finished_at is not None]
+            for key in finished[:max(0, len(finished) - self.finished_limit)]:
+                del self._fanouts[key]
+        return fanout
+
+    def get(self, fanout_id):
+        """Return a fan-out by id, or None."""
+        with self._lock:
+            return self._fanouts.get(fanout_id)
+
+    def fanouts(self):
+        """Return every fan-out kept, oldest first."""
+        with self._lock:
+            return list(self._fanouts.values())
@@ -0,0 +1,628 @@
+import asyncio
+import collections
+import hashlib
+import hmac
+import os
+import queue
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import framing
+
+# A file body is an 8 byte big-endian size followed by exactly that many raw
+# bytes, so the receiver never has to scan the data for an end marker.
+FILE_SIZE = struct.Struct("!Q")
+
+# Receive chunk size in bytes. server.py overrides it from --chunk-size.
+CHUNK_SIZE = 1024 * 1024
+
+# Chunks a relay may hold in memory per consumer before the sender is paused.
+RELAY_QUEUE_DEPTH = 8
+
+# Whether relayed files are also stored under <sender>/<filename> on the
+# server. server.py turns it off with --no-relay-archive.
+RELAY_ARCHIVE = True
+
+# A resumable body is the size of the part still to send, that part, and
+# the BLAKE2b digest of the whole file. Both sides hash the part they
+# already have from disk and the rest while it streams, so every byte is
+# read once.
+DIGEST_SIZE = 32
+
+# Partial uploads are kept under <username>/PARTIAL_DIRECTORY/<transfer id>
+# until they are complete; the client keeps partial downloads as
+# <filename>.<transfer id>.PARTIAL_SUFFIX.
+PARTIAL_DIRECTORY = ".partial"
+PARTIAL_SUFFIX = "part"
+
+# Seconds a partial upload may go without new data before the server
+# removes it, 0 to keep them forever. server.py overrides it from
+# --partial-max-age.
+PARTIAL_MAX_AGE = 7 * 24 * 60 * 60
+
+# Server files pushed to clients that may be asked for again by transfer id.
+OUTGOING_LIMIT = 1024
+
+
+class IntegrityError(ValueError):
+    """A received file whose digest does not match the sender's."""
+
+
+def new_hash():
+    """Return the incremental hash used for file digests."""
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def transfer_id(path):
+    """Return the transfer id of a file.
+
+    The id only depends on the path, size and modification time, so the
+    same file gets the same id after a reconnect and a changed file a new
+    one.
+
+    Input Arguments:
+    - path (str): The file.
+
+    Output Arguments:
+    - str: 16 hex digits.
+    """
+    status = os.stat(path)
+    key = f"{os.path.abspath(path)}:{status.st_size}:{status.st_mtime_ns}"
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+
+class OutgoingTransfers:
+    """The files last pushed to clients, by transfer id, so that a client can resume one."""
+
+    def __init__(self, limit=OUTGOING_LIMIT):
+        self.limit = limit
+        self._paths = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, path):
+        """Remember a file and return its transfer id."""
+        identifier = transfer_id(path)
+        with self._lock:
+            self._paths[identifier] = path
+            self._paths.move_to_end(identifier)
+            while len(self._paths) > self.limit:
+                self._paths.popitem(last=False)
+        return identifier
+
+    def get(self, identifier):
+        """Return the path of a transfer id, or None if it is unknown or the file has changed."""
+        with self._lock:
+            path = self._paths.get(identifier)
+        try:
+            if path is not None and transfer_id(path) == identifier:
+                return path
+        except OSError:
+            pass
+        return None
+
+
+OUTGOING = OutgoingTransfers()
+
+
+def hash_prefix(file, offset, hasher, chunk_size=None):
+    """Feed the first offset bytes of an open file to hasher and leave the file at offset."""
+    file.seek(0)
+    remaining = offset
+    while remaining:
+        data = file.read(min(chunk_size or CHUNK_SIZE, remaining))
+        if not data:
+            raise ValueError("file is shorter than the offset")
+        hasher.update(data)
+        remaining -= len(data)
+
+
+def file_size(file):
+    """Return the size of an open file in bytes."""
+    return os.fstat(file.fileno()).st_size
+
+
+def send_file_body(sock, file):
+    """Send an open file as a size-prefixed body.
+
+    socket.sendfile() uses the kernel sendfile() call where available, so the
+    file contents go from the page cache to the socket without being copied
+    through Python.
+
+    Input Arguments:
+    - sock (socket): The socket to send on.
+    - file (file object): The file to send, opened in binary mode.
+
+    Output Arguments:
+    - int: The number of file bytes sent.
+    """
+    size = file_size(file)
+    sock.sendall(FILE_SIZE.pack(size))
+    if size:
+        sock.sendfile(file, 0, size)
+    return size
+
+
+def receive_file_body(sock, file, chunk_size=None, throttle=None):
+    """Receive a size-prefixed body into an open file.
+
+    Data is read with recv_into() into one preallocated buffer that is reused
+    for every chunk. Bytes already buffered by the socket's FrameReader are
+    consumed first.
+
+    Input Arguments:
+    - sock (socket): The socket to receive from.
+    - file (file object): The file to write to, opened in binary mode.
+    - chunk_size (int): The receive chunk size, CHUNK_SIZE by default.
+    - throttle (callable): Called with the size of every chunk received;
+      returns the seconds to pause reading, see rate_limits.UserLimits.
+
+    Output Arguments:
+    - int: The number of file bytes received.
+    """
+    reader = framing.reader_for(sock)
+    size = FILE_SIZE.unpack(reader.read_exact(FILE_SIZE.size))[0]
+    chunk_size = chunk_size or CHUNK_SIZE
+
+    buffer = bytearray(max(1, min(chunk_size, size)))
+    view = memoryview(buffer)
+    remaining = size
+
+    while remaining:
+        received = reader.readinto(view[:min(len(buffer), remaining)])
+        if not received:
+            raise ConnectionError("connection closed during file transfer")
+        file.write(view[:received])
+        remaining -= received
+        if throttle is not None:
+            time.sleep(throttle(received))
+
+    return size
+
+
+def send_resumable_body(sock, file, offset=0, chunk_size=None):
+    """Send an open file from offset as a resumable body.
+
+    Input Arguments:
+    - sock (socket): The socket to send on.
+    - file (file object): The file to send, opened in binary mode.
+    - offset (int): The number of bytes the receiver already has.
+    - chunk_size (int): The read chunk size, CHUNK_SIZE by default.
+
+    Output Arguments:
+    - int: The number of bytes sent, digest included.
+    """
+    size = file_size(file)
+    offset = min(offset, size)
+    hasher = new_hash()
+    hash_prefix(file, offset, hasher, chunk_size)
+    sock.sendall(FILE_SIZE.pack(size - offset))
+
+    # Every chunk is a new bytes object: an asyncio transport may keep a
+    # reference to what it has not sent yet.
+    chunk_size = chunk_size or CHUNK_SIZE
+    remaining = size - offset
+    while remaining:
+        data = file.read(min(chunk_size, remaining))
+        if not data:
+            raise ValueError("file shrank while it was being sent")
+        hasher.update(data)
+        sock.sendall(data)
+        remaining -= len(data)
+
+    sock.sendall(hasher.digest())
+    return size - offset + DIGEST_SIZE
+
+
+def send_mapped_body(sock, data, offset=0, digest=None, chunk_size=None, progress=None, throttle=None):
+    """Send a file that is already in memory, such as a mapped blob.
+
+    Without a digest this is the body send_file_body() sends; with one it
+    is the resumable body send_resumable_body() sends, without hashing the
+    file again. The data is sent in slices, so nothing is copied and many
+    sockets can send the same data at once.
+
+    Input Arguments:
+    - sock (socket): The socket to send on.
+    - data (memoryview): The whole file.
+    - offset (int): The number of bytes the receiver already has.
+    - digest (bytes): The digest of the whole file for a resumable body.
+    - chunk_size (int): The slice size, CHUNK_SIZE by default.
+    - progress (callable): Called with the size of every slice once it is sent.
+    - throttle (callable): Called with the size of every slice before it
+      is sent; returns the seconds to wait, see rate_limits.UserLimits.
+
+    Output Arguments:
+    - int: The number of bytes sent, digest included.
+    """
+    offset = min(offset, len(data))
+    sock.sendall(FILE_SIZE.pack(len(data) - offset))
+    chunk_size = chunk_size or CHUNK_SIZE
+    for start in range(offset, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        if throttle is not None:
+            time.sleep(throttle(len(chunk)))
+        sock.sendall(chunk)
+        if progress is not None:
+            progress(len(chunk))
+    if digest is None:
+        return len(data) - offset
+    sock.sendall(digest)
+    return len(data) - offset + len(digest)
+
+
+def receive_resumable_body(sock, file, offset=0, chunk_size=None, throttle=None):
+    """Receive a resumable body into an open file that holds the first offset bytes.
+
+    The file is cut to offset first, so it must be opened for reading and
+    writing ("r+b" or "w+b"). Bytes are written as they arrive, which lets
+    an interrupted transfer resume from the size of the file.
+
+    Input Arguments:
+    - sock (socket): The socket to receive from.
+    - file (file object): The file to write to.
+    - offset (int): The number of bytes the file already holds.
+    - chunk_size (int): The receive chunk size, CHUNK_SIZE by default.
+    - throttle (callable): Called with the size of every chunk received;
+      returns the seconds to pause reading, see rate_limits.UserLimits.
+
+    Output Arguments:
+    - tuple: The number of bytes received, digest included, and the hex
+      digest of the file. Raises IntegrityError if the whole file does not
+      match the sender's digest.
+    """
+    reader = framing.reader_for(sock)
+    file.truncate(offset)
+    hasher = new_hash()
+    hash_prefix(file, offset, hasher, chunk_size)
+    size = FILE_SIZE.unpack(reader.read_exact(FILE_SIZE.size))[0]
+
+    buffer = bytearray(max(1, min(chunk_size or CHUNK_SIZE, size)))
+    view = memoryview(buffer)
+    remaining = size
+    while remaining:
+        received = reader.readinto(view[:min(len(buffer), remaining)])
+        if not received:
+            raise ConnectionError("connection closed during file transfer")
+        hasher.update(view[:received])
+        file.write(view[:received])
+        remaining -= received
+        if throttle is not None:
+            time.sleep(throttle(received))
+
+    digest = reader.read_exact(DIGEST_SIZE)
+    file.flush()
+    if not hmac.compare_digest(digest, hasher.digest()):
+        raise IntegrityError("the file does not match the sender's digest")
+    return size + DIGEST_SIZE, hasher.hexdigest()
+
+
+def write_chunks(chunks, sock):
+    """Write chunks from a queue to a socket until the None sentinel.
+
+    After the first failure the remaining chunks are still taken off the
+    queue so the producer never blocks on a dead consumer; the failure is
+    raised once the sentinel arrives.
+
+    Input Arguments:
+    - chunks (queue.Queue): The chunk queue.
+    - sock (socket): The socket to write to.
+
+    Output Arguments:
+    - int: The number of bytes written.
+    """
+    written = 0
+    error = None
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        if error is None:
+            try:
+                sock.sendall(chunk)
+                written += len(chunk)
+            except OSError as exception:
+                error = exception
+    if error is not None:
+        raise error
+    return written
+
+
+def _archive_chunks(chunks, file, errors):
+    """Write chunks from a queue to a file until the None sentinel."""
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            return
+        if not errors:
+            try:
+                file.write(chunk)
+            except OSError as error:
+                errors.append(error)
+
+
+def relay_file_body(sender_sock, recipient_chunks=None, archive=None, chunk_size=None, throttle=None):
+    """Stream a size-prefixed body from a socket into a chunk queue.
+
+    Chunks are passed on as soon as they arrive, so the recipient sees the
+    first byte while the upload is still running. The queues are bounded:
+    a slow recipient pauses reading from the sender instead of growing
+    memory. When an archive is given a second bounded queue feeds a
+    thread that stores the file in parallel.
+
+    Input Arguments:
+    - sender_sock (socket): The socket the body is read from.
+    - recipient_chunks (queue.Queue): Receives the size prefix, the chunks
+      and a final None; whoever drains it (see write_chunks) writes the
+      body to the recipient. None only archives (or discards) the body.
+    - archive (file object): Where to store a copy of the file, e.g. a
+      blob_store.BlobWriter, or None. The caller closes it.
+    - chunk_size (int): The receive chunk size, CHUNK_SIZE by default.
+    - throttle (callable): Called with the size of every chunk received;
+      returns the seconds to pause reading, see rate_limits.UserLimits.
+
+    Output Arguments:
+    - int: The number of file bytes relayed.
+    """
+    reader = framing.reader_for(sender_sock)
+    size = FILE_SIZE.unpack(reader.read_exact(FILE_SIZE.size))[0]
+    chunk_size = chunk_size or CHUNK_SIZE
+
+    queues = []
+    if recipient_chunks is not None:
+        recipient_chunks.put(FILE_SIZE.pack(size))
+        queues.append(recipient_chunks)
+
+    archive_errors = []
+    if archive is not None:
+        archive_queue = queue.Queue(RELAY_QUEUE_DEPTH)
+        archive_thread = threading.Thread(target=_archive_chunks, args=(archive_queue, archive, archive_errors))
+        archive_thread.start()
+        queues.append(archive_queue)
+
+    remaining = size
+    try:
+        while remaining:
+            data = reader.recv(min(chunk_size, remaining))
+            if not data:
+                raise ConnectionError("connection closed during file transfer")
+            for chunks in queues:
+                chunks.put(data)
+            remaining -= len(data)
+            if throttle is not None:
+                time.sleep(throttle(len(data)))
+    finally:
+        for chunks in queues:
+            chunks.put(None)
+        if archive is not None:
+            archive_thread.join()
+
+    if archive_errors:
+        raise archive_errors[0]
+    return size
+
+
+async def write_chunks_async(chunks, writer):
+    """Write chunks from an asyncio queue to a stream until the None sentinel.
+
+    Like write_chunks(), keeps draining the queue after a failure and raises
+    the failure at the end.
+
+    Input Arguments:
+    - chunks (asyncio.Queue): The chunk queue.
+    - writer (asyncio.StreamWriter): The stream to write to.
+
+    Output Arguments:
+    - int: The number of bytes written.
+    """
+    written = 0
+    error = None
+    while True:
+        chunk = await chunks.get()
+        if chunk is None:
+            break
+        if error is None:
+            try:
+                writer.write(chunk)
+                await writer.drain()
+                written += len(chunk)
+            except OSError as exception:
+                error = exception
+    if error is not None:
+        raise error
+    return written
+
+
+async def relay_file_body_async(reader, recipient_chunks=None, archive=None, chunk_size=None, throttle=None):
+    """Stream a size-prefixed body from an asyncio stream into a chunk queue.
+
+    The asyncio counterpart of relay_file_body(). Archive writes run on a
+    single worker thread so they stay in order, with at most
+    RELAY_QUEUE_DEPTH of them in flight; after the first failed write the
+    rest of the body is still relayed and the failure is raised at the end.
+
+    Input Arguments:
+    - reader (asyncio.StreamReader): The sender stream.
+    - recipient_chunks (asyncio.Queue): Receives the size prefix, the
+      chunks and a final None (see write_chunks_async), or None.
+    - archive (file object): Where to store a copy of the file, or None.
+      The caller closes it.
+    - chunk_size (int): The receive chunk size, CHUNK_SIZE by default.
+    - throttle (callable): Called with the size of every chunk received;
+      returns the seconds to pause reading, see rate_limits.UserLimits.
+
+    Output Arguments:
+    - int: The number of file bytes relayed.
+    """
+    size = FILE_SIZE.unpack(await reader.readexactly(FILE_SIZE.size))[0]
+    chunk_size = chunk_size or CHUNK_SIZE
+    loop = asyncio.get_running_loop()
+    if recipient_chunks is not None:
+        await recipient_chunks.put(FILE_SIZE.pack(size))
+
+    archive_executor = ThreadPoolExecutor(max_workers=1) if archive is not None else None
+    archive_writes = collections.deque()
+    archive_errors = []
+    remaining = size
+    try:
+        while remaining:
+            data = await reader.read(min(chunk_size, remaining))
+            if not data:
+                raise ConnectionError("connection closed during file transfer")
+            if archive is not None and not archive_errors:
+                if len(archive_writes) >= RELAY_QUEUE_DEPTH:
+                    try:
+                        await archive_writes.popleft()
+                    except OSError as error:
+                        archive_errors.append(error)
+                if not archive_errors:
+                    archive_writes.append(loop.run_in_executor(archive_executor, archive.write, data))
+            if recipient_chunks is not None:
+                await recipient_chunks.put(data)
+            remaining -= len(data)
+            if throttle is not None:
+                await asyncio.sleep(throttle(len(data)))
+    finally:
+        if recipient_chunks is not None:
+            await recipient_chunks.put(None)
+        if archive is not None:
+            for result in await asyncio.gather(*archive_writes, return_exceptions=True):
+                if isinstance(result, BaseException):
+                    archive_errors.append(result)
+            archive_executor.shutdown()
+
+    if archive_errors:
+        raise archive_errors[0]
+    return size
+
+
+async def send_file_body_async(writer, file):
+    """Send an open file as a size-prefixed body on an asyncio stream.
+
+    Input Arguments:
+    - writer (asyncio.StreamWriter): The stream to send on.
+    - file (file object): The file to send, opened in binary mode.
+
+    Output Arguments:
+    - int: The number of file bytes sent.
+    """
+    size = file_size(file)
+    writer.write(FILE_SIZE.pack(size))
+    await writer.drain()
+    if size:
+        await asyncio.get_running_loop().sendfile(writer.transport, file, 0, size)
+    return size
+
+
+async def send_mapped_body_async(writer, data, offset=0, digest=None, chunk_size=None, progress=None, throttle=None):
+    """Send a file that is already in memory on an asyncio stream, see send_mapped_body().
+
+    Input Arguments:
+    - writer (asyncio.StreamWriter): The stream to send on.
+    - data (memoryview): The whole file.
+    - offset (int): The number of bytes the receiver already has.
+    - digest (bytes): The digest of the whole file for a resumable body.
+    - chunk_size (int): The slice size, CHUNK_SIZE by default.
+    - progress (callable): Called with the size of every slice once it is sent.
+    - throttle (callable): Called with the size of every slice before it
+      is sent; returns the seconds to wait, see rate_limits.UserLimits.
+
+    Output Arguments:
+    - int: The number of bytes sent, digest included.
+    """
+    offset = min(offset, len(data))
+    writer.write(FILE_SIZE.pack(len(data) - offset))
+    chunk_size = chunk_size or CHUNK_SIZE
+    for start in range(offset, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        if throttle is not None:
+            await asyncio.sleep(throttle(len(chunk)))
+        writer.write(chunk)
+        await writer.drain()
+        if progress is not None:
+            progress(len(chunk))
+    if digest is None:
+        return len(data) - offset
+    writer.write(digest)
+    await writer.drain()
+    return len(data) - offset + len(digest)
+
+
+async def receive_file_body_async(reader, file, chunk_size=None, throttle=None):
+    """Receive a size-prefixed body from an asyncio stream into an open file.
+
+    Input Arguments:
+    - reader (asyncio.StreamReader): The stream to receive from.
+    - file (file object): The file to write to, opened in binary mode.
+    - chunk_size (int): The receive chunk size, CHUNK_SIZE by default.
+    - throttle (callable): Called with the size of every chunk received;
+      returns the seconds to pause reading, see rate_limits.UserLimits.
+
+    Output Arguments:
+    - int: The number of file bytes received.
+    """
+    size = FILE_SIZE.unpack(await reader.readexactly(FILE_SIZE.size))[0]
+    chunk_size = chunk_size or CHUNK_SIZE
+    loop = asyncio.get_running_loop()
+    remaining = size
+
+    while remaining:
+        data = await reader.read(min(chunk_size, remaining))
+        if not data:
+            raise ConnectionError("connection closed during file transfer")
+        await loop.run_in_executor(None, file.write, data)
+        remaining -= len(data)
+        if throttle is not None:
+            await asyncio.sleep(throttle(len(data)))
+
+    return size
+
+
+def _write_and_hash(file, hasher, data):
+    """Write a chunk to a file and add it to the running digest."""
+    hasher.update(data)
+    file.write(data)
+
+
+async def receive_resumable_body_async(reader, file, offset=0, chunk_size=None, throttle=None):
+    """Receive a resumable body from an asyncio stream into an open file.
+
+    The asyncio counterpart of receive_resumable_body(); hashing and file
+    writes run on the default executor.
+
+    Input Arguments:
+    - reader (asyncio.StreamReader): The stream to receive from.
+    - file (file object): The file to write to, holding the first offset bytes.
+    - offset (int): The number of bytes the file already holds.
+    - chunk_size (int): The receive chunk size, CHUNK_SIZE by default.
+    - throttle (callable): Called with the size of every chunk received;
+      returns the seconds to pause reading, see rate_limits.UserLimits.
+
+    Output Arguments:
+    - tuple: The number of bytes received, digest included, and the hex
+      digest of the file. Raises IntegrityError if the whole file does not
+      match the sender's digest.
+    """
+    loop = asyncio.get_running_loop()
+    file.truncate(offset)
+    hasher = new_hash()
+    await loop.run_in_executor(None, hash_prefix, file, offset, hasher, chunk_size)
+    size = FILE_SIZE.unpack(await reader.readexactly(FILE_SIZE.size))[0]
+    chunk_size = chunk_size or CHUNK_SIZE
+    remaining = size
+
+    while remaining:
+        data = await reader.read(min(chunk_size, remaining))
+        if not data:
+            raise ConnectionError("connection closed during file transfer")
+        await loop.run_in_executor(None, _write_and_hash, file, hasher, data)
+        remaining -= len(data)
+        if throttle is not None:
+            await asyncio.sleep(throttle(len(data)))
+
+    digest = await reader.readexactly(DIGEST_SIZE)
+    file.flush()
+    if not hmac.compare_digest(digest, hasher.digest()):
+        raise IntegrityError("the file does not match the sender's digest")
+    return size + DIGEST_SIZE, hasher.hexdigest()
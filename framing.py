@@ -0,0 +1,433 @@
+import struct
+import threading
+import weakref
+import zlib
+
+# Frame layout: 2 byte header length, header, 4 byte payload length, payload.
+HEADER_LENGTH = struct.Struct("!H")
+PAYLOAD_LENGTH = struct.Struct("!I")
+
+# Version 2 frame layout: 1 byte opcode, 1 byte flags, varint payload length,
+# payload. Opcode 0 is followed by a varint header length and a text header,
+# for headers that have no opcode.
+OPCODES = ("", "msg", "cmd", "to", "info", "file_transfer", "quiz_answer", "quiz_question", "error", "hello", "chunk")
+OPCODE_OF = {header: opcode for opcode, header in enumerate(OPCODES) if header}
+FLAG_ZLIB = 0x01
+
+# Headers whose payloads are never compressed: chunk frames carry file
+# data, which is mostly compressed already.
+UNCOMPRESSED_HEADERS = frozenset([b"chunk"])
+
+# A client that speaks version 2 sends a "hello" frame in the version 1
+# format before anything else, e.g. "2 zlib resume mux". The server answers with
+# the version and features it accepts and both sides switch after that frame.
+# Clients that never send one keep the version 1 format.
+HELLO = "hello"
+VERSION = 2
+
+# Whether the server accepts zlib payload compression. server.py turns it
+# off with --no-compression.
+COMPRESSION = True
+
+# Payloads shorter than this are never compressed, and the level used for
+# the ones that are.
+COMPRESS_MIN = 256
+COMPRESS_LEVEL = 6
+
+# Most bytes a compressed payload may expand to.
+MAX_DECOMPRESSED = 16 * 1024 * 1024
+
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+_readers = weakref.WeakKeyDictionary()
+_readers_lock = threading.Lock()
+
+
+def encode_message(header, message):
+    """Encode a message with a header and payload length.
+
+    Input Arguments:
+    - header (str): The message header.
+    - message (str or bytes): The message payload. Bytes are sent as they are.
+
+    Output Arguments:
+    - bytes: Encoded message.
+    """
+    header = header.encode()
+    if isinstance(message, str):
+        message = message.encode()
+    return Frame(HEADER_LENGTH.pack(len(header)) + header + PAYLOAD_LENGTH.pack(len(message)) + message)
+
+
+def encode_varint(value):
+    """Encode a non-negative int as a LEB128 varint."""
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _decompress(payload):
+    """Inflate a zlib payload, refusing to expand past MAX_DECOMPRESSED."""
+    inflater = zlib.decompressobj()
+    data = inflater.decompress(payload, MAX_DECOMPRESSED)
+    if inflater.unconsumed_tail:
+        raise ValueError("compressed payload too large")
+    return data
+
+
+class Frame(bytes):
+    """A frame in the version 1 format that can re-encode itself as version 2.
+
+    Frames are encoded once and may be queued for many clients, so the
+    version 2 encodings are cached on the frame: a broadcast to version 2
+    clients is converted and compressed once, not once per client.
+    """
+
+    def v2(self, compress):
+        """Return the frame in the version 2 format.
+
+        Input Arguments:
+        - compress (bool): Compress the payload if that makes it smaller.
+
+        Output Arguments:
+        - bytes: The encoded frame.
+        """
+        attribute = "_v2_zlib" if compress else "_v2"
+        cached = self.__dict__.get(attribute)
+        if cached is not None:
+            return cached
+
+        header_length = HEADER_LENGTH.unpack_from(self)[0]
+        header = self[HEADER_LENGTH.size:HEADER_LENGTH.size + header_length]
+        payload = self[HEADER_LENGTH.size + header_length + PAYLOAD_LENGTH.size:]
+        flags = 0
+        if compress and len(payload) >= COMPRESS_MIN and header not in UNCOMPRESSED_HEADERS:
+            packed = zlib.compress(payload, COMPRESS_LEVEL)
+            if len(packed) < len(payload):
+                payload, flags = packed, FLAG_ZLIB
+
+        opcode = OPCODE_OF.get(header.decode(errors="replace"), 0)
+        prefix = bytes((opcode, flags))
+        if not opcode:
+            prefix += encode_varint(len(header)) + header
+        encoded = self.__dict__[attribute] = prefix + encode_varint(len(payload)) + payload
+        return encoded
+
+
+class Codec:
+    """The frame format agreed with one peer."""
+
+    def __init__(self, version=1, compress=False, resume=False, mux=False):
+        """Initialize the codec.
+
+        Input Arguments:
+        - version (int): 1 for the original format, 2 for opcodes and varints.
+        - compress (bool): Whether version 2 payloads may be compressed.
+        - resume (bool): Whether files are sent with transfer ids and
+          digests so that they can be resumed (see file_transfer).
+        - mux (bool): Whether files are sent as chunk frames, so that
+          several transfers share the connection with chat (see
+          mux_transfers). Needs version 2.
+        """
+        self.version = version
+        self.compress = compress
+        self.resume = resume
+        self.mux = mux
+
+    def wire(self, data):
+        """Return the bytes to put on the wire for data.
+
+        Frames are converted to the agreed format; anything else, such as a
+        file body, is returned unchanged.
+        """
+        if self.version == 1 or not isinstance(data, Frame):
+            return data
+        return data.v2(self.compress)
+
+    def hello(self):
+        """Return the hello payload describing this codec, e.g. "2 zlib resume mux"."""
+        return " ".join([str(self.version)] + ["zlib"] * self.compress + ["resume"] * self.resume + ["mux"] * self.mux)
+
+    @classmethod
+    def from_hello(cls, payload, allow_compression=True):
+        """Return the codec for a hello payload.
+
+        Input Arguments:
+        - payload (str): The hello payload received from the peer.
+        - allow_compression (bool): Whether this side accepts compression.
+
+        Output Arguments:
+        - Codec: The highest version both sides speak.
+        """
+        fields = payload.split()
+        try:
+            version = min(VERSION, int(fields[0]))
+        except (IndexError, ValueError):
+            version = 1
+        return cls(max(1, version), version >= 2 and allow_compression and "zlib" in fields[1:], "resume" in fields[1:],
+                   version >= 2 and "mux" in fields[1:])
+
+    def __repr__(self):
+        return f"Codec({self.version}, {self.compress}, {self.resume}, {self.mux})"
+
+
+# The codec of every peer that has not sent a hello.
+V1 = Codec()
+
+
+class FrameReader:
+    """Buffered reader that turns a socket byte stream into complete frames.
+
+    Data is received with recv_into() straight into a per-connection
+    bytearray, so a single syscall can deliver many frames and a frame split
+    over several TCP segments is reassembled before it is returned.
+    """
+
+    def __init__(self, sock, buffer_size=DEFAULT_BUFFER_SIZE):
+        """Initialize the reader.
+
+        Input Arguments:
+        - sock (socket): The socket to read from.
+        - buffer_size (int): Initial size of the receive buffer.
+        """
+        self.sock = sock
+        # Frame format version, raised to 2 once negotiated.
+        self.version = 1
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        # Total bytes handed out by this reader, frames and raw data alike.
+        self.consumed = 0
+
+    @property
+    def buffered(self):
+        """Number of received bytes that have not been consumed yet."""
+        return self._end - self._start
+
+    def _fill(self, needed):
+        """Receive until at least needed bytes are buffered.
+
+        Input Arguments:
+        - needed (int): The number of unconsumed bytes required.
+
+        Output Arguments:
+        - None
+        """
+        while self._end - self._start < needed:
+            if self._start + needed > len(self._buffer):
+                # Move the unconsumed tail to the front, growing the buffer
+                # when a single frame is larger than it.
+                pending = self._end - self._start
+                if needed > len(self._buffer):
+                    buffer = bytearray(max(needed, 2 * len(self._buffer)))
+                    buffer[:pending] = self._view[self._start:self._end]
+                    self._buffer = buffer
+                    self._view = memoryview(buffer)
+                else:
+                    self._buffer[:pending] = self._view[self._start:self._end]
+                self._start, self._end = 0, pending
+
+            received = self.sock.recv_into(self._view[self._end:])
+            if not received:
+                raise ConnectionError("connection closed by peer")
+            self._end += received
+
+    def _take(self, size):
+        """Consume size buffered bytes and return them as a memoryview."""
+        view = self._view[self._start:self._start + size]
+        self._start += size
+        self.consumed += size
+        if self._start == self._end:
+            self._start = self._end = 0
+        return view
+
+    def read_frame(self, decode=True):
+        """Read one complete frame.
+
+        Input Arguments:
+        - decode (bool): Decode the payload to str. When False the payload is
+          returned as a memoryview into the receive buffer, which stays valid
+          only until the next read on this reader. Forwarding paths use it to
+          pass the bytes on without decoding or copying them.
+
+        Output Arguments:
+        - tuple: A tuple containing header and payload.
+        """
+        if self.version == 2:
+            return self._read_frame_v2(decode)
+
+        self._fill(HEADER_LENGTH.size)
+        header_length = HEADER_LENGTH.unpack_from(self._buffer, self._start)[0]
+        self._fill(HEADER_LENGTH.size + header_length + PAYLOAD_LENGTH.size)
+        payload_length = PAYLOAD_LENGTH.unpack_from(self._buffer, self._start + HEADER_LENGTH.size + header_length)[0]
+        self._fill(HEADER_LENGTH.size + header_length + PAYLOAD_LENGTH.size + payload_length)
+
+        self._take(HEADER_LENGTH.size)
+        header = str(self._take(header_length), "utf-8")
+        self._take(PAYLOAD_LENGTH.size)
+        payload = self._take(payload_length)
+
+        if decode:
+            payload = str(payload, "utf-8")
+        return header, payload
+
+    def _varint(self, offset):
+        """Parse a buffered varint at offset; return (value, offset after it)."""
+        value = shift = 0
+        while True:
+            self._fill(offset + 1)
+            byte = self._buffer[self._start + offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value, offset
+            shift += 7
+            if shift > 63:
+                raise ValueError("varint too long")
+
+    def _read_frame_v2(self, decode):
+        """Read one frame in the version 2 format, see read_frame()."""
+        self._fill(2)
+        opcode, flags = self._buffer[self._start], self._buffer[self._start + 1]
+        offset = 2
+        if opcode:
+            header = OPCODES[opcode] if opcode < len(OPCODES) else ""
+        else:
+            header_length, offset = self._varint(offset)
+            self._fill(offset + header_length)
+            header = str(self._view[self._start + offset:self._start + offset + header_length], "utf-8")
+            offset += header_length
+        payload_length, offset = self._varint(offset)
+        self._fill(offset + payload_length)
+
+        self._take(offset)
+        payload = self._take(payload_length)
+
+        if flags & FLAG_ZLIB:
+            payload = _decompress(payload)
+        if decode:
+            payload = str(payload, "utf-8")
+        return header, payload
+
+    def recv(self, bufsize):
+        """Return up to bufsize bytes, like socket.recv().
+
+        Buffered bytes are returned first so raw data that follows a frame on
+        the wire is never lost. Returns b'' when the peer closed the socket.
+        """
+        if self._end == self._start:
+            data = self.sock.recv(bufsize)
+            self.consumed += len(data)
+            return data
+        return bytes(self._take(min(bufsize, self._end - self._start)))
+
+    def readinto(self, view):
+        """Read up to len(view) bytes into a writable buffer.
+
+        Input Arguments:
+        - view (memoryview): The buffer to fill.
+
+        Output Arguments:
+        - int: The number of bytes read, 0 when the peer closed the socket.
+        """
+        if self._end == self._start:
+            received = self.sock.recv_into(view)
+            self.consumed += received
+            return received
+        size = min(len(view), self._end - self._start)
+        view[:size] = self._take(size)
+        return size
+
+    def read_exact(self, size):
+        """Read exactly size bytes.
+
+        Input Arguments:
+        - size (int): The number of bytes to read.
+
+        Output Arguments:
+        - bytes: The data read.
+        """
+        self._fill(size)
+        return bytes(self._take(size))
+
+
+def reader_for(sock):
+    """Return the FrameReader bound to a socket, creating it on first use.
+
+    Input Arguments:
+    - sock (socket): The socket.
+
+    Output Arguments:
+    - FrameReader: The reader for that socket.
+    """
+    with _readers_lock:
+        reader = _readers.get(sock)
+        if reader is None:
+            reader = _readers[sock] = FrameReader(sock)
+        return reader
+
+
+async def _read_varint_async(reader):
+    """Read a varint from an asyncio stream reader; returns (value, bytes read)."""
+    value = shift = size = 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        size += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, size
+        shift += 7
+        if shift > 63:
+            raise ValueError("varint too long")
+
+
+async def read_message_async(reader, version=1, decode=True):
+    """Read one frame from an asyncio stream reader.
+
+    Input Arguments:
+    - reader (asyncio.StreamReader): The stream reader.
+    - version (int): The frame format agreed with the peer.
+    - decode (bool): Decode the payload to str; pass False to get the raw bytes.
+
+    Output Arguments:
+    - tuple: A tuple containing header and payload.
+    """
+    header, payload, _ = await read_frame_async(reader, version, decode)
+    return header, payload
+
+
+async def read_frame_async(reader, version=1, decode=True):
+    """Read one frame like read_message_async(), and tell how many bytes it took on the wire.
+
+    Output Arguments:
+    - tuple: The header, the payload and the wire size of the frame, which
+      is what FrameReader.consumed advances by for the same frame.
+    """
+    if version == 2:
+        opcode, flags = await reader.readexactly(2)
+        size = 2
+        if opcode:
+            header = OPCODES[opcode] if opcode < len(OPCODES) else ""
+        else:
+            header_length, length_size = await _read_varint_async(reader)
+            header = (await reader.readexactly(header_length)).decode()
+            size += length_size + header_length
+        payload_length, length_size = await _read_varint_async(reader)
+        payload = await reader.readexactly(payload_length)
+        size += length_size + payload_length
+        if flags & FLAG_ZLIB:
+            payload = _decompress(payload)
+        return header, payload.decode() if decode else payload, size
+
+    header_length = HEADER_LENGTH.unpack(await reader.readexactly(HEADER_LENGTH.size))[0]
+    header = (await reader.readexactly(header_length)).decode()
+
+    payload_length = PAYLOAD_LENGTH.unpack(await reader.readexactly(PAYLOAD_LENGTH.size))[0]
+    payload = await reader.readexactly(payload_length)
+
+    size = HEADER_LENGTH.size + header_length + PAYLOAD_LENGTH.size + payload_length
+    return header, payload.decode() if decode else payload, size
@@ -0,0 +1,230 @@
+import bisect
+import http.server
+import threading
+import time
+
+import framing
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Address of the /metrics endpoint. server.py overrides it from
+# --metrics-port; 0 leaves the endpoint off.
+METRICS_HOST = "localhost"
+METRICS_PORT = 0
+
+_metrics = []
+
+
+def _labels(name, value):
+    return f'{{{name}="{value}"}}' if name else ""
+
+
+class Counter:
+    """Monotonic count, optionally split by the value of one label."""
+
+    def __init__(self, name, description, label=None):
+        """Create and register the counter.
+
+        Input Arguments:
+        - name (str): The metric name.
+        - description (str): The HELP text.
+        - label (str): The label name, or None for a single series.
+        """
+        self.name = name
+        self.description = description
+        self.label = label
+        # A counter without a label starts at 0 rather than missing.
+        self._values = {} if label else {None: 0}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, label_value=None, amount=1):
+        """Add amount to the series of label_value."""
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def value(self, label_value=None):
+        """Return the current count of a series."""
+        return self._values.get(label_value, 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda item: str(item[0]))
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for label_value, value in values:
+            lines.append(f"{self.name}{_labels(self.label, label_value)} {value}")
+        return lines
+
+
+class Histogram:
+    """Distribution of durations in seconds over BUCKETS, optionally by label."""
+
+    def __init__(self, name, description, label=None):
+        """Create and register the histogram.
+
+        Input Arguments:
+        - name (str): The metric name.
+        - description (str): The HELP text.
+        - label (str): The label name, or None for a single series.
+        """
+        self.name = name
+        self.description = description
+        self.label = label
+        # label value -> [per-bucket counts (last one is +Inf), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, seconds, label_value=None):
+        """Record one duration."""
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def time(self, label_value=None):
+        """Return a context manager that observes the duration of its block."""
+        return _Timer(self, label_value)
+
+    def count(self, label_value=None):
+        """Return the number of durations recorded for a series."""
+        series = self._series.get(label_value)
+        return series[2] if series else 0
+
+    def render(self):
+        with self._lock:
+            series = sorted(((label_value, [list(values[0]), values[1], values[2]])
+                             for label_value, values in self._series.items()), key=lambda item: str(item[0]))
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for label_value, (buckets, total, count) in series:
+            prefix = f'{self.label}="{label_value}",' if self.label else ""
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + ("+Inf",), buckets):
+                cumulative += bucket
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{_labels(self.label, label_value)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label, label_value)} {count}")
+        return lines
+
+
+class _Timer:
+    """Context manager returned by Histogram.time()."""
+
+    def __init__(self, histogram, label_value):
+        self.histogram = histogram
+        self.label_value = label_value
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, self.label_value)
+
+
+class Gauge:
+    """Value read from a function whenever the metrics are rendered.
+
+    Also exposes counts that another object already keeps, such as the
+    credential cache hits, with kind="counter".
+    """
+
+    def __init__(self, name, description, function, kind="gauge"):
+        """Create and register the gauge.
+
+        Input Arguments:
+        - name (str): The metric name.
+        - description (str): The HELP text.
+        - function (callable): Returns the current value.
+        - kind (str): The metric TYPE, "gauge" or "counter".
+        """
+        self.name = name
+        self.description = description
+        self.function = function
+        self.kind = kind
+        _metrics.append(self)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}",
+                f"{self.name} {self.function()}"]
+
+
+FRAMES_IN = Counter("chat_frames_received_total", "Frames received from clients, by header.", "header")
+FRAMES_OUT = Counter("chat_frames_sent_total", "Frames written to clients, by header.", "header")
+BYTES_IN = Counter("chat_received_bytes_total", "Bytes received from authenticated clients, file bodies included.")
+FRAMES_DROPPED = Counter("chat_frames_dropped_total", "Frames dropped because a client's outbound queue was full.")
+BYTES_OUT = Counter("chat_sent_bytes_total", "Bytes written to authenticated clients, file bodies included.")
+AUTH_SECONDS = Histogram("chat_auth_seconds", "Time to register or check a password, by outcome.", "outcome")
+BROADCAST_SECONDS = Histogram("chat_broadcast_seconds", "Time to queue one broadcast frame for every recipient.")
+DB_SECONDS = Histogram("chat_db_seconds", "Time spent on users.db, history.db and quiz score statements, by kind.", "kind")
+HISTORY_DROPPED = Counter("chat_history_dropped_total", "Group messages not logged because the history queue was full.")
+QUIZ_SUBMISSIONS = Counter("chat_quiz_submissions_total", "Quiz answers scored, first submissions only.")
+QUIZ_SCORES_DROPPED = Counter("chat_quiz_scores_dropped_total", "Quiz scores that could not be written to their score file.")
+BLOBS_DEDUPLICATED = Counter("chat_blobs_deduplicated_total", "Files received or added whose contents were already in the blob store.")
+CONNECTIONS_REJECTED = Counter("chat_connections_rejected_total", "Connections refused at accept time, by the limit reached.", "limit")
+RATE_LIMITED = Counter("chat_rate_limited_total", "Frames over their sender's rate limit, delayed or dropped, by header.", "header")
+SESSIONS_REAPED = Counter("chat_sessions_reaped_total", "Connections closed for sending nothing, by stage.", "stage")
+
+
+def frame_received(header, valid):
+    """Count a frame received from a client.
+
+    Headers that failed validation are counted as "invalid" so that a
+    client cannot create new series.
+    """
+    FRAMES_IN.inc(header if valid else "invalid")
+
+
+def frame_sent(frame):
+    """Count an encoded frame written to a client."""
+    length = framing.HEADER_LENGTH.unpack_from(frame)[0]
+    FRAMES_OUT.inc(bytes(frame[2:2 + length]).decode(errors="replace"))
+
+
+def render():
+    """Return every registered metric in the Prometheus text format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Answers GET /metrics; everything else is a 404."""
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a console line each.
+        pass
+
+
+def serve(host=None, port=None):
+    """Serve /metrics over HTTP from a daemon thread.
+
+    Input Arguments:
+    - host (str): Address to bind, METRICS_HOST by default.
+    - port (int): Port to listen on, METRICS_PORT by default.
+
+    Output Arguments:
+    - http.server.ThreadingHTTPServer: The running server; call shutdown()
+      and server_close() to stop it.
+    """
+    server = http.server.ThreadingHTTPServer((host or METRICS_HOST, port or METRICS_PORT), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,247 @@
+import concurrent.futures
+import hmac
+import itertools
+import os
+import socket
+import threading
+
+import framing
+
+# Clients that put "mux" in their hello send and receive files as chunk
+# frames tagged with a transfer id instead of as raw bodies, so any number
+# of transfers and chat frames can be interleaved on one connection:
+#
+#   client: file_transfer "send:ID:SIZE:TARGET:FILENAME" (TARGET is server
+#           or a username), then after the server's "accept:ID" chunk
+#           frames "ID:" + data and file_transfer "sent:ID:DIGEST"
+#   server: file_transfer "recv:ID:SIZE:SENDER:FILENAME", chunk frames and
+#           file_transfer "end:ID:DIGEST"
+#
+# DIGEST is the hex BLAKE2b digest of the whole file (file_transfer.new_hash).
+CHUNK_HEADER = "chunk"
+
+# File bytes in one chunk frame. A chat frame waits for at most one batch
+# of BATCH_CHUNKS chunks, and BATCHES_IN_FLIGHT batches of every push are
+# queued for the client's writer at a time.
+CHUNK_SIZE = 64 * 1024
+BATCH_CHUNKS = 4
+BATCHES_IN_FLIGHT = 2
+
+# Files one client may be sending at once.
+MAX_INCOMING = 16
+
+# Bytes the kernel may hold unsent on the connection of a client that
+# agreed on chunked transfers (TCP_NOTSENT_LOWAT, where the platform has
+# it). Without a cap the send buffer grows to megabytes of chunks, and a
+# chat frame queued behind them waits until they are all on the wire;
+# with it the chunks wait in the session's queue, where chat frames can
+# pass them. 0 leaves the socket alone.
+UNSENT_LIMIT = 128 * 1024
+
+# Transfer ids of the files the server pushes.
+_push_ids = itertools.count(1)
+
+
+def parse_chunk(payload):
+    """Split a chunk payload into the transfer id and the data.
+
+    Input Arguments:
+    - payload (bytes or memoryview): The chunk frame payload.
+
+    Output Arguments:
+    - tuple: The transfer id (str) and the data (memoryview). Raises
+      ValueError if the payload has no id.
+    """
+    view = memoryview(payload)
+    separator = bytes(view[:64]).find(b":")
+    if separator <= 0:
+        raise ValueError("chunk without a transfer id")
+    return str(view[:separator], "ascii"), view[separator + 1:]
+
+
+def limit_unsent(sock):
+    """Cap the unsent bytes of a client socket at UNSENT_LIMIT, see above."""
+    if UNSENT_LIMIT and hasattr(socket, "TCP_NOTSENT_LOWAT"):
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, UNSENT_LIMIT)
+        except OSError:
+            pass
+
+
+def chunk_frame(identifier, data):
+    """Encode a chunk frame."""
+    return framing.encode_message(CHUNK_HEADER, identifier.encode() + b":" + data)
+
+
+class IncomingTransfer:
+    """A file a client is sending in chunk frames, received into the blob store."""
+
+    def __init__(self, identifier, size, target, filename, blob):
+        """Initialize the transfer.
+
+        Input Arguments:
+        - identifier (str): The id the client chose.
+        - size (int): The file size announced.
+        - target (str): "server" for an upload, otherwise the recipient.
+        - filename (str): The file name.
+        - blob (blob_store.BlobWriter): Where the data is written.
+        """
+        self.identifier = identifier
+        self.size = size
+        self.target = target
+        self.filename = filename
+        self.blob = blob
+        self.received = 0
+
+
+def parse_send(payload):
+    """Parse "send:ID:SIZE:TARGET:FILENAME"; raises ValueError for a malformed request."""
+    _, identifier, size, target, filename = payload.strip().split(":", 4)
+    size = int(size)
+    if not identifier or len(identifier) > 32 or size < 0 or not target \
+            or filename in ("", ".", "..") or os.path.basename(filename) != filename:
+        raise ValueError(payload)
+    return identifier, size, target, filename
+
+
+def receive(transfer, data):
+    """Write the data of a chunk frame; raises ValueError past the announced size."""
+    if transfer.received + len(data) > transfer.size:
+        raise ValueError(f"more than {transfer.size} bytes sent for transfer {transfer.identifier}")
+    transfer.blob.write(data)
+    transfer.received += len(data)
+
+
+def complete(transfer, digest):
+    """Store a transfer the client says it has sent in full.
+
+    Input Arguments:
+    - transfer (IncomingTransfer): The transfer.
+    - digest (str): The digest the client computed.
+
+    Output Arguments:
+    - str: The digest of the stored blob. Raises ValueError if bytes are
+      missing or the digests differ; the blob is then discarded.
+    """
+    if transfer.received != transfer.size:
+        raise ValueError(f"{transfer.received} of {transfer.size} bytes received")
+    if not hmac.compare_digest(transfer.blob.hasher.hexdigest(), digest):
+        raise ValueError("the file does not match the sender's digest")
+    return transfer.blob.commit()
+
+
+def push(session, blob, filename, sender, progress=None, throttle=None):
+    """Send a stored file to a session that agreed on chunked transfers.
+
+    The chunk frames go through the session's outbound queue like any
+    other frame, a few batches at a time: every batch is followed by a job
+    that does nothing, and when the writer reaches that job the next batch
+    is queued. Chat frames queued meanwhile go out between the batches, and
+    the memory held is a few batches per push, not the file.
+
+    Input Arguments:
+    - session (Session): The recipient.
+    - blob (blob_store.Blob): The file.
+    - filename (str): The name the client stores it under.
+    - sender (str): Who sent it, "Server" for server files.
+    - progress (callable): Called with the number of bytes of every batch written.
+    - throttle (callable): Called with the number of bytes of every batch
+      before it is queued; returns the seconds to wait.
+
+    Output Arguments:
+    - concurrent.futures.Future: Resolves to 0 once the file has been
+      written; the chunk frames are counted by the session's writer like
+      any other frame.
+    """
+    transfer = _Push(session, f"d{next(_push_ids)}", blob, progress, throttle)
+    session.sendall(framing.encode_message(
+        "file_transfer", f"recv:{transfer.identifier}:{blob.size}:{sender}:{filename}\n"))
+    for _ in range(BATCHES_IN_FLIGHT):
+        transfer.next_batch()
+    return transfer.future
+
+
+def _noop(client):
+    return None
+
+
+async def _noop_async(writer):
+    return None
+
+
+class _Push:
+    """The state of one push(), advanced from the writer as batches go out."""
+
+    def __init__(self, session, identifier, blob, progress, throttle):
+        self.session = session
+        self.identifier = identifier
+        self.blob = blob
+        self.progress = progress
+        self.throttle = throttle
+        self.future = concurrent.futures.Future()
+        self.offset = 0
+        self.ending = False
+        self._lock = threading.Lock()
+
+    def next_batch(self):
+        """Queue the next batch, or the end of the file after the last one."""
+        with self._lock:
+            if self.future.done() or self.ending:
+                return
+            if self.session.closing:
+                self.future.set_exception(ConnectionError("the session was closed"))
+                return
+            start = self.offset
+            if start >= self.blob.size:
+                self.ending = True
+            self.offset = min(self.blob.size, start + BATCH_CHUNKS * CHUNK_SIZE)
+        if start >= self.blob.size:
+            self.session.sendall(framing.encode_message("file_transfer", f"end:{self.identifier}:{self.blob.digest}\n"))
+            self._marker(self._finished)
+            return
+        wait = self.throttle(self.offset - start) if self.throttle is not None else 0
+        if wait:
+            self._later(wait, self._queue, start, self.offset)
+        else:
+            self._queue(start, self.offset)
+
+    def _queue(self, start, end):
+        for offset in range(start, end, CHUNK_SIZE):
+            self.session.sendall(chunk_frame(self.identifier, self.blob.view[offset:min(end, offset + CHUNK_SIZE)]))
+        self._marker(lambda future: self._written(future, end - start))
+
+    def _marker(self, callback):
+        if self.session.coroutine_jobs:
+            marker = self.session.run_async(_noop_async)
+        else:
+            marker = self.session.run(_noop)
+        marker.add_done_callback(callback)
+
+    def _written(self, marker, count):
+        if marker.cancelled() or marker.exception() is not None:
+            self._fail(marker)
+            return
+        if self.progress is not None:
+            self.progress(count)
+        self.next_batch()
+
+    def _finished(self, marker):
+        if marker.cancelled() or marker.exception() is not None:
+            self._fail(marker)
+        elif not self.future.done():
+            self.future.set_result(0)
+
+    def _fail(self, marker):
+        with self._lock:
+            if not self.future.done():
+                self.future.set_exception(ConnectionError("the session was closed") if marker.cancelled()
+                                          else marker.exception())
+
+    def _later(self, delay, function, *args):
+        """Call function(*args) after delay seconds without holding up the writer."""
+        if self.session.coroutine_jobs:
+            self.session.loop.call_soon_threadsafe(self.session.loop.call_later, delay, function, *args)
+        else:
+            timer = threading.Timer(delay, function, args)
+            timer.daemon = True
+            timer.start()
@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Key derivation used for new and rehashed passwords: "scrypt" or "pbkdf2".
+# server.py overrides these from --kdf, --scrypt-n and --pbkdf2-iterations.
+KDF = "scrypt"
+
+# scrypt cost: N is the CPU/memory cost (a power of two), R the block size
+# and P the parallelism. N=2**14, r=8 is the interactive login setting from
+# the scrypt paper and needs 16 MiB per hash.
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+# PBKDF2-HMAC-SHA256 iteration count.
+PBKDF2_ITERATIONS = 600000
+
+SALT_SIZE = 16
+KEY_SIZE = 32
+
+# Hashing worker processes, and how many logins and registrations may wait
+# for one before further clients wait for a slot. server.py overrides them
+# from --hash-workers and --max-pending-auth.
+WORKERS = max(1, (os.cpu_count() or 1) - 1)
+MAX_PENDING = 64
+
+
+def current_parameters():
+    """Return the KDF name and cost parameters new hashes are made with."""
+    if KDF == "pbkdf2":
+        return ("pbkdf2_sha256", PBKDF2_ITERATIONS)
+    return ("scrypt", SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+def hash_password(password, parameters):
+    """Hash a password with a fresh random salt.
+
+    Hashes are stored as "scrypt$n$r$p$salt$key" or
+    "pbkdf2_sha256$iterations$salt$key" with the salt and key in hex, so
+    every row records the parameters it has to be checked with.
+
+    Input Arguments:
+    - password (str): The password to hash.
+    - parameters (tuple): KDF name and cost, see current_parameters().
+
+    Output Arguments:
+    - str: The encoded hash.
+    """
+    salt = os.urandom(SALT_SIZE)
+    key = _derive(password, salt, parameters)
+    return "$".join([str(value) for value in parameters] + [salt.hex(), key.hex()])
+
+
+def verify_password(password, stored, parameters):
+    """Check a password against a stored hash.
+
+    Rows written before salted hashing are plain sha256 hex digests. When one
+    of those, or a hash made with other parameters, matches, a new hash with
+    the current parameters is returned so that the caller can store it.
+
+    Input Arguments:
+    - password (str): The password to check.
+    - stored (str): The hash stored in users.db.
+    - parameters (tuple): KDF name and cost new hashes are made with.
+
+    Output Arguments:
+    - tuple: (bool match, str new hash or None).
+    """
+    fields = stored.split("$")
+    if len(fields) == 1:
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        matched = hmac.compare_digest(legacy, stored)
+        stored_parameters = None
+    else:
+        stored_parameters = (fields[0],) + tuple(int(value) for value in fields[1:-2])
+        key = _derive(password, bytes.fromhex(fields[-2]), stored_parameters)
+        matched = hmac.compare_digest(key.hex(), fields[-1])
+
+    if matched and stored_parameters != tuple(parameters):
+        return True, hash_password(password, parameters)
+    return matched, None
+
+
+def _derive(password, salt, parameters):
+    """Derive the key for a password and salt with the given KDF parameters."""
+    if parameters[0] == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, parameters[1], KEY_SIZE)
+    if parameters[0] == "scrypt":
+        _, n, r, p = parameters
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=KEY_SIZE,
+                              maxmem=256 * r * (n + p) + 1024 * 1024)
+    raise ValueError(f"unknown password hash scheme {parameters[0]!r}")
+
+
+def _exit_with_parent():
+    """Worker initializer: exit when the server process goes away.
+
+    Pool workers are only told to stop by a clean shutdown; without this a
+    killed server would leave them running.
+    """
+    def watch():
+        multiprocessing.parent_process().join()
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+class Hasher:
+    """Runs password hashing on a bounded pool of worker processes.
+
+    scrypt and PBKDF2 are CPU-bound and would hold the GIL away from chat
+    traffic if they ran on the handler threads or the event loop. At most
+    max_pending hashes are queued or running at once; further logins wait
+    for a slot before submitting work.
+    """
+
+    def __init__(self, workers=None, max_pending=None):
+        """Start the worker pool.
+
+        Input Arguments:
+        - workers (int): Worker processes, WORKERS by default.
+        - max_pending (int): Hashes queued or running at once, MAX_PENDING
+          by default.
+        """
+        self.workers = workers or WORKERS
+        self.max_pending = max_pending or MAX_PENDING
+        self.parameters = current_parameters()
+        # Worker processes are spawned rather than forked: the server already
+        # runs threads, and forking those is unsafe.
+        self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                         initializer=_exit_with_parent)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._async_slots = asyncio.Semaphore(self.max_pending)
+
+    def _run(self, function, *args):
+        with self._slots:
+            return self._pool.submit(function, *args).result()
+
+    async def _run_async(self, function, *args):
+        async with self._async_slots:
+            return await asyncio.wrap_future(self._pool.submit(function, *args))
+
+    def hash(self, password):
+        """Hash a new password, blocking until a worker is done.
+
+        Input Arguments:
+        - password (str): The password to hash.
+
+        Output Arguments:
+        - str: The encoded hash.
+        """
+        return self._run(hash_password, password, self.parameters)
+
+    def verify(self, password, stored):
+        """Check a password against a stored hash, see verify_password().
+
+        Input Arguments:
+        - password (str): The password to check.
+        - stored (str): The hash stored in users.db.
+
+        Output Arguments:
+        - tuple: (bool match, str new hash or None).
+        """
+        return self._run(verify_password, password, stored, self.parameters)
+
+    async def hash_async(self, password):
+        """Coroutine version of hash() for the asyncio server."""
+        return await self._run_async(hash_password, password, self.parameters)
+
+    async def verify_async(self, password, stored):
+        """Coroutine version of verify() for the asyncio server."""
+        return await self._run_async(verify_password, password, stored, self.parameters)
+
+    def close(self):
+        """Stop the worker processes."""
+        self._pool.shutdown()
@@ -0,0 +1,205 @@
+import os
+import re
+import threading
+
+import framing
+
+# A quiz is a questions file NAME_ques.txt and an answers file NAME_ans.txt
+# in the same directory, e.g. quiz_dir/quiz_ques.txt and quiz_dir/quiz_ans.txt.
+QUESTIONS_SUFFIX = "_ques.txt"
+ANSWERS_SUFFIX = "_ans.txt"
+
+OPTION_PREFIXES = ("a.", "b.", "c.", "d.")
+OPTION_LETTER = re.compile(r"(?:^|\s)([a-z])\.")
+
+SEPARATOR = "\n\n-----------------------------\n\n"
+
+
+class QuizError(ValueError):
+    """A quiz file that cannot be used as it is."""
+
+
+def quiz_id(directory_name, filename):
+    """Return the id of the quiz whose questions are in directory_name/filename, e.g. "quiz_dir/quiz"."""
+    name = filename[:-len(QUESTIONS_SUFFIX)] if filename.endswith(QUESTIONS_SUFFIX) else os.path.splitext(filename)[0]
+    return f"{directory_name.rstrip('/')}/{name}"
+
+
+def parse_questions(text):
+    """Split a questions file into questions and their option lines.
+
+    Lines starting with "a." to "d." are options of the question before
+    them; any other non-empty line starts a new question.
+
+    Input Arguments:
+    - text (str): The contents of the questions file.
+
+    Output Arguments:
+    - tuple: The list of questions and the list of option lists.
+    """
+    questions = []
+    options = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(OPTION_PREFIXES):
+            if not questions:
+                raise QuizError(f"option before the first question: {line!r}")
+            options[-1].append(line)
+        else:
+            questions.append(line)
+            options.append([])
+    return questions, options
+
+
+class Quiz:
+    """A parsed and validated quiz with its broadcast frame already encoded."""
+
+    def __init__(self, quiz_id, questions, options, answers, stamp=None):
+        """Validate the quiz and encode its question frame.
+
+        Input Arguments:
+        - quiz_id (str): The id the quiz is looked up by.
+        - questions (list): The question lines.
+        - options (list): The option lines of every question.
+        - answers (list): The correct option letter of every question.
+        - stamp (tuple): Modification times and sizes of the files it was
+          read from, to tell when they changed.
+        """
+        self.id = quiz_id
+        self.questions = questions
+        self.options = options
+        self.answers = [answer.lower() for answer in answers]
+        self.stamp = stamp
+        self.validate()
+
+        self.message = "".join(f"Question {number}: {question}\n\nOptions: {' '.join(question_options)}{SEPARATOR}"
+                               for number, (question, question_options) in enumerate(zip(questions, options), 1))
+        self.frame = framing.encode_message("quiz_question", self.message)
+        # Encode the compact formats now, so starting the quiz only queues
+        # the frame for every client.
+        self.frame.v2(False)
+        self.frame.v2(True)
+
+    def validate(self):
+        """Raise QuizError unless every question has options and a valid answer."""
+        if not self.questions:
+            raise QuizError(f"{self.id}: no questions")
+        if len(self.answers) != len(self.questions):
+            raise QuizError(f"{self.id}: {len(self.questions)} questions but {len(self.answers)} answers")
+        for number, (question_options, answer) in enumerate(zip(self.options, self.answers), 1):
+            letters = set(OPTION_LETTER.findall(" ".join(question_options)))
+            if not letters:
+                raise QuizError(f"{self.id}: question {number} has no options")
+            if answer not in letters:
+                raise QuizError(f"{self.id}: answer {answer!r} to question {number} is not one of its options")
+
+    def __len__(self):
+        return len(self.questions)
+
+    def __repr__(self):
+        return f"Quiz({self.id!r}, {len(self.questions)} questions)"
+
+
+class QuizBank:
+    """Cache of parsed quizzes by id.
+
+    A quiz is read, validated and encoded the first time it is loaded and
+    served from memory after that for as long as its files keep their
+    modification time and size; a changed file is parsed again on the next
+    lookup. Lookups are thread-safe.
+    """
+
+    def __init__(self, base=None):
+        """Initialize an empty bank.
+
+        Input Arguments:
+        - base (str): Directory quiz directories are relative to, the
+          working directory by default.
+        """
+        self.base = base
+        self._lock = threading.Lock()
+        # quiz id -> (directory, questions file, answers file)
+        self._sources = {}
+        self._quizzes = {}
+
+    def _path(self, directory_name, filename):
+        return os.path.join(self.base or os.getcwd(), directory_name, filename)
+
+    def _stamp(self, source):
+        directory_name, filename, answer_file = source
+        stamp = []
+        for name in (filename, answer_file):
+            status = os.stat(self._path(directory_name, name))
+            stamp.extend((status.st_mtime_ns, status.st_size))
+        return tuple(stamp)
+
+    def _read(self, quiz_id, source, stamp):
+        directory_name, filename, answer_file = source
+        with open(self._path(directory_name, filename), "r") as file:
+            questions, options = parse_questions(file.read())
+        with open(self._path(directory_name, answer_file), "r") as file:
+            answers = file.read().split()
+        return Quiz(quiz_id, questions, options, answers, stamp)
+
+    def load(self, directory_name, filename, answer_file):
+        """Return the quiz in the given files, parsing them only if they changed.
+
+        Input Arguments:
+        - directory_name (str): The directory containing the quiz files.
+        - filename (str): The questions file.
+        - answer_file (str): The answers file.
+
+        Output Arguments:
+        - Quiz: The quiz. Raises QuizError if the files do not make a valid
+          quiz and OSError if they cannot be read.
+        """
+        identifier = quiz_id(directory_name, filename)
+        source = (directory_name, filename, answer_file)
+        stamp = self._stamp(source)
+        with self._lock:
+            quiz = self._quizzes.get(identifier)
+            if quiz is not None and self._sources[identifier] == source and quiz.stamp == stamp:
+                return quiz
+        quiz = self._read(identifier, source, stamp)
+        with self._lock:
+            self._sources[identifier] = source
+            self._quizzes[identifier] = quiz
+        return quiz
+
+    def load_directory(self, directory_name):
+        """Load every NAME_ques.txt quiz that has a NAME_ans.txt next to it.
+
+        Input Arguments:
+        - directory_name (str): The directory to scan.
+
+        Output Arguments:
+        - list: The loaded quizzes, sorted by id.
+        """
+        quizzes = []
+        for filename in sorted(os.listdir(self._path(directory_name, ""))):
+            if filename.endswith(QUESTIONS_SUFFIX):
+                answer_file = filename[:-len(QUESTIONS_SUFFIX)] + ANSWERS_SUFFIX
+                if os.path.exists(self._path(directory_name, answer_file)):
+                    quizzes.append(self.load(directory_name, filename, answer_file))
+        return quizzes
+
+    def get(self, quiz_id):
+        """Return a loaded quiz by id, re-reading it if its files changed.
+
+        Output Arguments:
+        - Quiz: The quiz, or None if no quiz with that id was loaded.
+        """
+        source = self._sources.get(quiz_id)
+        if source is None:
+            return None
+        return self.load(*source)
+
+    def ids(self):
+        """Return the ids of the loaded quizzes."""
+        with self._lock:
+            return sorted(self._quizzes)
+
+    def __len__(self):
+        return len(self._quizzes)
@@ -0,0 +1,140 @@
+import quiz_bank
+
+# Answers are encoded one byte per question: the option letter a to z as 1
+# to 26, and 0 for a missing answer or anything that is not one letter.
+LETTERS = b"abcdefghijklmnopqrstuvwxyz"
+NO_ANSWER = 0
+
+_ENCODE = bytearray(256)
+for _code, _letter in enumerate(LETTERS, 1):
+    _ENCODE[_letter] = _code
+_ENCODE = bytes(_ENCODE)
+
+
+class AnswerKey:
+    """The answers of a quiz, encoded for scoring submissions in batches.
+
+    A batch of submissions is one bytes object of N rows of one byte per
+    question. XOR with the key repeated N times, done as a single integer
+    operation, gives the correctness matrix: a zero byte wherever the answer
+    is right. Scores are zero counts over each row and per-question
+    statistics are counts over each column of the rows, so scoring a batch costs a few C
+    level passes over the bytes instead of a Python loop per answer.
+    """
+
+    def __init__(self, quiz):
+        """Encode the answers and the option letters of every question.
+
+        Input Arguments:
+        - quiz (quiz_bank.Quiz): The quiz.
+        """
+        self.length = len(quiz)
+        self.key = self.encode(" ".join(quiz.answers))
+        # Codes of the options offered by every question, in order.
+        self.options = [sorted(set("".join(quiz_bank.OPTION_LETTER.findall(" ".join(question_options))).encode()
+                                   .translate(_ENCODE)))
+                        for question_options in quiz.options]
+
+    def encode(self, answers):
+        """Encode one submission as a row of the batch.
+
+        Input Arguments:
+        - answers (str): The answers separated by spaces, e.g. "a c b".
+
+        Output Arguments:
+        - bytes: One byte per question; missing answers are NO_ANSWER and
+          extra answers are dropped.
+        """
+        # A full submission of single letters and single spaces is encoded
+        # without splitting it into tokens.
+        if len(answers) == 2 * self.length - 1 and answers[1::2].isspace():
+            letters = answers[::2].lower()
+            if len(letters) == self.length and letters.isalpha():
+                return letters.encode("ascii", "replace").translate(_ENCODE)
+
+        tokens = answers.lower().split()[:self.length]
+        letters = "".join(tokens)
+        if len(letters) != len(tokens):
+            # Only a longer token makes the joined string longer.
+            letters = "".join(token if len(token) == 1 else "?" for token in tokens)
+        row = letters.encode("ascii", "replace").translate(_ENCODE)
+        return row + bytes(self.length - len(row))
+
+    def mark(self, rows):
+        """Return the correctness matrix of a batch.
+
+        Input Arguments:
+        - rows (bytes): The encoded submissions, one after the other.
+
+        Output Arguments:
+        - bytes: The same shape as rows, zero where the answer is correct.
+        """
+        count = len(rows) // self.length
+        return (int.from_bytes(rows, "big") ^ int.from_bytes(self.key * count, "big")).to_bytes(len(rows), "big")
+
+    def scores(self, matrix):
+        """Return the score of every row of a correctness matrix."""
+        return [matrix.count(0, start, start + self.length) for start in range(0, len(matrix), self.length)]
+
+
+class ItemStatistics:
+    """Per-question results of a quiz, accumulated batch by batch."""
+
+    def __init__(self, key):
+        """Start with no submissions.
+
+        Input Arguments:
+        - key (AnswerKey): The key the batches are scored against.
+        """
+        self.key = key
+        self.submissions = 0
+        self.correct = [0] * key.length
+        # question -> option code -> how many chose it; NO_ANSWER included
+        self.choices = [dict.fromkeys([NO_ANSWER, *options], 0) for options in key.options]
+
+    def add(self, rows):
+        """Count a batch of encoded submissions.
+
+        Input Arguments:
+        - rows (bytes): The encoded submissions, one after the other.
+        """
+        length = self.key.length
+        self.submissions += len(rows) // length
+        for question, code in enumerate(self.key.key):
+            column = rows[question::length]
+            self.correct[question] += column.count(code)
+            counts = self.choices[question]
+            for option in counts:
+                counts[option] += column.count(option)
+
+    def percent_correct(self):
+        """Return the percentage of submissions that got each question right."""
+        return [100 * correct / self.submissions if self.submissions else 0.0 for correct in self.correct]
+
+    def format(self):
+        """Return the statistics as one line of text per question."""
+        lines = []
+        for number, (percent, counts) in enumerate(zip(self.percent_correct(), self.choices), 1):
+            total = self.submissions or 1
+            chosen = ", ".join(f"{chr(LETTERS[code - 1])} {100 * count / total:.1f}%"
+                               for code, count in counts.items() if code != NO_ANSWER)
+            lines.append(f"Question {number}: {percent:.1f}% correct; {chosen}, "
+                         f"no answer {100 * counts[NO_ANSWER] / total:.1f}%\n")
+        return "".join(lines)
+
+
+def score_batch(key, submissions, statistics=None):
+    """Score a batch of submissions.
+
+    Input Arguments:
+    - key (AnswerKey): The answers to score against.
+    - submissions (list): The answers of every submission as str.
+    - statistics (ItemStatistics): Statistics to add the batch to, if any.
+
+    Output Arguments:
+    - list: The score of every submission, in order.
+    """
+    rows = b"".join(map(key.encode, submissions))
+    if statistics is not None:
+        statistics.add(rows)
+    return key.scores(key.mark(rows))
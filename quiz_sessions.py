@@ -0,0 +1,293 @@
+import heapq
+import itertools
+import operator
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import chat_history
+import metrics
+import quiz_scoring
+
+# Score files are kept in this directory; a SCORE_FILE ending in one of
+# SQLITE_SUFFIXES is an SQLite database, any other name a CSV file with one
+# "username,score" line per submission.
+SCORES_DIRECTORY = "all_quiz_scores"
+SQLITE_SUFFIXES = (".db", ".sqlite")
+
+# Most scores written in one batch, and how long (seconds) the writer waits
+# for more scores once it has one. Each batch opens every score file once.
+BATCH_SIZE = 1024
+BATCH_INTERVAL = 0.2
+
+# Entries in a leaderboard when the request does not say.
+DEFAULT_TOP = 10
+
+CREATE_TABLE = ("CREATE TABLE IF NOT EXISTS quiz_scores (quiz INTEGER NOT NULL, quiz_name TEXT NOT NULL, "
+                "username TEXT NOT NULL, score INTEGER NOT NULL, questions INTEGER NOT NULL, submitted_at REAL NOT NULL)")
+INSERT_SCORE = ("INSERT INTO quiz_scores (quiz, quiz_name, username, score, questions, submitted_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)")
+
+LEADERBOARD_USAGE = "Server: Usage: cmd:leaderboard [QUIZ_ID] [COUNT]\n"
+
+
+class QuizSession:
+    """One run of a quiz with the scores of everyone who answered it.
+
+    Only a client's first submission counts. Submissions are buffered and
+    scored in batches with quiz_scoring, when the manager's writer picks
+    them up or when the scores are asked for; the writer then saves them to
+    the score file.
+    """
+
+    def __init__(self, session_id, quiz, score_file):
+        """Open the session for submissions.
+
+        Input Arguments:
+        - session_id (int): The id clients answer the quiz by.
+        - quiz (quiz_bank.Quiz): The quiz being run.
+        - score_file (str): The file in SCORES_DIRECTORY scores are written to.
+        """
+        self.id = session_id
+        self.quiz = quiz
+        self.score_file = score_file
+        self.started_at = time.time()
+        self.open = True
+        self.key = quiz_scoring.AnswerKey(quiz)
+        self.statistics = quiz_scoring.ItemStatistics(self.key)
+        # username -> score, in the order the answers were scored
+        self.scores = {}
+        self._answered = set()
+        # (username, answers, submitted_at) not scored yet
+        self._unscored = []
+        # (username, score, submitted_at) not written yet
+        self._unwritten = []
+        self._lock = threading.Lock()
+
+    def submit(self, username, answers):
+        """Buffer a client's answers if they are the first.
+
+        Input Arguments:
+        - username (str): The username of the client.
+        - answers (str): The answers separated by spaces, e.g. "a c b".
+
+        Output Arguments:
+        - bool: False if the client had already answered.
+        """
+        with self._lock:
+            if username in self._answered:
+                return False
+            self._answered.add(username)
+            self._unscored.append((username, answers, time.time()))
+        return True
+
+    def _score(self):
+        """Score the buffered submissions in one batch; called with the lock held."""
+        if not self._unscored:
+            return
+        usernames, answers, submitted_at = zip(*self._unscored)
+        self._unscored = []
+        scores = quiz_scoring.score_batch(self.key, answers, self.statistics)
+        self.scores.update(zip(usernames, scores))
+        self._unwritten.extend(zip(usernames, scores, submitted_at))
+
+    def take_scores(self):
+        """Score what is buffered and return the scores not written yet.
+
+        Output Arguments:
+        - list: (username, score, submitted_at) tuples.
+        """
+        with self._lock:
+            self._score()
+            rows, self._unwritten = self._unwritten, []
+        return rows
+
+    def leaderboard(self, count=DEFAULT_TOP):
+        """Return the count best (username, score) pairs, best first.
+
+        Ties are ranked by who answered first.
+        """
+        with self._lock:
+            self._score()
+            entries = list(self.scores.items())
+        return heapq.nlargest(count, entries, key=operator.itemgetter(1))
+
+    def item_statistics(self):
+        """Return the percentage correct and the choices made for every question as text."""
+        with self._lock:
+            self._score()
+            return self.statistics.format()
+
+    def __len__(self):
+        return len(self._answered)
+
+    def __repr__(self):
+        return f"QuizSession({self.id}, {self.quiz.id!r}, {len(self)} answers)"
+
+
+def format_leaderboard(quiz_session, count=DEFAULT_TOP):
+    """Return the best scores of a quiz session as lines of text.
+
+    Input Arguments:
+    - quiz_session (QuizSession): The session.
+    - count (int): How many places to show.
+
+    Output Arguments:
+    - str: A heading and one line per place.
+    """
+    state = "open" if quiz_session.open else "ended"
+    lines = [f"Server: Quiz {quiz_session.id} ({quiz_session.quiz.id}, {state}), "
+             f"{len(quiz_session)} answers, top {count}:\n"]
+    for place, (username, score) in enumerate(quiz_session.leaderboard(count), 1):
+        lines.append(f"{place}. {username}: {score}/{len(quiz_session.quiz)}\n")
+    return "".join(lines)
+
+
+class QuizSessions:
+    """The quiz sessions of a server and the writer that saves their scores.
+
+    Any number of quizzes can run at once. submit() only buffers an answer
+    in its session; a writer thread scores whatever has queued up in one
+    batch per session and appends the scores, opening each score file once
+    per batch instead of once per submission.
+    """
+
+    def __init__(self):
+        """Start the score writer."""
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._sessions = {}
+        self._pending = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="quiz-score-writer", daemon=True)
+        self._writer.start()
+        self.batches_written = 0
+
+    def start(self, quiz, score_file):
+        """Open a new session of a quiz.
+
+        Input Arguments:
+        - quiz (quiz_bank.Quiz): The quiz to run.
+        - score_file (str): The file in SCORES_DIRECTORY to write scores to.
+
+        Output Arguments:
+        - QuizSession: The new session.
+        """
+        with self._lock:
+            session = QuizSession(next(self._ids), quiz, score_file)
+            self._sessions[session.id] = session
+        return session
+
+    def get(self, session_id=None):
+        """Return a session by id, or the latest open one without an id.
+
+        Output Arguments:
+        - QuizSession: The session, or None if there is no such session.
+        """
+        with self._lock:
+            if session_id is not None:
+                return self._sessions.get(session_id)
+            for session in reversed(self._sessions.values()):
+                if session.open:
+                    return session
+        return None
+
+    def latest(self):
+        """Return the session started last, open or not, or None."""
+        with self._lock:
+            return next(reversed(self._sessions.values()), None)
+
+    def end(self, session_id):
+        """Stop accepting answers for a session.
+
+        Output Arguments:
+        - QuizSession: The session, or None if there is no such session.
+        """
+        session = self.get(session_id)
+        if session is not None:
+            session.open = False
+        return session
+
+    def sessions(self):
+        """Return every session, oldest first."""
+        with self._lock:
+            return list(self._sessions.values())
+
+    def submit(self, session, username, answers):
+        """Buffer a client's answers for scoring and writing.
+
+        Input Arguments:
+        - session (QuizSession): The session answered.
+        - username (str): The username of the client.
+        - answers (str): The answers separated by spaces.
+
+        Output Arguments:
+        - bool: False if the client had already answered.
+        """
+        if not session.submit(username, answers):
+            return False
+        metrics.QUIZ_SUBMISSIONS.inc()
+        self._pending.put(session)
+        return True
+
+    def _write_loop(self):
+        """Write queued scores in batches until close()."""
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            batch = [item]
+
+            deadline = time.monotonic() + BATCH_INTERVAL
+            while len(batch) < BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._pending.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._pending.put(None)
+                    break
+                batch.append(item)
+
+            self._write(batch)
+
+    def _write(self, batch):
+        """Score the sessions in a batch and append their scores, opening each score file once."""
+        by_file = {}
+        for session in dict.fromkeys(batch):
+            by_file.setdefault(session.score_file, []).extend(
+                (session, username, score, submitted_at) for username, score, submitted_at in session.take_scores())
+
+        os.makedirs(SCORES_DIRECTORY, exist_ok=True)
+        for score_file, rows in by_file.items():
+            if not rows:
+                # An earlier batch or a leaderboard already scored them.
+                continue
+            file_path = os.path.join(os.getcwd(), SCORES_DIRECTORY, score_file)
+            try:
+                if score_file.endswith(SQLITE_SUFFIXES):
+                    with metrics.DB_SECONDS.time("quiz"):
+                        connection = chat_history.connect(file_path)
+                        try:
+                            with connection:
+                                connection.execute(CREATE_TABLE)
+                                connection.executemany(INSERT_SCORE, [
+                                    (session.id, session.quiz.id, username, score, len(session.quiz), submitted_at)
+                                    for session, username, score, submitted_at in rows])
+                        finally:
+                            connection.close()
+                else:
+                    with open(file_path, "a") as csv_file:
+                        csv_file.writelines(f"{username},{score}\n" for _, username, score, _ in rows)
+            except (OSError, sqlite3.Error):
+                metrics.QUIZ_SCORES_DROPPED.inc(amount=len(rows))
+        self.batches_written += 1
+
+    def close(self):
+        """Write every queued score and stop the writer."""
+        self._pending.put(None)
+        self._writer.join()
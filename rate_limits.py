@@ -0,0 +1,233 @@
+import threading
+import time
+
+import metrics
+
+# Frames per second each user may send of every header, and how many may
+# come in one burst; 0 per second for no limit. server.py overrides them
+# from --rate-limit HEADER:RATE:BURST, and rate_limit:HEADER:RATE:BURST on
+# the console changes them while the server runs. Headers missing here
+# are not limited.
+HEADER_RATES = {
+    "msg": (5, 20),
+    "to": (5, 20),
+    "room": (5, 20),
+    "quiz_answer": (20, 50),
+    "cmd": (10, 30),
+    "file_transfer": (1, 5),
+}
+
+# What happens to a frame over its limit: "delay" stops reading from the
+# client until the frame is allowed, so TCP pushes back on it, "reject"
+# drops the frame and sends the client an error frame. file_transfer
+# frames are always delayed, since their body follows on the connection.
+# server.py overrides it from --rate-limit-policy.
+POLICY = "delay"
+
+# File bytes per second each user may send, and separately receive; 0 for
+# no limit. server.py overrides it from --file-rate.
+FILE_RATE = 0
+
+POLICIES = ("delay", "reject")
+
+# The headers clients send, which can be limited.
+HEADERS = ("msg", "to", "room", "cmd", "quiz_answer", "file_transfer")
+
+USAGE = ("Use rate_limit, rate_limit:HEADER:RATE:BURST, rate_limit:file:BYTES_PER_SEC "
+         "or rate_limit:policy:delay|reject")
+
+
+def parse_limit(text):
+    """Parse HEADER:RATE:BURST into (header, rate, burst); raises ValueError if it is not one."""
+    header, rate, burst = text.split(":")
+    rate, burst = float(rate), float(burst)
+    if header not in HEADERS or rate < 0 or (rate and burst < 1):
+        raise ValueError(f"not a rate limit: {text!r}")
+    return header, rate, burst
+
+
+class TokenBucket:
+    """Tokens that refill at a rate up to a burst, taken per frame or per byte.
+
+    The rate and burst are read on every take, from the limits shared by
+    all sessions, so a change on the console applies to buckets that are
+    already full or empty.
+    """
+
+    __slots__ = ("tokens", "stamp")
+
+    def __init__(self, burst):
+        """Start full."""
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self, amount, rate, burst, borrow):
+        """Take tokens, or tell how long until there are enough.
+
+        Input Arguments:
+        - amount (float): The tokens to take.
+        - rate (float): Tokens added per second.
+        - burst (float): The most tokens the bucket holds.
+        - borrow (bool): Take them even if there are not enough yet; the
+          bucket then goes below zero and refills from there.
+
+        Output Arguments:
+        - float: Seconds to wait before the tokens are covered, 0 if they
+          are there already. Without borrow nothing is taken unless 0 is
+          returned.
+        """
+        now = time.monotonic()
+        self.tokens = min(burst, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        wait = (amount - self.tokens) / rate
+        if borrow:
+            self.tokens -= amount
+        return wait
+
+
+class RateLimits:
+    """The rate limits in force, shared by every session of a server."""
+
+    def __init__(self, rates=None, file_rate=None, policy=None):
+        """Initialize the limits.
+
+        Input Arguments:
+        - rates (dict): Header -> (frames per second, burst), HEADER_RATES by default.
+        - file_rate (float): File bytes per second per user, FILE_RATE by default.
+        - policy (str): "delay" or "reject", POLICY by default.
+        """
+        self.rates = dict(HEADER_RATES if rates is None else rates)
+        self.file_rate = FILE_RATE if file_rate is None else file_rate
+        self.policy = POLICY if policy is None else policy
+        self.delayed = 0
+        self.rejected = 0
+        self.throttled_sec = 0.0
+        self._lock = threading.Lock()
+
+    def user(self):
+        """Return the buckets of a new session."""
+        return UserLimits(self)
+
+    def command(self, message):
+        """Run a rate_limit console line and return the reply.
+
+        rate_limit shows the limits, rate_limit:HEADER:RATE:BURST changes
+        the limit of one header (RATE 0 lifts it), rate_limit:file:N the
+        file bytes per second and rate_limit:policy:P the policy.
+        """
+        fields = message.split(":")[1:]
+        if not fields:
+            return self.format()
+        if fields[0] == "policy" and len(fields) == 2 and fields[1] in POLICIES:
+            self.policy = fields[1]
+            return f"Server: Frames over their rate limit are now {'delayed' if self.policy == 'delay' else 'rejected'}."
+        if fields[0] == "file" and len(fields) == 2 and fields[1].isdigit():
+            self.file_rate = int(fields[1])
+            return f"Server: The limit of file transfers is now {self.file_rate or 'none'} bytes per second per user."
+        try:
+            header, rate, burst = parse_limit(":".join(fields))
+        except ValueError:
+            return f"Server: {USAGE}"
+        if rate:
+            self.rates[header] = (rate, burst)
+        else:
+            self.rates.pop(header, None)
+        return f"Server: The limit of {header} frames is now {self._describe(header)}."
+
+    def format(self):
+        """Return the limits and how often they applied, one line each."""
+        lines = [f"{header}: {self._describe(header)}" for header in HEADERS]
+        lines.append(f"file: {self.file_rate or 'no limit'} bytes per second per user, "
+                     f"{self.throttled_sec:.1f} seconds paused")
+        lines.append(f"policy: {self.policy}, {self.delayed} frames delayed, {self.rejected} rejected")
+        return "\n".join(lines)
+
+    def _describe(self, header):
+        rate = self.rates.get(header)
+        return "none" if rate is None else f"{rate[0]:g} per second, bursts of {rate[1]:g}"
+
+    def _count_frame(self, header, delayed):
+        """Count a frame over its limit."""
+        with self._lock:
+            if delayed:
+                self.delayed += 1
+            else:
+                self.rejected += 1
+        metrics.RATE_LIMITED.inc(header)
+
+    def _count_pause(self, wait):
+        """Count a pause of a file transfer."""
+        with self._lock:
+            self.throttled_sec += wait
+
+
+class UserLimits:
+    """The token buckets of one session.
+
+    The frame buckets and the upload bucket are only used by the
+    session's handler and the download bucket only by its writer, so they
+    need no lock. Checking a frame costs one bucket refill; sessions that
+    stay under their limits never wait.
+    """
+
+    def __init__(self, limits):
+        """Initialize without buckets; they are made for the headers the client sends."""
+        self.limits = limits
+        self._buckets = {}
+        # Headers whose frames were rejected since one was last allowed.
+        self._warned = set()
+
+    def check(self, header):
+        """Take a token for a frame the client sent.
+
+        Input Arguments:
+        - header (str): The frame header.
+
+        Output Arguments:
+        - float: Seconds to stop reading from the client before the frame
+          is handled, 0 to handle it now, or None if it must be dropped.
+        """
+        rate = self.limits.rates.get(header)
+        if rate is None:
+            return 0.0
+        bucket = self._buckets.get(header)
+        if bucket is None:
+            bucket = self._buckets[header] = TokenBucket(rate[1])
+        delay = self.limits.policy == "delay" or header == "file_transfer"
+        wait = bucket.take(1, rate[0], rate[1], delay)
+        if not wait:
+            self._warned.discard(header)
+            return wait
+        self.limits._count_frame(header, delay)
+        return wait if delay else None
+
+    def warn(self, header):
+        """Return True for the first rejected frame of a header in a row."""
+        if header in self._warned:
+            return False
+        self._warned.add(header)
+        return True
+
+    def upload(self, count):
+        """Take count file bytes the client sent; returns the seconds to pause reading."""
+        return self._take_bytes("file in", count)
+
+    def download(self, count):
+        """Take count file bytes to send to the client; returns the seconds to wait before sending them."""
+        return self._take_bytes("file out", count)
+
+    def _take_bytes(self, direction, count):
+        """Take file bytes from the bucket of one direction, which the server's reads and writes do not share."""
+        rate = self.limits.file_rate
+        if not rate:
+            return 0.0
+        bucket = self._buckets.get(direction)
+        if bucket is None:
+            bucket = self._buckets[direction] = TokenBucket(rate)
+        wait = bucket.take(count, rate, rate, True)
+        if wait:
+            self.limits._count_pause(wait)
+        return wait
@@ -1,28 +1,79 @@
+import argparse
+import logging
+import multiprocessing
+import socket
 import socketserver
-import sys
 import threading
-import hashlib
-import sqlite3
+import time
+import framing
 import server_utils
-
-# Usage: ./server.py [PORT] [HOST]
-
-USERS = {}
-ACTIVE_USERS = {}
-CLIENTS = []
-ANSWERS = []
-quiz_score_file = None
+import file_transfer
+import async_server
+import session_registry
+import user_store
+import password_hashing
+import metrics
+import chat_history
+import chat_rooms
+import cluster
+import quiz_bank
+import quiz_sessions
+import blob_store
+import file_fanout
+import connection_limits
+import rate_limits
+import mux_transfers
+
+# Usage: ./server.py [PORT] [HOST] [--mode threaded|asyncio] [--workers N] [--send-queue-size N] [--slow-client-policy drop|disconnect]
+
+REGISTRY = session_registry.SessionRegistry()
+STORE = None
+HASHER = None
+HISTORY = None
+QUIZZES = quiz_bank.QuizBank()
+QUIZ_SESSIONS = None
+BLOBS = None
+LIMITER = None
+REAPER = None
+RATE_LIMITS = None
+FANOUTS = file_fanout.Fanouts()
+GROUPS = file_fanout.Groups()
+
+# Console lines that are commands rather than messages to broadcast.
+CONSOLE_COMMANDS = ("stats", "send_file:", "Quiz", "quizzes", "leaderboard", "end_quiz", "quiz_stats", "collect_blobs",
+                    "transfers", "group:", "ungroup:", "groups", "rooms", "room_history:",
+                    "rate_limit")
+
+# Put in front of console output; workers of a cluster name themselves.
+CONSOLE_PREFIX = ""
+
+logger = logging.getLogger("chat")
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     """Threaded TCP Server class."""
-    pass
+    # socketserver listens with a backlog of 5, which makes connections
+    # time out during reconnect storms; asyncio.start_server uses 100.
+    request_queue_size = 128
+    # Set by start_server(); counts connections against the limits.
+    limiter = None
+
+    def verify_request(self, request, client_address):
+        """Refuse a connection over the connection limits as soon as it is accepted."""
+        if self.limiter.acquire(client_address):
+            return True
+        try:
+            request.sendall(server_utils.encode_message("info", connection_limits.REFUSED))
+        except OSError:
+            pass
+        return False
 
 class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
     """Threaded TCP Request Handler class."""
     
     def __init__(self, request, client_address, server):
-        """Initialize with database connection."""
-        self.db_connection = sqlite3.connect('users.db')
+        """Initialize the handler."""
+        self.username = None
+        self.codec = framing.V1
         super().__init__(request, client_address, server)
 
     def authenticate(self, client_socket):
@@ -37,6 +88,14 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
         client_socket.sendall(server_utils.encode_message("info", "Are you already registered? (yes/no):"))
         header, response = server_utils.decode_message(client_socket)
 
+        if header == framing.HELLO:
+            self.codec = server_utils.negotiate(response)
+            client_socket.sendall(server_utils.encode_message(framing.HELLO, self.codec.hello()))
+            framing.reader_for(client_socket).version = self.codec.version
+            if self.codec.mux:
+                mux_transfers.limit_unsent(client_socket)
+            header, response = server_utils.decode_message(client_socket)
+
         if header != "info":
             return False
     
@@ -46,18 +105,22 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
                 header, username = server_utils.decode_message(client_socket)
 
                 if self.check_unique_username(username):
-                    client_socket.sendall(server_utils.encode_message("info", "Username registered successfully."))  
+                    client_socket.sendall(self.codec.wire(server_utils.encode_message("info", "Username registered successfully.")))  
                     break
                 else:
-                    client_socket.sendall(server_utils.encode_message("info", "Username already exists. Please choose another: "))
+                    client_socket.sendall(self.codec.wire(server_utils.encode_message("info", "Username already exists. Please choose another: ")))
             
             header, password = server_utils.decode_message(client_socket)
             
             # Hash the password before storing it
-            hashed_password = hashlib.sha256(password.encode()).hexdigest()
-            self.add_user_to_database(username, hashed_password)
-            USERS[username] = hashed_password
-            ACTIVE_USERS[self.client_address] = username
+            started = time.perf_counter()
+            hashed_password = HASHER.hash(password)
+            added = self.add_user_to_database(username, hashed_password)
+            metrics.AUTH_SECONDS.observe(time.perf_counter() - started, "register" if added else "register_failed")
+            if not added:
+                client_socket.sendall(self.codec.wire(server_utils.encode_message("info", "Username already exists.")))
+                return False
+            self.username = username
 
             return True
         
@@ -67,17 +130,18 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
             header, password = server_utils.decode_message(client_socket)
 
             # Validate username and password
-            hashed_password = hashlib.sha256(password.encode()).hexdigest()
-
-            if self.validate_user_credentials(username, hashed_password):
-                ACTIVE_USERS[self.client_address] = username
+            started = time.perf_counter()
+            valid = self.validate_user_credentials(username, password)
+            metrics.AUTH_SECONDS.observe(time.perf_counter() - started, "login" if valid else "login_failed")
+            if valid:
+                self.username = username
                 return True
             else:
-                client_socket.sendall(server_utils.encode_message("info", "Invalid username or password."))
+                client_socket.sendall(self.codec.wire(server_utils.encode_message("info", "Invalid username or password.")))
                 return False
             
         else:
-            client_socket.sendall(server_utils.encode_message("info", "Invalid response."))
+            client_socket.sendall(self.codec.wire(server_utils.encode_message("info", "Invalid response.")))
             return False
 
     def check_unique_username(self, username):
@@ -89,11 +153,7 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
         Output Arguments:
         - bool: True if the username is unique, False otherwise.
         """
-        cursor = self.db_connection.cursor()
-        cursor.execute("SELECT * FROM users WHERE username=?", (username,))
-        result = cursor.fetchone()
-        cursor.close()
-        return result is None
+        return not STORE.username_exists(username)
 
     def add_user_to_database(self, username, hashed_password):
         """Add a new user to the database.
@@ -103,68 +163,89 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
         - hashed_password (str): The hashed password of the new user.
         
         Output Arguments:
-        - None
+        - bool: False if the username was taken in the meantime.
         """
-        cursor = self.db_connection.cursor()
-        cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))
-        self.db_connection.commit()
-        cursor.close()
+        return STORE.add_user(username, hashed_password)
 
-    def validate_user_credentials(self, username, hashed_password):
+    def validate_user_credentials(self, username, password):
         """Validate user credentials against the database.
+
+        A password stored as a legacy sha256 digest, or with outdated KDF
+        parameters, is rehashed with the current ones once it matches.
         
         Input Arguments:
         - username (str): The username to validate.
-        - hashed_password (str): The hashed password to validate.
+        - password (str): The password to validate.
         
         Output Arguments:
         - bool: True if the credentials are valid, False otherwise.
         """
-        cursor = self.db_connection.cursor()
-        cursor.execute("SELECT * FROM users WHERE username=? AND password=?", (username, hashed_password))
-        result = cursor.fetchone()
-        cursor.close()
-        return result is not None
+        stored = STORE.password_hash(username)
+        if stored is None:
+            return False
+        matched, rehashed = HASHER.verify(password, stored)
+        if rehashed:
+            STORE.update_password(username, rehashed)
+        return matched
 
-    def handle_command(self, payload, client_socket):
+    def handle_command(self, payload, session):
         """Handle commands sent by the server to clients.
         
         Input Arguments:
         - payload (str): The command payload.
-        - client_socket (socket): The client socket.
+        - session (Session): The client session.
         
         Output Arguments:
         - None
         """
         if payload == "disconnect":
-            client_socket.close()
-            user = ACTIVE_USERS[self.client_address]
+            REGISTRY.remove(session)
+
+            server_utils.broadcast_message("info", f"Server: Client {session.username} left the server.\n", REGISTRY)
+            logger.info("Client %s disconnected.", session.username)
 
-            ACTIVE_USERS.pop(self.client_address)
-            CLIENTS.remove((client_socket, self.client_address))
+        elif payload.split(" ", 1)[0] == "history":
+            server_utils.send_history(payload, session, HISTORY)
 
-            server_utils.broadcast_message("info", f"Server: Client {user} left the server.\n", CLIENTS)
-            print(f"Client {user} disconnected.")
-            print("=================")
+        elif payload.split(" ", 1)[0] == "leaderboard":
+            server_utils.send_leaderboard(payload, session, QUIZ_SESSIONS)
+
+        elif payload.split(":", 1)[0] in ("join", "leave", "rooms"):
+            server_utils.room_command(payload, session, REGISTRY)
+
+        elif payload == "ping":
+            # Heartbeat; receiving it has already marked the session active.
+            session.sendall(server_utils.encode_message("cmd", "pong"))
             
             
-    def handle_file_transfer(self, payload, client_socket, username):
+    def handle_file_transfer(self, payload, session):
         """Handle file transfer requests.
         
         Input Arguments:
         - payload (str): The file transfer payload.
-        - client_socket (socket): The client socket.
-        - username (str): The username of the sender.
+        - session (Session): The session of the sender.
         
         Output Arguments:
         - None
         """
         if payload.startswith("file_to_server"):
-            server_utils.upload_file_from_client(payload.split(":")[1], username, client_socket, CLIENTS)
+            server_utils.upload_file_from_client(payload.split(":")[1], session, REGISTRY, BLOBS)
+
+        elif payload.startswith("upload:"):
+            server_utils.resume_upload(payload, session, REGISTRY, BLOBS)
+
+        elif payload.startswith("resume_download:"):
+            server_utils.resume_download(payload, session, BLOBS)
+
+        elif payload.startswith("send:"):
+            server_utils.start_transfer(payload, session, REGISTRY, BLOBS)
+
+        elif payload.startswith("sent:"):
+            server_utils.finish_transfer(payload, session, REGISTRY, BLOBS)
 
         elif payload.startswith("file_to"):
             recipient, filename = payload.split(":")[1:]
-            server_utils.send_file_to_client(recipient, filename, client_socket, username, ACTIVE_USERS, CLIENTS)
+            server_utils.send_file_to_client(recipient, filename, session, REGISTRY, BLOBS)
 
 
     def handle(self):
@@ -177,146 +258,621 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
         - None
         """
         client_socket = self.request
-        CLIENTS.append((client_socket, self.client_address))
+        connected_at = time.time()
+
+        # A client that never finishes logging in would keep this thread forever.
+        client_socket.settimeout(connection_limits.AUTH_TIMEOUT or None)
+        try:
+            authenticated = self.authenticate(client_socket)
+        except socket.timeout:
+            metrics.SESSIONS_REAPED.inc("login")
+            logger.info("Client %s did not log in within %s seconds.", self.client_address[0], connection_limits.AUTH_TIMEOUT)
+            authenticated = False
+        except Exception as e:
+            logger.warning("Error: %s", e)
+            authenticated = False
+
+        if not authenticated:
+            return
+        client_socket.settimeout(None)
+
+        session = session_registry.ThreadedSession(self.username, client_socket, self.client_address, connected_at, self.codec)
+        session.rate_limits = RATE_LIMITS.user()
+        reader = framing.reader_for(client_socket)
 
-        if not self.authenticate(client_socket):
-            CLIENTS.remove((client_socket, self.client_address))
+        if not REGISTRY.add(session):
+            client_socket.sendall(self.codec.wire(server_utils.encode_message("info", f"Server: {self.username} is already logged in.\n")))
+            session.close()
             return
         
+        REAPER.watch(session)
         welcome_msg = "Server: You joined the server.\n"
-        client_socket.sendall(server_utils.encode_message("info", welcome_msg))
+        session.sendall(server_utils.encode_message("info", welcome_msg))
         
-        server_utils.broadcast_message("info", f"Server: Client {ACTIVE_USERS[self.client_address]} joined the server.\n", CLIENTS, exclude_client=client_socket)
+        server_utils.broadcast_message("info", f"Server: Client {session.username} joined the server.\n", REGISTRY, exclude=session)
         
         while True:
             
             try:
                 
-                header, payload = server_utils.decode_message(client_socket)
+                # Chunk payloads are file data and stay bytes.
+                header, payload = server_utils.decode_message(client_socket, decode=False)
+                session.record_received(reader.consumed - session.bytes_in)
+                if header != mux_transfers.CHUNK_HEADER:
+                    payload = str(payload, "utf-8")
+                valid = server_utils.validate_message(header)
+                metrics.frame_received(header, valid)
                 
-                if server_utils.validate_message(header):
-                    print("=================")
-
-                    if header == "msg":
+                if valid:
+                    # Sleeping here stops reading from the client, so TCP holds back the rest.
+                    wait = server_utils.admit_frame(header, session)
+                    if wait is None:
+                        continue
+                    if wait:
+                        time.sleep(wait)
+
+                    if header == mux_transfers.CHUNK_HEADER:
+                        wait = server_utils.receive_chunk(payload, session)
+                        if wait:
+                            time.sleep(wait)
+
+                    elif header == "msg":
                         
-                        server_utils.broadcast_message("msg", f"Client {ACTIVE_USERS[self.client_address]}: {payload}\n", CLIENTS, exclude_client=client_socket)
-                        print(f"Client {ACTIVE_USERS[self.client_address]}: {payload}")
+                        server_utils.broadcast_message("msg", f"Client {session.username}: {payload}\n", REGISTRY, exclude=session)
+                        if HISTORY is not None:
+                            HISTORY.append(session.username, payload)
+                        logger.debug("Client %s: %s", session.username, payload)
 
                     elif header == "cmd":
-                        self.handle_command(payload, client_socket)
+                        self.handle_command(payload, session)
                         if payload == "disconnect":
                             break
                     
                     elif header == "file_transfer":
-                        self.handle_file_transfer(payload, client_socket, ACTIVE_USERS[self.client_address])
+                        session.receiving_file = True
+                        try:
+                            self.handle_file_transfer(payload, session)
+                        finally:
+                            session.receiving_file = False
 
                     elif header == "to":
 
                         recipient, message = payload.split(":", 1)
-                        server_utils.send_message_to_client(recipient, message, ACTIVE_USERS[self.client_address], ACTIVE_USERS, CLIENTS)
+                        if not server_utils.send_message_to_client(recipient, message, session.username, REGISTRY):
+                            session.sendall(server_utils.encode_message("info", f"Server: {recipient} is not online.\n"))
+
+                    elif header == "room":
+                        server_utils.send_room_message(payload, session, REGISTRY)
                     
                     elif header == "quiz_answer":
-                        server_utils.evaluate_quiz(payload, quiz_score_file, client_socket, ACTIVE_USERS[self.client_address], ANSWERS)
-                        pass
+                        server_utils.evaluate_quiz(payload, session, QUIZ_SESSIONS)
                         
                     else:
-                        print("Unknown header:", header)
+                        logger.debug("Unknown header: %s", header)
 
                 else:
                     invalid_message = "Server: Invalid message format. Please adhere to the message protocol.\n"
-                    client_socket.sendall(server_utils.encode_message("error", invalid_message))
+                    session.sendall(server_utils.encode_message("error", invalid_message))
 
             except Exception as e:
-                print("Error:", e)
+                logger.warning("Error: %s", e)
                 break
 
-        # Close database connection when handler exits
-        self.db_connection.close()
+        server_utils.abandon_transfers(session)
 
-if __name__ == "__main__":
+        # A dropped connection never sent cmd:disconnect
+        if REGISTRY.remove(session):
+            server_utils.broadcast_message("info", f"Server: Client {session.username} left the server.\n", REGISTRY)
 
-    # Create users table in the database if it doesn't exist
-    db_connection = sqlite3.connect('users.db')
-    cursor = db_connection.cursor()
-    cursor.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT)")
-    db_connection.commit()
-    cursor.close()
-
-    if len(sys.argv) == 1:
-        HOST = ("localhost", 10000)
-    elif len(sys.argv) == 2:
-        HOST = ("localhost", int(sys.argv[1]))
-    else:
-        HOST = (sys.argv[2], int(sys.argv[1]))
+        # Flush what is still queued for the client before the socket closes
+        session.close()
+
+    def finish(self):
+        """Stop counting the connection against the connection limits."""
+        self.server.limiter.release(self.client_address)
+
+
+def close_sessions():
+    """Flush and stop the writer of every active session.
+
+    Input Arguments:
+    - None
+
+    Output Arguments:
+    - None
+    """
+    for session in REGISTRY.sessions():
+        session.close()
+
+
+def run_console_command(message, registry):
+    """Run a server console line other than shutdown.
+
+    Input Arguments:
+    - message (str): The console line.
+    - registry (SessionRegistry): The sessions the command applies to.
+
+    Output Arguments:
+    - bool: True for one of CONSOLE_COMMANDS, False if the line was
+      broadcast as a server message.
+    """
+    if message == "stats":
+        stats = registry.queue_stats()
+        print(f"{CONSOLE_PREFIX}Sessions: {stats['sessions']}, queued frames: {stats['queued_frames']}, "
+              f"deepest queue: {stats['max_queue_depth']} ({stats['deepest_queue']}), "
+              f"dropped frames: {stats['dropped_frames']}")
+        stats = STORE.cache.stats()
+        print(f"{CONSOLE_PREFIX}Credential cache: {stats['entries']}/{stats['max_entries']} entries, "
+              f"{stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions")
+        connections, addresses, refused = LIMITER.stats()
+        print(f"{CONSOLE_PREFIX}Connections: {connections} from {addresses} addresses "
+              f"(limits: {LIMITER.max_connections or 'none'} in total, {LIMITER.max_per_ip or 'none'} per address), "
+              f"{refused} refused, {REAPER.reaped} idle sessions closed")
+        print(f"{CONSOLE_PREFIX}Rate limits: {RATE_LIMITS.delayed} frames delayed, {RATE_LIMITS.rejected} rejected, "
+              f"file transfers paused for {RATE_LIMITS.throttled_sec:.1f} seconds")
+        stats = BLOBS.stats()
+        print(f"{CONSOLE_PREFIX}Blob store: {stats['blobs']} blobs, {stats['stored_bytes']} bytes stored for "
+              f"{stats['references']} files of {stats['referenced_bytes']} bytes")
 
-    server = ThreadedTCPServer(HOST, ThreadedTCPRequestHandler)
-    server.daemon_threads = True
+    elif message.startswith("send_file:"):
+
+        # send_file:RECIPIENTS:DIRECTORY:FILE, where RECIPIENTS is all or
+        # comma separated usernames and @GROUP names.
+        _, recipient, directory_name, filename = message.split(":", 3)
+
+        if recipient == "all":
+            # Send file to all clients
+            recipients = registry.sessions()
+
+        else:
+            try:
+                usernames = GROUPS.expand(recipient)
+            except KeyError as error:
+                print(f"{CONSOLE_PREFIX}Server: No group @{error.args[0]}.")
+                return True
+            recipients = []
+            for username in usernames:
+                session = registry.get(username)
+                if session is None:
+                    print(f"{CONSOLE_PREFIX}Server: {username} is not online.")
+                else:
+                    recipients.append(session)
+
+        if recipients:
+            try:
+                fanout = server_utils.send_files_from_server(recipients, filename, directory_name, BLOBS, FANOUTS)
+            except OSError as error:
+                print(f"{CONSOLE_PREFIX}Server: Cannot send '{filename}': {error}")
+                return True
+            print(f"{CONSOLE_PREFIX}Server: Transfer {fanout.id} of '{filename}' to {len(recipients)} clients started, "
+                  f"type transfers {fanout.id} to follow it.")
+
+    elif message.startswith("Quiz"):
+        fields = message.split(":")[1:]
+        try:
+            if len(fields) == 2:
+                # Quiz:ID:SCORE_FILE starts a quiz that is already loaded.
+                quiz = QUIZZES.get(fields[0])
+                if quiz is None:
+                    raise quiz_bank.QuizError(f"no quiz {fields[0]!r}, type quizzes to list them")
+            elif len(fields) == 4:
+                quiz = QUIZZES.load(*fields[:3])
+            else:
+                raise quiz_bank.QuizError("use Quiz:DIRECTORY:QUESTIONS:ANSWERS:SCORE_FILE or Quiz:ID:SCORE_FILE")
+        except (OSError, quiz_bank.QuizError) as error:
+            print(f"{CONSOLE_PREFIX}Server: Cannot start the quiz: {error}")
+            return True
+        quiz_session = server_utils.start_quiz(quiz, fields[-1], registry, QUIZ_SESSIONS)
+        print(f"{CONSOLE_PREFIX}Server: Quiz {quiz_session.id} ({quiz.id}) started.")
+
+    elif message == "quizzes":
+        for identifier in QUIZZES.ids():
+            print(f"{CONSOLE_PREFIX}{identifier}: {len(QUIZZES.get(identifier))} questions")
+        for quiz_session in QUIZ_SESSIONS.sessions():
+            print(f"{CONSOLE_PREFIX}Quiz {quiz_session.id}: {quiz_session.quiz.id}, "
+                  f"{'open' if quiz_session.open else 'ended'}, {len(quiz_session)} answers")
+
+    elif message.startswith(("leaderboard", "end_quiz")):
+        # leaderboard [QUIZ_ID] [COUNT] shows the best scores, end_quiz QUIZ_ID
+        # stops taking answers and shows the final ones.
+        command, *arguments = message.split()
+        if not all(argument.isdigit() for argument in arguments) or \
+                (command == "end_quiz" and len(arguments) != 1) or len(arguments) > 2:
+            print(f"{CONSOLE_PREFIX}Server: Use leaderboard [QUIZ_ID] [COUNT] or end_quiz QUIZ_ID")
+            return True
+        if command == "end_quiz":
+            quiz_session = QUIZ_SESSIONS.end(int(arguments[0]))
+        elif arguments:
+            quiz_session = QUIZ_SESSIONS.get(int(arguments[0]))
+        else:
+            quiz_session = QUIZ_SESSIONS.latest()
+        if quiz_session is None:
+            print(f"{CONSOLE_PREFIX}Server: No such quiz.")
+            return True
+        count = int(arguments[1]) if len(arguments) == 2 else quiz_sessions.DEFAULT_TOP
+        print(f"{CONSOLE_PREFIX}{quiz_sessions.format_leaderboard(quiz_session, count)}", end="")
+
+    elif message.startswith("quiz_stats"):
+        # quiz_stats QUIZ_ID shows how many got each question right and which options they chose.
+        arguments = message.split()[1:]
+        quiz_session = QUIZ_SESSIONS.get(int(arguments[0])) if len(arguments) == 1 and arguments[0].isdigit() else None
+        if quiz_session is None:
+            print(f"{CONSOLE_PREFIX}Server: Use quiz_stats QUIZ_ID for a quiz that was started")
+            return True
+        print(f"{CONSOLE_PREFIX}Server: Quiz {quiz_session.id} ({quiz_session.quiz.id}), {len(quiz_session)} answers:")
+        print(quiz_session.item_statistics(), end="")
+
+    elif message.split(" ", 1)[0] == "transfers":
+        # transfers lists the recent file fan-outs, transfers ID shows every recipient of one.
+        arguments = message.split()[1:]
+        if not arguments:
+            for fanout in FANOUTS.fanouts():
+                print(f"{CONSOLE_PREFIX}{fanout.summary()}")
+        else:
+            fanout = FANOUTS.get(int(arguments[0])) if len(arguments) == 1 and arguments[0].isdigit() else None
+            if fanout is None:
+                print(f"{CONSOLE_PREFIX}Server: Use transfers [ID] for a transfer that was started")
+                return True
+            print(f"{CONSOLE_PREFIX}{fanout.format()}")
+
+    elif message == "groups" or message.startswith(("group:", "ungroup:")):
+        print(f"{CONSOLE_PREFIX}{file_fanout.group_command(message, GROUPS)}")
+
+    elif message == "rooms":
+        for name, members, kept, limit in registry.rooms.rooms():
+            print(f"{CONSOLE_PREFIX}{name}: {members} members, {kept}/{limit} messages kept")
+
+    elif message.startswith("room_history:"):
+        # room_history:ROOM:N keeps the last N messages of a room for replay.
+        _, name, limit = (message.split(":") + [""])[:3]
+        if not chat_rooms.valid_name(name) or not limit.isdigit():
+            print(f"{CONSOLE_PREFIX}Server: Use room_history:ROOM:N")
+            return True
+        registry.rooms.set_limit(name, int(limit))
+        print(f"{CONSOLE_PREFIX}Server: Room {name} keeps its last {limit} messages.")
+
+    elif message.split(":", 1)[0] == "rate_limit":
+        # rate_limit shows the limits; rate_limit:HEADER:RATE:BURST, rate_limit:file:N
+        # and rate_limit:policy:delay|reject change them for every session at once.
+        for line in RATE_LIMITS.command(message).splitlines():
+            print(f"{CONSOLE_PREFIX}{line}")
+
+    elif message == "collect_blobs":
+        # Removes stored files that no <username>/<filename> refers to any more.
+        removed, freed = BLOBS.collect()
+        print(f"{CONSOLE_PREFIX}Blob store: removed {removed} unreferenced blobs, {freed} bytes freed")
+
+    else:
+        server_utils.broadcast_message("info", f"Server: {message}\n", registry)
+        return False
+
+    return True
+
+
+def start_server(args, address, reuse_port=False, metrics_port=0):
+    """Open the databases and the password hashing pool and start serving.
+
+    Input Arguments:
+    - args (argparse.Namespace): The parsed command line.
+    - address (tuple): The (host, port) to listen on.
+    - reuse_port (bool): Bind with SO_REUSEPORT so that several worker
+      processes can listen on the same port.
+    - metrics_port (int): Port of the /metrics endpoint, 0 for none.
+
+    Output Arguments:
+    - tuple: The server and the metrics server, or None for the latter.
+    """
+    global HASHER, STORE, HISTORY, QUIZ_SESSIONS, BLOBS, LIMITER, REAPER, RATE_LIMITS
+
+    HASHER = password_hashing.Hasher(args.hash_workers, args.max_pending_auth)
+
+    # Creates the users table in the database if it doesn't exist
+    cache = user_store.CredentialCache(args.credential_cache_size, args.credential_cache_ttl)
+    STORE = user_store.UserStore('users.db', args.db_pool_size, cache)
+    if args.history:
+        HISTORY = chat_history.ChatHistory('history.db')
+    QUIZ_SESSIONS = quiz_sessions.QuizSessions()
+    BLOBS = blob_store.BlobStore()
+    removed, freed = server_utils.remove_stale_partials()
+    if removed:
+        logger.info("Removed %s abandoned partial uploads, %s bytes freed.", removed, freed)
+    LIMITER = connection_limits.ConnectionLimiter()
+    REAPER = connection_limits.IdleReaper()
+    RATE_LIMITS = rate_limits.RateLimits()
+    for directory_name in args.quiz_dir:
+        QUIZZES.load_directory(directory_name)
+
+    if args.mode == "asyncio":
+        server = async_server.AsyncChatServer(address, REGISTRY, QUIZ_SESSIONS, STORE, HASHER, BLOBS, HISTORY, reuse_port,
+                                              LIMITER, REAPER, RATE_LIMITS)
+    else:
+        ThreadedTCPServer.allow_reuse_port = reuse_port
+        ThreadedTCPServer.limiter = LIMITER
+        server = ThreadedTCPServer(address, ThreadedTCPRequestHandler)
+        server.daemon_threads = True
+
+    metrics.Gauge("chat_sessions", "Authenticated sessions.", lambda: len(REGISTRY))
+    metrics.Gauge("chat_queued_frames", "Frames waiting in outbound queues.",
+                  lambda: REGISTRY.queue_stats()["queued_frames"])
+    metrics.Gauge("chat_connections", "Open client connections, logged in or not.", lambda: LIMITER.connections)
+    metrics.Gauge("chat_credential_cache_hits_total", "Credential cache hits.", lambda: STORE.cache.hits, "counter")
+    metrics.Gauge("chat_credential_cache_misses_total", "Credential cache misses.", lambda: STORE.cache.misses, "counter")
+    metrics_server = metrics.serve(port=metrics_port) if metrics_port else None
 
     server_thread = threading.Thread(target=server.serve_forever)
 
     # Exit the server thread when the main thread terminates
     server_thread.daemon = True
     server_thread.start()
-
-    print("Server is up.")
+    return server, metrics_server
+
+
+def stop_server(server, metrics_server, registry):
+    """Tell the clients, flush their sessions and release what start_server() opened.
+
+    Input Arguments:
+    - server: The server returned by start_server().
+    - metrics_server: The metrics server returned by start_server(), or None.
+    - registry (SessionRegistry): The sessions to notify.
+
+    Output Arguments:
+    - None
+    """
+    server_utils.broadcast_message("info", "Server is shutting down.\n", registry)
+    close_sessions()
+    server.shutdown()
+    server.server_close()
+    STORE.close()
+    HASHER.close()
+    if HISTORY is not None:
+        HISTORY.close()
+    QUIZ_SESSIONS.close()
+    REAPER.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+
+
+def run_worker(index, args, port, hub_socket):
+    """Serve clients as one worker process of a --workers cluster.
+
+    Every worker listens on the same port with SO_REUSEPORT, so the kernel
+    spreads new connections over them, and reaches the sessions of the
+    other workers through the hub in the parent process.
+
+    Input Arguments:
+    - index (int): The index of this worker.
+    - args (argparse.Namespace): The parsed command line.
+    - port (int): The port to listen on.
+    - hub_socket (socket): This worker's end of the socket pair to the hub.
+
+    Output Arguments:
+    - None
+    """
+    global REGISTRY, CONSOLE_PREFIX
+
+    CONSOLE_PREFIX = f"[worker {index}] "
+    logging.basicConfig(level=args.log_level.upper(), format=f"{CONSOLE_PREFIX}%(message)s", force=True)
+
+    stopped = threading.Event()
+    # Console lines reach every worker, so they only apply to its own clients.
+    REGISTRY = cluster.ClusterRegistry(hub_socket, index, lambda message: run_console_command(message, REGISTRY.local),
+                                       stopped.set)
+    server, metrics_server = start_server(args, (args.host, port), reuse_port=True,
+                                          metrics_port=args.metrics_port + index if args.metrics_port else 0)
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    stop_server(server, metrics_server, REGISTRY.local)
+    REGISTRY.link.close()
+
+
+def run_cluster(args):
+    """Start args.workers worker processes and run the console and the hub.
+
+    Input Arguments:
+    - args (argparse.Namespace): The parsed command line.
+
+    Output Arguments:
+    - None
+    """
+    port = args.port
+    reserved = None
+    if port == 0:
+        # Every worker binds on its own, so an ephemeral port is picked
+        # here once and held until they are listening.
+        reserved = socket.socket()
+        reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        reserved.bind((args.host, 0))
+        port = reserved.getsockname()[1]
+
+    pairs = [socket.socketpair() for _ in range(args.workers)]
+    # Workers are not daemonic: each one runs its own password hashing pool.
+    workers = [multiprocessing.Process(target=run_worker, args=(index, args, port, worker_end), name=f"chat-worker-{index}")
+               for index, (_, worker_end) in enumerate(pairs)]
+    for worker in workers:
+        worker.start()
+    for _, worker_end in pairs:
+        worker_end.close()
+    hub = cluster.Hub([hub_end for hub_end, _ in pairs])
+    if reserved is not None:
+        reserved.close()
+
+    print(f"Server is up on port {port} with {args.workers} workers.")
     print("=================")
-    
+
     while True:
         try:
             message = input().strip()
+        except (KeyboardInterrupt, EOFError):
+            break
 
-            if message == "shutdown":
-                for client, _ in CLIENTS:
-                    encoded_message = server_utils.encode_message("info", "Server is shutting down.\n")
-                    client.sendall(encoded_message)
-                server.shutdown()
-                server.server_close()
-                print("Server is closed.")
-                break
+        if message == "shutdown":
+            break
+        if message == "stats":
+            print(f"Cluster: {args.workers} workers, {len(hub.directory)} users online")
+        if message == "groups" or message.startswith(("group:", "ungroup:")):
+            print(file_fanout.group_command(message, hub.groups))
+            continue
+        try:
+            offline = hub.console(message)
+        except KeyError as error:
+            print(f"Server: No group @{error.args[0]}.")
+            continue
+        for username in offline:
+            print(f"Server: {username} is not online.")
+        if not message.startswith(CONSOLE_COMMANDS):
+            print(f"Server: {message}")
+
+    hub.stop()
+    for worker in workers:
+        worker.join(session_registry.CLOSE_TIMEOUT + 5)
+        if worker.is_alive():
+            worker.terminate()
+    print("Server is closed.")
+
+
+def parse_arguments():
+    """Parse the server command line.
+
+    Input Arguments:
+    - None
+
+    Output Arguments:
+    - argparse.Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Chat, file transfer and quiz server.")
+    parser.add_argument("port", nargs="?", type=int, default=10000, help="port to listen on (default 10000)")
+    parser.add_argument("host", nargs="?", default="localhost", help="address to bind (default localhost)")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded",
+                        help="serve clients with one thread each or on a single asyncio event loop")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port with SO_REUSEPORT, each in --mode (default 1)")
+    parser.add_argument("--chunk-size", type=int, default=file_transfer.CHUNK_SIZE,
+                        help="file transfer receive chunk size in bytes (default 1 MiB)")
+    parser.add_argument("--no-relay-archive", dest="relay_archive", action="store_false",
+                        help="do not keep a server copy of files relayed between clients")
+    parser.add_argument("--partial-max-age", type=float, default=file_transfer.PARTIAL_MAX_AGE,
+                        help="seconds an unfinished upload is kept without new data, 0 to keep it forever (default 7 days)")
+    parser.add_argument("--db-pool-size", type=int, default=user_store.POOL_SIZE,
+                        help="database connections kept open for logins (default 8)")
+    parser.add_argument("--credential-cache-size", type=int, default=user_store.CACHE_SIZE,
+                        help="credentials kept in memory, 0 to disable the cache (default 10000)")
+    parser.add_argument("--credential-cache-ttl", type=float, default=user_store.CACHE_TTL,
+                        help="seconds a cached credential is trusted (default 300)")
+    parser.add_argument("--kdf", choices=["scrypt", "pbkdf2"], default=password_hashing.KDF,
+                        help="password key derivation function (default scrypt)")
+    parser.add_argument("--scrypt-n", type=int, default=password_hashing.SCRYPT_N,
+                        help="scrypt CPU/memory cost, a power of two (default 16384)")
+    parser.add_argument("--pbkdf2-iterations", type=int, default=password_hashing.PBKDF2_ITERATIONS,
+                        help="PBKDF2-HMAC-SHA256 iterations (default 600000)")
+    parser.add_argument("--hash-workers", type=int, default=None,
+                        help="password hashing worker processes (default: CPU count - 1, at least 1, "
+                             "shared out between --workers)")
+    parser.add_argument("--max-pending-auth", type=int, default=password_hashing.MAX_PENDING,
+                        help="password hashes queued or running at once (default 64)")
+    parser.add_argument("--send-queue-size", type=int, default=session_registry.SEND_QUEUE_SIZE,
+                        help="frames queued for a client before the slow client policy applies (default 1024)")
+    parser.add_argument("--slow-client-policy", choices=["drop", "disconnect"], default=session_registry.SLOW_CLIENT_POLICY,
+                        help="drop broadcast frames for a client whose queue is full, or disconnect it")
+    parser.add_argument("--coalesce-ms", type=float, default=session_registry.COALESCE_WINDOW * 1000,
+                        help="wait up to this many milliseconds to send queued frames to a client in one write (default 0, off)")
+    parser.add_argument("--coalesce-bytes", type=int, default=session_registry.COALESCE_BYTES,
+                        help="send a coalesced batch once this many bytes are pending (default 65536)")
+    parser.add_argument("--max-connections", type=int, default=connection_limits.MAX_CONNECTIONS,
+                        help="connections served at once, 0 for no limit (default 10000, per worker)")
+    parser.add_argument("--max-connections-per-ip", type=int, default=connection_limits.MAX_CONNECTIONS_PER_IP,
+                        help="connections served at once from one IP address, 0 for no limit (default 0, per worker)")
+    parser.add_argument("--auth-timeout", type=float, default=connection_limits.AUTH_TIMEOUT,
+                        help="seconds a new connection has to log in, 0 to wait forever (default 60)")
+    parser.add_argument("--idle-timeout", type=float, default=connection_limits.IDLE_TIMEOUT,
+                        help="disconnect sessions that send nothing, not even cmd:ping, for this many seconds, "
+                             "0 never (default 600)")
+    parser.add_argument("--rate-limit", action="append", default=[], type=rate_limits.parse_limit, metavar="HEADER:RATE:BURST",
+                        help="frames of a header each user may send per second, and in one burst; RATE 0 lifts the "
+                             "limit (repeatable, default msg, to and room 5:20, cmd 10:30, quiz_answer 20:50, "
+                             "file_transfer 1:5)")
+    parser.add_argument("--no-rate-limits", dest="rate_limits", action="store_false",
+                        help="do not limit the frames users send")
+    parser.add_argument("--rate-limit-policy", choices=rate_limits.POLICIES, default=rate_limits.POLICY,
+                        help="stop reading from a client over its rate limit until it is under again, or drop its "
+                             "frames with an error (default delay)")
+    parser.add_argument("--file-rate", type=int, default=rate_limits.FILE_RATE,
+                        help="file bytes per second each user may send, and receive, 0 for no limit (default 0)")
+    parser.add_argument("--no-compression", dest="compression", action="store_false",
+                        help="refuse zlib payload compression with version 2 clients")
+    parser.add_argument("--quiz-dir", action="append", default=[],
+                        help="load every NAME_ques.txt/NAME_ans.txt quiz in this directory at start-up (repeatable)")
+    parser.add_argument("--no-history", dest="history", action="store_false",
+                        help="do not log group messages to history.db")
+    parser.add_argument("--room-history", type=int, default=chat_rooms.HISTORY_LIMIT,
+                        help="messages of each chat room replayed to new members (default 50)")
+    parser.add_argument("--metrics-port", type=int, default=metrics.METRICS_PORT,
+                        help="serve Prometheus metrics on http://localhost:PORT/metrics (default off)")
+    parser.add_argument("--log-level", choices=["debug", "info", "warning", "error"], default="info",
+                        help="console log level; debug prints every message (default info)")
+    return parser.parse_args()
 
-            elif message.startswith("send_file:"):
 
-                _, recipient, directory_name, filename = message.split(":", 3)
+if __name__ == "__main__":
 
-                if recipient == "all":
-                    # Send file to all clients
-                    for client, recipient_addr in CLIENTS:
+    args = parse_arguments()
+    HOST = (args.host, args.port)
+    file_transfer.CHUNK_SIZE = args.chunk_size
+    file_transfer.RELAY_ARCHIVE = args.relay_archive
+    file_transfer.PARTIAL_MAX_AGE = args.partial_max_age
+    framing.COMPRESSION = args.compression
+    session_registry.SEND_QUEUE_SIZE = args.send_queue_size
+    session_registry.SLOW_CLIENT_POLICY = args.slow_client_policy
+    session_registry.COALESCE_WINDOW = args.coalesce_ms / 1000
+    session_registry.COALESCE_BYTES = args.coalesce_bytes
+    chat_rooms.HISTORY_LIMIT = args.room_history
+    connection_limits.MAX_CONNECTIONS = args.max_connections
+    connection_limits.MAX_CONNECTIONS_PER_IP = args.max_connections_per_ip
+    connection_limits.AUTH_TIMEOUT = args.auth_timeout
+    connection_limits.IDLE_TIMEOUT = args.idle_timeout
+    if not args.rate_limits:
+        rate_limits.HEADER_RATES = {}
+    for header, rate, burst in args.rate_limit:
+        if rate:
+            rate_limits.HEADER_RATES[header] = (rate, burst)
+        else:
+            rate_limits.HEADER_RATES.pop(header, None)
+    rate_limits.POLICY = args.rate_limit_policy
+    rate_limits.FILE_RATE = args.file_rate
 
-                        recipient_name = ACTIVE_USERS[recipient_addr]
+    logging.basicConfig(level=args.log_level.upper(), format="%(message)s")
 
-                        encoded_message = server_utils.encode_message("file_transfer", f"file from server:{filename}\n")
-                        client.sendall(encoded_message)
+    password_hashing.KDF = args.kdf
+    password_hashing.SCRYPT_N = args.scrypt_n
+    password_hashing.PBKDF2_ITERATIONS = args.pbkdf2_iterations
 
-                        server_utils.send_files_from_server(recipient_name, filename, directory_name, ACTIVE_USERS, CLIENTS)
+    if args.workers > 1:
+        if args.hash_workers is None:
+            # Share the cores between the workers' hashing pools.
+            args.hash_workers = max(1, password_hashing.WORKERS // args.workers)
+        run_cluster(args)
+        raise SystemExit
 
-                else:
-                    # Send file to a particular client
-                    recipient_addr = list(ACTIVE_USERS.keys())[list(ACTIVE_USERS.values()).index(recipient)]
-                    
-                    for client, address in CLIENTS:
-                        if address[0] == recipient_addr[0] and address[1] == recipient_addr[1]:
+    server, metrics_server = start_server(args, HOST, metrics_port=args.metrics_port)
 
-                            encoded_message = server_utils.encode_message("file_transfer", f"file from server:{filename}\n")
-                            client.sendall(encoded_message)
-                            
-                            server_utils.send_files_from_server(recipient, filename, directory_name, ACTIVE_USERS, CLIENTS)
-                            break
-            
-            elif message.startswith("Quiz"):
-                directory_name, filename, answer_file, quiz_score_file = message.split(":")[1:]
-                ANSWERS = server_utils.start_quiz(directory_name, filename, answer_file, CLIENTS)
+    print("Server is up.")
+    print("=================")
+    
+    while True:
+        try:
+            message = input().strip()
 
-            else:
-                server_utils.broadcast_message("info", f"Server: {message}\n", CLIENTS)
+            if message == "shutdown":
+                stop_server(server, metrics_server, REGISTRY)
+                print("Server is closed.")
+                break
+
+            if not run_console_command(message, REGISTRY):
                 print(f"Server: {message}")
 
         except KeyboardInterrupt:
 
-            for client, _ in CLIENTS:
-                encoded_message = server_utils.encode_message("info", "Server is shutting down.\n")
-                client.sendall(encoded_message)
-
-            server.shutdown()
-            server.server_close()
+            stop_server(server, metrics_server, REGISTRY)
             print("Server is closed.")
             break
@@ -1,39 +1,64 @@
-import struct
+import contextlib
+import functools
+import glob
+import itertools
+import logging
 import os
+import queue
+import time
+import framing
+import file_transfer
+import metrics
+import chat_history
+import chat_rooms
+import mux_transfers
+import quiz_sessions
+
+# Headers a client may send, as a set so validation is a hash lookup.
+VALID_HEADERS = frozenset(["msg", "cmd", "to", "room", "info", "file_transfer", "quiz_answer", "quiz_question",
+                           mux_transfers.CHUNK_HEADER])
+
+logger = logging.getLogger("chat")
 
 def encode_message(header, message):
     """Encode a message with a header and payload length.
 
     Input Arguments:
     - header (str): The message header.
-    - message (str): The message payload.
+    - message (str or bytes): The message payload.
 
     Output Arguments:
     - bytes: Encoded message.
     """
-    header_length = len(header).to_bytes(2, byteorder="big")
-    payload_length = len(message).to_bytes(4, byteorder="big")
-    return header_length + header.encode() + payload_length + message.encode()
+    return framing.encode_message(header, message)
 
 
-def decode_message(client_socket):
+def decode_message(client_socket, decode=True):
     """Decode a message from a client socket.
 
+    Frames are read through the socket's buffered FrameReader, so partial
+    reads are reassembled and several queued frames cost a single recv.
+
     Input Arguments:
     - client_socket (socket): The client socket.
+    - decode (bool): Decode the payload to str; pass False to get the raw bytes.
 
     Output Arguments:
     - tuple: A tuple containing header and payload.
     """
-    header_length = client_socket.recv(2)
-    header_length = struct.unpack("!H", header_length)[0]
-    header = client_socket.recv(header_length).decode()
+    return framing.reader_for(client_socket).read_frame(decode)
 
-    payload_length = client_socket.recv(4)
-    payload_length = struct.unpack("!I", payload_length)[0]
-    payload = client_socket.recv(payload_length).decode()
 
-    return header, payload
+def negotiate(payload):
+    """Choose the frame format for a client's hello.
+
+    Input Arguments:
+    - payload (str): The hello payload, e.g. "2 zlib".
+
+    Output Arguments:
+    - framing.Codec: The format to use from the next frame on.
+    """
+    return framing.Codec.from_hello(payload, framing.COMPRESSION)
 
 
 def validate_message(header):
@@ -45,278 +70,747 @@ def validate_message(header):
     Output Arguments:
     - bool: True if the header is valid, False otherwise.
     """
-    return header in ["msg", "cmd", "to", "info", "file_transfer", "quiz_answer", "quiz_question"]
+    return header in VALID_HEADERS
+
+
+def admit_frame(header, session):
+    """Apply the sender's rate limit to a frame it sent.
+
+    Input Arguments:
+    - header (str): The frame header.
+    - session (Session): The session of the sender.
+
+    Output Arguments:
+    - float: Seconds to stop reading from the client before handling the
+      frame, 0 to handle it now, or None to drop it. The client gets an
+      error frame for the first frame dropped in a row.
+    """
+    if session.rate_limits is None:
+        return 0.0
+    wait = session.rate_limits.check(header)
+    if wait is None and session.rate_limits.warn(header):
+        session.sendall(encode_message("error", f"Server: Too many {header} frames, they are dropped until you slow down.\n"))
+    return wait
+
 
+def file_throttle(session, direction):
+    """Return what shapes the file bytes a session sends ("upload") or receives ("download"), or None."""
+    if session.rate_limits is None:
+        return None
+    return getattr(session.rate_limits, direction)
 
-def broadcast_message(header, message, CLIENTS, exclude_client=None):
+
+def broadcast_message(header, message, registry, exclude=None):
     """Broadcast a message to all clients except the excluded one.
 
+    The frame is encoded once and appended to every recipient's outbound
+    queue, so the caller never waits on a slow client.
+
     Input Arguments:
     - header (str): The message header.
     - message (str): The message to broadcast.
-    - CLIENTS (list): List of client sockets and addresses.
-    - exclude_client (socket): The client socket to exclude from broadcasting.
+    - registry (SessionRegistry): The active sessions.
+    - exclude (Session): The session to exclude from broadcasting.
 
     Output Arguments:
     - None
     """
     encoded_message = encode_message(header, message)
-    for client, _ in CLIENTS:
-        if client is not exclude_client:
-            client.sendall(encoded_message)
+    with metrics.BROADCAST_SECONDS.time():
+        registry.broadcast(encoded_message, exclude)
 
 
-def send_message_to_client(recipient_name, message, sender, ACTIVE_USERS, CLIENTS):
+def send_message_to_client(recipient_name, message, sender, registry):
     """Send a message to a specific client.
 
     Input Arguments:
     - recipient_name (str): The username of the recipient.
     - message (str): The message to send.
     - sender (str): The username of the sender.
-    - ACTIVE_USERS (dict): Dictionary of active users and their addresses.
-    - CLIENTS (list): List of client sockets and addresses.
+    - registry (SessionRegistry): The active sessions.
+
+    Output Arguments:
+    - bool: False if the recipient is not logged in.
+    """
+    recipient = registry.get(recipient_name)
+    if recipient is None:
+        return False
+
+    encoded_message = encode_message("info", f"{sender} (private): {message}\n")
+    recipient.sendall(encoded_message)
+    return True
+
+
+def room_command(payload, session, registry):
+    """Join or leave a chat room, or list the rooms of a client.
+
+    The command is "join:ROOM", "leave:ROOM" or "rooms". Joining replays
+    the room's latest messages from the frames kept for it, and the other
+    members are told who joined or left.
+
+    Input Arguments:
+    - payload (str): The cmd payload.
+    - session (Session): The session of the client.
+    - registry (SessionRegistry): The active sessions and their rooms.
 
     Output Arguments:
     - None
     """
-    recipient_addr = list(ACTIVE_USERS.keys())[list(ACTIVE_USERS.values()).index(recipient_name)]
-    for client, address in CLIENTS:
-        if address[0] == recipient_addr[0]:
-            encoded_message = encode_message("info", f"{sender} (private): {message}\n")
-            client.sendall(encoded_message)
+    command, _, name = payload.partition(":")
+    if command == "rooms" and not name:
+        rooms = registry.rooms.rooms_of(session)
+        message = f"Server: Your rooms: {', '.join(rooms)}\n" if rooms else "Server: You are not in any room.\n"
+        session.sendall(encode_message("info", message))
+        return
+    if not chat_rooms.valid_name(name):
+        session.sendall(encode_message("info", chat_rooms.USAGE))
+        return
+
+    if command == "leave":
+        if not registry.rooms.leave(session, name):
+            session.sendall(encode_message("info", f"Server: You are not in room {name}.\n"))
+            return
+        session.sendall(encode_message("info", f"Server: You left room {name}.\n"))
+        registry.publish(name, encode_message("info", f"Server: {session.username} left room {name}.\n"))
+        return
+
+    try:
+        replay = registry.rooms.join(session, name)
+    except ValueError as error:
+        session.sendall(encode_message("error", f"Server: Cannot join room {name}: {error}.\n"))
+        return
+    if replay is None:
+        session.sendall(encode_message("info", f"Server: You are already in room {name}.\n"))
+        return
+    session.sendall(encode_message("info", f"Server: You joined room {name}.\n"))
+    for frame in replay:
+        session.sendall(frame)
+    registry.publish(name, encode_message("info", f"Server: {session.username} joined room {name}.\n"), exclude=session)
+
+
+def send_room_message(payload, sender, registry):
+    """Send a message to the members of a chat room.
+
+    The frame is encoded once, queued for each member of the room rather
+    than for every client, and kept for replay to later members.
 
+    Input Arguments:
+    - payload (str): The room payload, "ROOM:message".
+    - sender (Session): The session of the sender, who must be in the room.
+    - registry (SessionRegistry): The active sessions and their rooms.
 
-def send_file_to_client(recipient_name, filename, sender_socket, username, ACTIVE_USERS, CLIENTS):
+    Output Arguments:
+    - None
+    """
+    name, separator, message = payload.partition(":")
+    if not separator or not chat_rooms.valid_name(name):
+        sender.sendall(encode_message("info", chat_rooms.USAGE))
+        return
+    if not registry.rooms.is_member(sender, name):
+        sender.sendall(encode_message("info", f"Server: You are not in room {name}, join it with cmd:join:{name}.\n"))
+        return
+
+    encoded_message = encode_message("msg", f"[{name}] Client {sender.username}: {message}\n")
+    with metrics.BROADCAST_SECONDS.time():
+        registry.publish(name, encoded_message, exclude=sender, record=True)
+
+
+def store_entry(blobs, digest, username, filename):
+    """Make <username>/<filename> on the server a reference to a stored blob.
+
+    Input Arguments:
+    - blobs (BlobStore): The blob store.
+    - digest (str): The hex digest of the blob.
+    - username (str): The user the file belongs to.
+    - filename (str): The name of the file.
+
+    Output Arguments:
+    - None
+    """
+    blobs.link(digest, os.path.join(os.getcwd(), username, filename))
+
+
+def archive_writer(blobs):
+    """Return a blob writer for the server copy of a relayed file, or a null context without one."""
+    return blobs.writer() if file_transfer.RELAY_ARCHIVE else contextlib.nullcontext()
+
+
+def send_file_to_client(recipient_name, filename, sender, registry, blobs):
     """Send a file to a specific client.
 
     Input Arguments:
     - recipient_name (str): The username of the recipient.
     - filename (str): The name of the file to send.
-    - sender_socket (socket): The socket of the sender.
-    - username (str): The username of the sender.
-    - ACTIVE_USERS (dict): Dictionary of active users and their addresses.
-    - CLIENTS (list): List of client sockets and addresses.
+    - sender (Session): The session of the sender.
+    - registry (SessionRegistry): The active sessions.
+    - blobs (BlobStore): Where the server copy is kept.
 
     Output Arguments:
     - None
     """
-    recipient_addr = list(ACTIVE_USERS.keys())[list(ACTIVE_USERS.values()).index(recipient_name)]
+    recipient = registry.get(recipient_name)
+
+    with archive_writer(blobs) as archive:
+        if recipient is None:
+            # The body is already on its way, so it still has to be consumed.
+            file_transfer.relay_file_body(sender.client, None, archive, throttle=file_throttle(sender, "upload"))
+        else:
+            # The recipient's writer runs write_chunks as one job, so nothing else
+            # is written to its socket until the whole body has gone out.
+            chunks = queue.Queue(file_transfer.RELAY_QUEUE_DEPTH)
+            delivered = recipient.run(functools.partial(file_transfer.write_chunks, chunks))
+            chunks.put(recipient.codec.wire(encode_message("file_transfer", f"file_to:{sender.username}:{filename}\n")))
+
+            # Chunks are forwarded to the recipient as they arrive instead
+            # of after the whole upload has been written to disk.
+            file_transfer.relay_file_body(sender.client, chunks, archive, throttle=file_throttle(sender, "upload"))
+
+        if archive is not None:
+            store_entry(blobs, archive.commit(), sender.username, filename)
+
+    if recipient is None:
+        sender.sendall(encode_message("info", f"Server: {recipient_name} is not online, file '{filename}' was not delivered.\n"))
+        return
+
+    try:
+        recipient.record_sent(delivered.result())
+    except OSError:
+        sender.sendall(encode_message("info", f"Server: File '{filename}' could not be delivered to {recipient_name}\n"))
+        return
+
+    encoded_message = encode_message("info", f"Server: File '{filename}' sent to {recipient_name}\n")
+    sender.sendall(encoded_message)
+
+
+def push_file(recipient, file_path, blob, filename, offset=0, progress=None, sender=None):
+    """Queue a file stored on the server for a client.
+
+    A client that agreed on resumable transfers gets the transfer id and
+    offset in the header and a resumable body, so it can ask for the rest
+    with resume_download if the connection drops. The body is sent from
+    the mapped blob, which any number of pushes can share; on sessions
+    that take coroutine jobs it is streamed by the writer task itself
+    rather than on a worker thread. A client that agreed on chunked
+    transfers gets the file as chunk frames between its other frames
+    instead (see mux_transfers.push()).
+
+    Input Arguments:
+    - recipient (Session): The session of the recipient.
+    - file_path (str): The file on the server, which the transfer id is for.
+    - blob (blob_store.Blob): Its contents.
+    - filename (str): The name the client stores it under.
+    - offset (int): The number of bytes the client already has.
+    - progress (callable): Called with the size of every slice sent.
+    - sender (str): The user who sent the file, for a relayed file; it is
+      then sent as a relay, which cannot be resumed.
+
+    Output Arguments:
+    - Future: Resolves to the number of bytes sent.
+    """
+    throttle = file_throttle(recipient, "download")
+    if recipient.codec.mux and recipient.local:
+        return mux_transfers.push(recipient, blob, filename, sender or "Server", progress, throttle)
+
+    resumable = recipient.codec.resume and sender is None
+    if sender is not None:
+        header = f"file_to:{sender}:{filename}\n"
+        offset = 0
+    elif resumable:
+        header = f"file from server:{filename}:{file_transfer.OUTGOING.add(file_path)}:{offset}\n"
+    else:
+        header = f"file from server:{filename}\n"
+
+    frame = recipient.codec.wire(encode_message("file_transfer", header))
+    digest = bytes.fromhex(blob.digest) if resumable else None
+
+    # Both run on the recipient's writer so the body is not interleaved
+    # with other frames.
+    if recipient.coroutine_jobs:
+        async def stream(writer):
+            writer.write(frame)
+            return await file_transfer.send_mapped_body_async(writer, blob.view, offset, digest, progress=progress,
+                                                                throttle=throttle)
+
+        return recipient.run_async(stream)
+
+    def send(client):
+        client.sendall(frame)
+        return file_transfer.send_mapped_body(client, blob.view, offset, digest, progress=progress, throttle=throttle)
+
+    return recipient.run(send)
+
+
+def send_files_from_server(recipients, filename, directory_name, blobs, fanouts):
+    """Send a file stored on the server to any number of clients at once.
+
+    The file is added to the blob store (read at most once, and not at all
+    if it has not changed since it was last sent) and mapped once. Every
+    recipient's writer then streams from that mapping at the same time, so
+    a push to many clients takes about as long as the network needs, and a
+    slow or broken recipient only holds up its own transfer. Returns as
+    soon as the transfers are queued; the console prints a line when the
+    last one is done and the transfers command shows the progress.
+
+    Input Arguments:
+    - recipients (list): The sessions of the recipients.
+    - filename (str): The name of the file to send.
+    - directory_name (str): The name of the directory containing the file.
+    - blobs (BlobStore): The blob store the file is sent from.
+    - fanouts (Fanouts): Where the progress of every recipient is kept.
+
+    Output Arguments:
+    - Fanout: The progress of the transfers. Raises OSError if the file
+      cannot be read.
+    """
+    file_path = os.path.join(os.getcwd(), directory_name, filename)
+    blob = blobs.open(blobs.add_file(file_path))
+    fanout = fanouts.start(filename, blob.size, [session.username for session in recipients])
+
+    for session in recipients:
+        progress = fanout.recipients[session.username]
+        transfer = push_file(session, file_path, blob, filename, progress=progress.add)
+        transfer.add_done_callback(functools.partial(_file_sent, fanout, session))
+    return fanout
+
 
-    for client, address in CLIENTS:
+def _file_sent(fanout, session, transfer):
+    """Record the end of one transfer of a fan-out and tell the client."""
+    error = transfer.exception()
+    if error is None:
+        session.record_sent(transfer.result())
+        session.sendall(encode_message("info", f"Server: File '{fanout.filename}' sent to {session.username}\n"))
+    else:
+        logger.warning("Server: File '%s' could not be sent to %s: %s", fanout.filename, session.username, error)
+    if fanout.finish(session.username, error):
+        logger.info("Server: %s", fanout.summary())
 
-        if address[0] == recipient_addr[0] and address[1] == recipient_addr[1]:
 
-            encoded_message = encode_message("file_transfer", f"file_to:{username}:{filename}\n")
-            client.sendall(encoded_message)
+def resume_download(payload, session, blobs):
+    """Send the rest of a file a client did not finish receiving.
 
-            directory_name = username
+    The request is "resume_download:TRANSFER_ID:OFFSET". The handler does
+    not wait for the transfer.
 
-            file_path = os.path.join(os.getcwd(), directory_name, filename)
+    Input Arguments:
+    - payload (str): The file_transfer payload.
+    - session (Session): The session of the client.
+    - blobs (BlobStore): The blob store the file is sent from.
+
+    Output Arguments:
+    - None
+    """
+    try:
+        _, identifier, offset = payload.strip().split(":")
+        offset = int(offset)
+    except ValueError:
+        session.sendall(encode_message("error", "Server: Usage: file_transfer:resume_download:TRANSFER_ID:OFFSET\n"))
+        return
 
-            if not os.path.exists(directory_name):
-                os.makedirs(directory_name)
+    file_path = file_transfer.OUTGOING.get(identifier)
+    if file_path is None:
+        session.sendall(encode_message("info", f"Server: Download {identifier} cannot be resumed, ask for the file again.\n"))
+        return
 
-            with open(file_path, "wb") as file:
-                while True:
-                    data = sender_socket.recv(1024)
-                    if not data:
-                        break
-                    if data.endswith(b'EOF'):  # Check for end of file marker
-                        file.write(data[:-3])  # Write all data except the EOF marker
-                        break
-                    file.write(data)
+    def finished(future):
+        if future.exception() is None:
+            session.record_sent(future.result())
 
-            with open(file_path, "rb") as file:
-                while True:
-                    data = file.read(1024)
-                    if not data:
-                        break
-                    if data.endswith(b'EOF'):  # Check for end of file marker
-                        client.sendall(data)  
-                        break
-                    client.sendall(data)
-                client.sendall(b'EOF')  # Send end of file marker
+    blob = blobs.open(blobs.add_file(file_path))
+    push_file(session, file_path, blob, os.path.basename(file_path), offset).add_done_callback(finished)
 
-            encoded_message = encode_message("info", f"Server: File '{filename}' sent to {recipient_name}\n")
-            sender_socket.sendall(encoded_message)
 
+def start_transfer(payload, session, registry, blobs):
+    """Accept a file a client announces with send:ID:SIZE:TARGET:FILENAME.
 
-def send_files_from_server(recipient_name, filename, directory_name, ACTIVE_USERS, CLIENTS):
-    """Send files from the server to a specific client.
+    The client waits for accept:ID before it sends the chunk frames, or
+    gives up on refused:ID:REASON.
 
     Input Arguments:
-    - recipient_name (str): The username of the recipient.
-    - filename (str): The name of the file to send.
-    - directory_name (str): The name of the directory containing the file.
-    - ACTIVE_USERS (dict): Dictionary of active users and their addresses.
-    - CLIENTS (list): List of client sockets and addresses.
+    - payload (str): The file_transfer payload.
+    - session (Session): The session of the client sending the file.
+    - registry (SessionRegistry): The active sessions.
+    - blobs (BlobStore): Where the file is received into.
 
     Output Arguments:
     - None
     """
-    recipient_addr = list(ACTIVE_USERS.keys())[list(ACTIVE_USERS.values()).index(recipient_name)]
-    
-    for client, address in CLIENTS:
-
-        if address[0] == recipient_addr[0] and address[1] == recipient_addr[1]:
-
-            directory_name = directory_name
-            file_path = os.path.join(os.getcwd(), directory_name, filename)
-            
-            with open(file_path, "rb") as file:
-                while True:
-                    data = file.read(1024)
-                    if not data:
-                        break
-                    if data.endswith(b'EOF'):  # Check for end of file marker
-                        client.sendall(data)  
-                        break
-                    client.sendall(data)
-                client.sendall(b'EOF')  # Send end of file marker
-
-            print(f"Server: File '{filename}' sent to {recipient_name}\n")
-            encoded_message = encode_message("info", f"Server: File '{filename}' sent to {recipient_name}\n")
-            client.sendall(encoded_message)
-
-
-def upload_file_from_client(filename, username, client_socket, CLIENTS):
-    """Upload a file from a client to the server.
+    try:
+        identifier, size, target, filename = mux_transfers.parse_send(payload)
+    except ValueError:
+        session.sendall(encode_message("error", f"Server: Invalid transfer request: {payload}\n"))
+        return
+
+    reason = None
+    if identifier in session.transfers:
+        reason = "transfer id in use"
+    elif len(session.transfers) >= mux_transfers.MAX_INCOMING:
+        reason = f"at most {mux_transfers.MAX_INCOMING} transfers at once"
+    elif target != "server" and registry.get(target) is None:
+        reason = f"{target} is not online"
+    if reason is not None:
+        session.sendall(encode_message("file_transfer", f"refused:{identifier}:{reason}\n"))
+        return
+
+    session.transfers[identifier] = mux_transfers.IncomingTransfer(identifier, size, target, filename, blobs.writer())
+    session.sendall(encode_message("file_transfer", f"accept:{identifier}\n"))
+
+
+def receive_chunk(payload, session):
+    """Write the data of a chunk frame to the transfer it belongs to.
 
     Input Arguments:
-    - filename (str): The name of the file to upload.
-    - username (str): The username of the client uploading the file.
-    - client_socket (socket): The socket of the client.
-    - CLIENTS (list): List of client sockets and addresses.
+    - payload (bytes): The chunk frame payload.
+    - session (Session): The session of the client sending the file.
+
+    Output Arguments:
+    - float: Seconds to stop reading from the client, which shapes the
+      file bandwidth of the user.
+    """
+    try:
+        identifier, data = mux_transfers.parse_chunk(payload)
+        transfer = session.transfers.get(identifier)
+        if transfer is None:
+            raise ValueError(f"no transfer {identifier}")
+        try:
+            mux_transfers.receive(transfer, data)
+        except ValueError:
+            del session.transfers[identifier]
+            transfer.blob.close()
+            raise
+    except ValueError as error:
+        session.sendall(encode_message("error", f"Server: Chunk dropped: {error}\n"))
+        return 0.0
+    throttle = file_throttle(session, "upload")
+    return throttle(len(data)) if throttle is not None else 0.0
+
+
+def finish_transfer(payload, session, registry, blobs):
+    """Store a file a client has sent as chunk frames, see start_transfer().
+
+    The payload is "sent:ID:DIGEST". An upload is stored under the
+    sender's directory; a file for another client is stored (kept as the
+    relay archive unless --no-relay-archive) and then pushed to it.
+
+    Input Arguments:
+    - payload (str): The file_transfer payload.
+    - session (Session): The session of the client sending the file.
+    - registry (SessionRegistry): The active sessions.
+    - blobs (BlobStore): The blob store the file is kept in.
 
     Output Arguments:
     - None
     """
-    directory_name = username
+    _, identifier, digest = (payload.strip().split(":") + ["", ""])[:3]
+    transfer = session.transfers.pop(identifier, None)
+    if transfer is None:
+        session.sendall(encode_message("error", f"Server: No transfer {identifier}\n"))
+        return
+
+    with transfer.blob:
+        try:
+            mux_transfers.complete(transfer, digest)
+        except ValueError as error:
+            session.sendall(encode_message("file_transfer", f"failed:{identifier}:{error}\n"))
+            return
+    session.record_received(transfer.size)
+    session.sendall(encode_message("file_transfer", f"done:{identifier}\n"))
+
+    if transfer.target == "server":
+        store_entry(blobs, transfer.blob.digest, session.username, transfer.filename)
+        broadcast_message("info", f"Server: File '{transfer.filename}' uploaded by {session.username}\n", registry)
+        return
+
+    if file_transfer.RELAY_ARCHIVE:
+        store_entry(blobs, transfer.blob.digest, session.username, transfer.filename)
+    recipient = registry.get(transfer.target)
+    if recipient is None:
+        session.sendall(encode_message("info", f"Server: {transfer.target} is not online, file '{transfer.filename}' was not delivered.\n"))
+        return
+
+    def delivered(future):
+        if future.exception() is not None:
+            session.sendall(encode_message("info", f"Server: File '{transfer.filename}' could not be delivered to {transfer.target}\n"))
+            return
+        recipient.record_sent(future.result())
+        session.sendall(encode_message("info", f"Server: File '{transfer.filename}' sent to {transfer.target}\n"))
+
+    blob = blobs.open(transfer.blob.digest)
+    push_file(recipient, blobs.path(blob.digest), blob, transfer.filename, sender=session.username).add_done_callback(delivered)
+
+
+def abandon_transfers(session):
+    """Discard the files a client was still sending as chunk frames when it left."""
+    for transfer in session.transfers.values():
+        transfer.blob.close()
+    session.transfers.clear()
+
+
+def partial_upload(payload, sender):
+    """Find where a resumable upload continues from.
 
-    file_path = os.path.join(os.getcwd(), directory_name, filename)
+    Input Arguments:
+    - payload (str): "upload:TRANSFER_ID:SIZE:FILENAME".
+    - sender (Session): The session of the client uploading the file.
 
-    if not os.path.exists(directory_name):
-        os.makedirs(directory_name)
+    Output Arguments:
+    - tuple: The transfer id, the file name, the partial file and the
+      number of bytes it already holds. Raises ValueError for a malformed
+      request.
+    """
+    _, identifier, size, filename = payload.strip().split(":", 3)
+    size = int(size)
+    if len(identifier) != 16 or not all(digit in "0123456789abcdef" for digit in identifier) or not filename:
+        raise ValueError(payload)
+
+    remove_stale_partials(sender.username)
+    directory_name = os.path.join(sender.username, file_transfer.PARTIAL_DIRECTORY)
+    os.makedirs(directory_name, exist_ok=True)
+    partial_path = os.path.join(os.getcwd(), directory_name, identifier)
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    if offset > size:
+        offset = 0
+    return identifier, filename, partial_path, offset
 
-    with open(file_path, "wb") as file:
-        while True:
-            data = client_socket.recv(1024)
-            if not data:
-                break
-            if data.endswith(b'EOF'):  # Check for end of file marker
-                    file.write(data[:-3])  # Write all data except the EOF marker
-                    break
-            file.write(data)
 
-    broadcast_message("info", f"Server: File '{filename}' uploaded by {username}\n", CLIENTS)
+def remove_stale_partials(username=None):
+    """Remove partial uploads that got no new data for file_transfer.PARTIAL_MAX_AGE seconds.
 
+    Input Arguments:
+    - username (str): Only look at the partial uploads of this user; all
+      users' by default.
 
-def read_quiz_questions(directory_name, filename, answer_file):
-    """Read quiz questions and answers from files.
+    Output Arguments:
+    - tuple: The number of partial uploads removed and the bytes freed.
+    """
+    removed = freed = 0
+    if not file_transfer.PARTIAL_MAX_AGE:
+        return removed, freed
+    cutoff = time.time() - file_transfer.PARTIAL_MAX_AGE
+    user_pattern = glob.escape(username) if username is not None else "*"
+    for path in glob.glob(os.path.join(user_pattern, file_transfer.PARTIAL_DIRECTORY, "*")):
+        try:
+            status = os.stat(path)
+            if status.st_mtime >= cutoff:
+                continue
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        removed += 1
+        freed += status.st_size
+    return removed, freed
+
+
+def finish_upload(filename, partial_path, sender, registry, blobs, digest=None, error=None):
+    """Move a complete upload into the blob store, or discard one that failed its digest.
 
     Input Arguments:
-    - directory_name (str): The name of the directory containing the files.
-    - filename (str): The name of the file containing quiz questions.
-    - answer_file (str): The name of the file containing quiz answers.
+    - filename (str): The name of the uploaded file.
+    - partial_path (str): The partial file it was received into.
+    - sender (Session): The session of the client that uploaded it.
+    - registry (SessionRegistry): The active sessions.
+    - blobs (BlobStore): The blob store.
+    - digest (str): The hex digest of the complete file.
+    - error (IntegrityError): Set when the digest did not match.
 
     Output Arguments:
-    - tuple: A tuple containing quiz questions, options, and answers.
+    - None
     """
-    quiz_questions = []
-    quiz_options = []
+    if error is not None:
+        os.remove(partial_path)
+        sender.sendall(encode_message("error", f"Server: File '{filename}' failed its integrity check and was discarded, "
+                                               f"send it again.\n"))
+        return
 
-    file_path = os.path.join(os.getcwd(), directory_name, filename)
+    blobs.adopt(partial_path, digest)
+    store_entry(blobs, digest, sender.username, filename)
+    broadcast_message("info", f"Server: File '{filename}' uploaded by {sender.username}\n", registry)
+
+
+def resume_upload(payload, sender, registry, blobs):
+    """Receive a resumable upload from a client.
 
-    with open(file_path, 'r') as file:
+    The client announces the upload with "upload:TRANSFER_ID:SIZE:FILENAME"
+    and waits for the offset the server already has; the body then carries
+    only the rest, followed by the digest of the whole file. A dropped
+    connection leaves the partial file for the next attempt.
 
-        lines = file.readlines()
-        question = ""
-        options = []
-        for line in lines:
-            line = line.strip()
-            if line:
-                if line.startswith("a.") or line.startswith("b.") or line.startswith("c.") or line.startswith("d."):
-                    options.append(line)
-                else:
-                    if question:
-                        quiz_questions.append(question)
-                        quiz_options.append(options)
-                        question = ""
-                        options = []
-                    question = line
-        if question:
-            quiz_questions.append(question)
-            quiz_options.append(options)
+    Input Arguments:
+    - payload (str): The file_transfer payload.
+    - sender (Session): The session of the client uploading the file.
+    - registry (SessionRegistry): The active sessions.
+    - blobs (BlobStore): The blob store the file is kept in.
+
+    Output Arguments:
+    - None
+    """
+    try:
+        identifier, filename, partial_path, offset = partial_upload(payload, sender)
+    except ValueError:
+        sender.sendall(encode_message("error", f"Server: Invalid upload request: {payload}\n"))
+        return
+
+    sender.sendall(encode_message("file_transfer", f"offset:{identifier}:{offset}\n"))
+
+    digest = error = None
+    with open(partial_path, "r+b" if offset else "w+b") as file:
+        try:
+            received, digest = file_transfer.receive_resumable_body(sender.client, file, offset,
+                                                                     throttle=file_throttle(sender, "upload"))
+            sender.record_received(received)
+        except file_transfer.IntegrityError as exception:
+            error = exception
+    finish_upload(filename, partial_path, sender, registry, blobs, digest, error)
+
+
+def upload_file_from_client(filename, sender, registry, blobs):
+    """Upload a file from a client to the server.
+
+    The file is received into the blob store and stored under the sender's
+    directory as a reference to it.
+
+    Input Arguments:
+    - filename (str): The name of the file to upload.
+    - sender (Session): The session of the client uploading the file.
+    - registry (SessionRegistry): The active sessions.
+    - blobs (BlobStore): The blob store the file is kept in.
 
-    file_path = os.path.join(os.getcwd(), directory_name, answer_file)
+    Output Arguments:
+    - None
+    """
+    with blobs.writer() as blob:
+        file_transfer.receive_file_body(sender.client, blob, throttle=file_throttle(sender, "upload"))
+        store_entry(blobs, blob.commit(), sender.username, filename)
 
-    with open(file_path, 'r') as file:
-        answers = file.read().strip().split()
+    broadcast_message("info", f"Server: File '{filename}' uploaded by {sender.username}\n", registry)
 
-    return quiz_questions, quiz_options, answers
 
+def send_history(payload, session, history):
+    """Replay logged group messages to a client.
 
-def start_quiz(directory_name, filename, answer_file, CLIENTS):
-    """Start a quiz by sending questions to clients.
+    The request is "history", "history COUNT" or "history FROM [TO]". The
+    replay runs on the client's writer, one frame per page read from the
+    log, so it never holds more than a page in memory and is not
+    interleaved with other frames.
 
     Input Arguments:
-    - directory_name (str): The name of the directory containing the quiz files.
-    - filename (str): The name of the file containing quiz questions.
-    - answer_file (str): The name of the file containing quiz answers.
-    - CLIENTS (list): List of client sockets and addresses.
+    - payload (str): The cmd payload.
+    - session (Session): The session of the requesting client.
+    - history (ChatHistory): The message log, or None when disabled.
 
     Output Arguments:
-    - list: List of correct answers.
+    - None
     """
-    quiz_questions, quiz_options, answers = read_quiz_questions(directory_name, filename, answer_file)
+    if history is None:
+        session.sendall(encode_message("info", "Server: Chat history is disabled.\n"))
+        return
+
+    arguments = payload.split()[1:]
+    try:
+        if not arguments:
+            request = {"count": chat_history.DEFAULT_COUNT}
+        elif len(arguments) == 1 and arguments[0].isdigit():
+            request = {"count": int(arguments[0])}
+        elif len(arguments) <= 2:
+            request = {"start": chat_history.parse_time(arguments[0]),
+                       "end": chat_history.parse_time(arguments[1]) if len(arguments) == 2 else None}
+        else:
+            raise ValueError(payload)
+    except ValueError:
+        session.sendall(encode_message("info", chat_history.USAGE))
+        return
+
+    def replay(client):
+        frames = (encode_message("info", "".join(chat_history.format_message(*row) for row in page))
+                  for page in history.pages(**request))
+        for frame in itertools.chain(frames, [encode_message("info", "Server: End of history.\n")]):
+            data = session.codec.wire(frame)
+            client.sendall(data)
+            session.record_sent(len(data))
+            metrics.frame_sent(frame)
+
+    # The handler goes on reading while the writer streams the replay.
+    session.run(replay)
+
+
+def start_quiz(quiz, score_file, registry, quizzes):
+    """Start a quiz session by sending its questions to clients.
+
+    The question frame was encoded when the quiz was loaded, so this is
+    only the fan-out, followed by the id to answer the session by.
 
-    # Concatenate all questions and options into a single message
-    quiz_message = ""
-    for i, question in enumerate(quiz_questions):
-        question_message = f"Question {i+1}: {question}\n\nOptions: {' '.join(quiz_options[i])}\n\n-----------------------------\n\n"
-        quiz_message += question_message
+    Input Arguments:
+    - quiz (quiz_bank.Quiz): The quiz to start.
+    - score_file (str): The file to store scores in.
+    - registry (SessionRegistry): The active sessions.
+    - quizzes (QuizSessions): The quiz sessions of the server.
 
-    # Send quiz message to all clients
-    broadcast_message("quiz_question", quiz_message, CLIENTS)
+    Output Arguments:
+    - QuizSession: The new quiz session.
+    """
+    quiz_session = quizzes.start(quiz, score_file)
+    with metrics.BROADCAST_SECONDS.time():
+        registry.broadcast(quiz.frame)
+    broadcast_message("info", f"Server: Quiz {quiz_session.id} started, answer with "
+                              f"quiz_answer:{quiz_session.id}:<answer1> <answer2> ...\n", registry)
+    return quiz_session
 
-    return answers
 
+def evaluate_quiz(payload, session, quizzes):
+    """Score a client's quiz answers.
 
-def evaluate_quiz(answer, filename, client_socket, client_name, ANSWERS):
-    """Evaluate quiz answers and store scores.
+    The payload is "ID:ANSWERS", or just the answers for the latest quiz
+    that is still open. The answers are scored in a batch with others and
+    written to the score file in the background.
 
     Input Arguments:
-    - answer (str): The answers received from clients.
-    - filename (str): The name of the file to store scores.
-    - client_socket (socket object): client socket object.
-    - client_name (string): username of client.
-    - ANSWERS (list): List of correct answers.
+    - payload (str): The quiz_answer payload.
+    - session (Session): The session of the client.
+    - quizzes (QuizSessions): The quiz sessions of the server.
 
     Output Arguments:
     - None
     """
-    # Receive answers from clients and evaluate
-    scores = {}
-    scores[client_name] = 0
-    answers = answer.split()  # Split the string into individual answers
-    correct_answer = ANSWERS
+    session_id, separator, answers = payload.partition(":")
+    if separator and session_id.strip().isdigit():
+        session_id = int(session_id)
+    else:
+        session_id, answers = None, payload
+    quiz_session = quizzes.get(session_id)
+
+    if quiz_session is None:
+        message = "Server: No quiz is running.\n" if session_id is None else f"Server: There is no quiz {session_id}.\n"
+    elif not quiz_session.open:
+        message = f"Server: Quiz {quiz_session.id} has ended, answers are no longer taken.\n"
+    elif not quizzes.submit(quiz_session, session.username, answers):
+        message = "Quiz is over. Only your first answers count.\n"
+    else:
+        # Inform the client that the quiz is over for them
+        message = "Quiz is over. Thank you for participating!\n"
+    session.sendall(encode_message("info", message))
+
+
+def send_leaderboard(payload, session, quizzes):
+    """Send the best scores of a quiz session to a client.
+
+    The request is "leaderboard [QUIZ_ID] [COUNT]"; without an id the
+    latest quiz is shown.
 
-    for i in range(len(ANSWERS)):
-        if answers[i].lower() == correct_answer[i]:
-           scores[client_name] += 1
+    Input Arguments:
+    - payload (str): The cmd payload.
+    - session (Session): The session of the requesting client.
+    - quizzes (QuizSessions): The quiz sessions of the server.
 
-    directory_name = "all_quiz_scores"
-    file_path = os.path.join(os.getcwd(), directory_name, filename)
-    
-    if not os.path.exists(directory_name):
-        os.makedirs(directory_name)
-    
-    # Store scores in CSV file
-    with open(file_path, "a") as csv_file:
-        
-        for username, score in scores.items():
-            csv_file.write(f"{username},{score}\n")
-
-    # Inform clients that quiz is over
-    encoded_message = encode_message("info", "Quiz is over. Thank you for participating!\n")
-    client_socket.sendall(encoded_message)
+    Output Arguments:
+    - None
+    """
+    arguments = payload.split()[1:]
+    if len(arguments) > 2 or not all(argument.isdigit() for argument in arguments):
+        session.sendall(encode_message("info", quiz_sessions.LEADERBOARD_USAGE))
+        return
+
+    quiz_session = quizzes.latest() if not arguments else quizzes.get(int(arguments[0]))
+    if quiz_session is None:
+        session.sendall(encode_message("info", "Server: No such quiz.\n"))
+        return
+    count = int(arguments[1]) if len(arguments) == 2 else quiz_sessions.DEFAULT_TOP
+    session.sendall(encode_message("info", quiz_sessions.format_leaderboard(quiz_session, count)))
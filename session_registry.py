@@ -0,0 +1,425 @@
+import abc
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import Future
+
+import chat_rooms
+import framing
+import metrics
+
+# Frames a session may have waiting in its outbound queue before the slow
+# client policy applies. server.py overrides it from --send-queue-size.
+SEND_QUEUE_SIZE = 1024
+
+# What happens to a frame sent to a client whose queue is full: "drop" the
+# frame, or "disconnect" the client. server.py overrides it from
+# --slow-client-policy.
+SLOW_CLIENT_POLICY = "drop"
+
+# Seconds close() waits for queued frames to be written.
+CLOSE_TIMEOUT = 5
+
+# Write coalescing: once a frame is taken off an outbound queue the writer
+# waits up to COALESCE_WINDOW seconds for more frames, or until
+# COALESCE_BYTES are pending, and sends them with one write. 0 sends every
+# frame on its own. server.py overrides them from --coalesce-ms and
+# --coalesce-bytes. Threaded sessions turn on TCP_NODELAY while coalescing;
+# asyncio sets it on every connection already.
+COALESCE_WINDOW = 0
+COALESCE_BYTES = 64 * 1024
+
+# Returned by the batch collectors when no item was left over.
+NO_ITEM = object()
+
+
+class Session(abc.ABC):
+    """An authenticated client connection and its metadata.
+
+    Everything written to the client goes through one outbound queue that a
+    single writer drains, so a broadcast only costs the sender an append per
+    recipient, a stalled client cannot block anybody else, and frames from
+    different threads are never interleaved on the socket. Subclasses
+    provide the queue and the writer, and cannot be created without them.
+    """
+
+    # Whether run_async() accepts coroutine jobs from any thread, which
+    # lets a writer stream a file without tying up a worker thread.
+    coroutine_jobs = False
+
+    # Whether the client is connected to this process; chunked pushes
+    # (mux_transfers.push()) need the session's own writer.
+    local = True
+
+    def __init__(self, username, client, address, connected_at=None, codec=None):
+        """Initialize the session.
+
+        Input Arguments:
+        - username (str): The username the client logged in as.
+        - client (socket): The client socket, or a socket-like stream wrapper.
+        - address (tuple): The client address.
+        - connected_at (float): When the connection was accepted, now by default.
+        - codec (framing.Codec): The frame format agreed with the client,
+          version 1 by default.
+        """
+        self.username = username
+        self.client = client
+        self.address = address
+        self.connected_at = connected_at or time.time()
+        self.codec = codec or framing.V1
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.dropped = 0
+        self.closing = False
+        # When the client last sent something (time.monotonic()), and
+        # whether a file is on its way in or out; the idle reaper leaves
+        # sessions alone while either is recent or true.
+        self.last_active = time.monotonic()
+        self.receiving_file = False
+        self.running_job = False
+        # The token buckets of the client's rate limits
+        # (rate_limits.UserLimits), set by the server; None for no limits.
+        self.rate_limits = None
+        # The files the client is sending as chunk frames, by transfer id
+        # (mux_transfers.IncomingTransfer).
+        self.transfers = {}
+
+    def send(self, data):
+        """Queue a frame unless the client is too far behind.
+
+        Used for fan-out traffic. When SEND_QUEUE_SIZE frames are already
+        waiting the frame is dropped, and under the "disconnect" policy the
+        client is disconnected as well.
+
+        Input Arguments:
+        - data (bytes): The encoded frame.
+
+        Output Arguments:
+        - bool: True if the frame was queued.
+        """
+        if self.queue_depth >= SEND_QUEUE_SIZE:
+            self.dropped += 1
+            metrics.FRAMES_DROPPED.inc()
+            if SLOW_CLIENT_POLICY == "disconnect" and not self.closing:
+                self.closing = True
+                self.disconnect()
+            return False
+        self._enqueue(data)
+        return True
+
+    def sendall(self, data):
+        """Queue a frame regardless of the queue depth.
+
+        Used for replies to the client's own requests, which must not be
+        dropped. Returns as soon as the frame is queued.
+
+        Input Arguments:
+        - data (bytes): The encoded frame.
+
+        Output Arguments:
+        - None
+        """
+        self._enqueue(data)
+
+    def record_received(self, count):
+        """Add count bytes to the received byte counter and mark the session active."""
+        self.bytes_in += count
+        self.last_active = time.monotonic()
+        metrics.BYTES_IN.inc(amount=count)
+
+    def record_sent(self, count):
+        """Add count bytes to the sent byte counter."""
+        self.bytes_out += count
+        metrics.BYTES_OUT.inc(amount=count)
+
+    def _encode_batch(self, frames):
+        """Return the wire bytes of a batch of frames as one buffer."""
+        if len(frames) == 1:
+            return self.codec.wire(frames[0])
+        return b"".join([self.codec.wire(frame) for frame in frames])
+
+    def _record_batch(self, frames, data):
+        """Count a batch of frames written as data."""
+        self.record_sent(len(data))
+        for frame in frames:
+            metrics.frame_sent(frame)
+
+    @property
+    def busy(self):
+        """True while a file is being received from or written to the client."""
+        return self.receiving_file or self.running_job or bool(self.transfers)
+
+    @property
+    @abc.abstractmethod
+    def queue_depth(self):
+        """Number of items waiting in the outbound queue."""
+
+    @abc.abstractmethod
+    def _enqueue(self, item):
+        """Append an item to the outbound queue."""
+
+    @abc.abstractmethod
+    def run(self, job):
+        """Run job(client) on the writer once everything queued before it is sent.
+
+        While the job runs it has the socket to itself, which is how file
+        bodies are written without other frames getting in between.
+
+        Input Arguments:
+        - job (callable): Called with the client socket (or socket-like
+          wrapper); it may block.
+
+        Output Arguments:
+        - concurrent.futures.Future: Resolves to the job's return value.
+        """
+
+    @abc.abstractmethod
+    def disconnect(self):
+        """Abort the connection so the session's handler exits."""
+
+    @abc.abstractmethod
+    def close(self):
+        """Write what is still queued, then stop the writer."""
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.username!r}, {self.address!r})"
+
+
+class ThreadedSession(Session):
+    """Session for a blocking socket, drained by a dedicated writer thread."""
+
+    def __init__(self, username, client, address, connected_at=None, codec=None):
+        """Initialize the session and start its writer thread."""
+        super().__init__(username, client, address, connected_at, codec)
+        if COALESCE_WINDOW > 0:
+            # The writer already batches small frames; Nagle's algorithm
+            # would hold each batch back for another round trip.
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name=f"writer-{username}", daemon=True)
+        self._writer.start()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _enqueue(self, item):
+        self._queue.put(item)
+
+    def run(self, job):
+        future = Future()
+        self._queue.put((job, future))
+        return future
+
+    def _collect(self, frames):
+        """Add frames queued within COALESCE_WINDOW to a batch.
+
+        Input Arguments:
+        - frames (list): The batch, holding the frame already taken.
+
+        Output Arguments:
+        - object: The first non-frame item taken off the queue, or NO_ITEM.
+        """
+        size = len(frames[0])
+        deadline = time.monotonic() + COALESCE_WINDOW
+        while size < COALESCE_BYTES:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                # One sleep for the rest of the window is much cheaper than
+                # a timed wait on the queue per frame.
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                time.sleep(remaining)
+                continue
+            if not isinstance(item, bytes):
+                return item
+            frames.append(item)
+            size += len(item)
+        return NO_ITEM
+
+    def _write_loop(self):
+        """Write queued frames and run queued jobs until close()."""
+        failed = False
+        leftover = NO_ITEM
+        while True:
+            if leftover is NO_ITEM:
+                item = self._queue.get()
+            else:
+                item, leftover = leftover, NO_ITEM
+            if item is None:
+                self._abandon_jobs()
+                return
+
+            if isinstance(item, bytes):
+                if failed:
+                    continue
+                frames = [item]
+                if COALESCE_WINDOW > 0:
+                    leftover = self._collect(frames)
+                try:
+                    data = self._encode_batch(frames)
+                    self.client.sendall(data)
+                    self._record_batch(frames, data)
+                except OSError:
+                    # The reading side sees the broken socket and cleans up;
+                    # remaining frames are discarded.
+                    failed = True
+                continue
+
+            # Jobs run even on a broken socket: they may have to drain a
+            # producer that would otherwise block forever.
+            job, future = item
+            if future.set_running_or_notify_cancel():
+                self.running_job = True
+                try:
+                    future.set_result(job(self.client))
+                except BaseException as error:
+                    future.set_exception(error)
+                finally:
+                    self.running_job = False
+
+    def _abandon_jobs(self):
+        """Fail the jobs queued after close(), which will never run."""
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(item, tuple) and item[1].set_running_or_notify_cancel():
+                item[1].set_exception(ConnectionError("the session was closed"))
+
+    def disconnect(self):
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.closing = True
+        self._queue.put(None)
+        if threading.current_thread() is not self._writer:
+            self._writer.join(CLOSE_TIMEOUT)
+
+
+class SessionRegistry:
+    """Thread-safe index of active sessions by username and by client.
+
+    Replaces the ACTIVE_USERS dict and CLIENTS list: lookups, inserts and
+    removals are dictionary operations, so routing a private message or a
+    file costs the same with ten sessions as with ten thousand. The chat
+    rooms of the sessions are kept here too, and a session leaves its
+    rooms when it is removed.
+    """
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self._lock = threading.Lock()
+        self._by_username = {}
+        self._by_client = {}
+        self.rooms = chat_rooms.Rooms()
+
+    def add(self, session):
+        """Register a session.
+
+        Input Arguments:
+        - session (Session): The session to add.
+
+        Output Arguments:
+        - bool: False if the username already has an active session.
+        """
+        with self._lock:
+            if session.username in self._by_username:
+                return False
+            self._by_username[session.username] = session
+            self._by_client[session.client] = session
+            return True
+
+    def remove(self, session):
+        """Unregister a session. Removing an unknown session is a no-op.
+
+        Input Arguments:
+        - session (Session): The session to remove.
+
+        Output Arguments:
+        - bool: True if the session was registered.
+        """
+        with self._lock:
+            if self._by_username.get(session.username) is not session:
+                return False
+            del self._by_username[session.username]
+            del self._by_client[session.client]
+        self.rooms.leave_all(session)
+        return True
+
+    def get(self, username):
+        """Return the session of a username, or None if not logged in."""
+        return self._by_username.get(username)
+
+    def for_client(self, client):
+        """Return the session that owns a client socket, or None."""
+        return self._by_client.get(client)
+
+    def sessions(self):
+        """Return a snapshot list of all sessions."""
+        with self._lock:
+            return list(self._by_username.values())
+
+    def usernames(self):
+        """Return a snapshot list of all logged in usernames."""
+        with self._lock:
+            return list(self._by_username)
+
+    def broadcast(self, frame, exclude=None):
+        """Queue a frame for every session except one.
+
+        Input Arguments:
+        - frame (bytes): The encoded frame.
+        - exclude (Session): The session to skip, if any.
+
+        Output Arguments:
+        - None
+        """
+        for session in self.sessions():
+            if session is not exclude:
+                session.send(frame)
+
+    def publish(self, room, frame, exclude=None, record=False):
+        """Queue a frame for the members of a room.
+
+        Input Arguments:
+        - room (str): The room name.
+        - frame (bytes): The encoded frame.
+        - exclude (Session): The session to skip, if any.
+        - record (bool): Keep the frame for replay to later members.
+
+        Output Arguments:
+        - None
+        """
+        self.rooms.publish(room, frame, exclude, record)
+
+    def queue_stats(self):
+        """Summarise the outbound queues of all sessions.
+
+        Output Arguments:
+        - dict: Session count, total and maximum queue depth, the deepest
+          queue's username and the number of frames dropped so far.
+        """
+        sessions = self.sessions()
+        depths = [(session.queue_depth, session.username) for session in sessions]
+        deepest = max(depths, default=(0, None))
+        return {
+            "sessions": len(sessions),
+            "queued_frames": sum(depth for depth, _ in depths),
+            "max_queue_depth": deepest[0],
+            "deepest_queue": deepest[1],
+            "dropped_frames": sum(session.dropped for session in sessions),
+        }
+
+    def __len__(self):
+        return len(self._by_username)
+
+    def __contains__(self, username):
+        return username in self._by_username
@@ -0,0 +1,301 @@
+import collections
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+# Connections kept open for credential lookups. server.py overrides it from
+# --db-pool-size.
+POOL_SIZE = 8
+
+# Most writes (registrations and password rehashes) committed in one
+# transaction, and how long (seconds) the writer waits for more writes to
+# join a batch once it has one.
+BATCH_SIZE = 64
+BATCH_INTERVAL = 0.005
+
+# Credentials kept in memory, and for how many seconds a cached entry is
+# trusted before it is read from users.db again. server.py overrides them
+# from --credential-cache-size and --credential-cache-ttl.
+CACHE_SIZE = 10000
+CACHE_TTL = 300
+
+# Seconds a connection waits for a lock held by another connection before
+# sqlite3 raises "database is locked".
+BUSY_TIMEOUT = 30
+
+# The statements are module constants so that every pooled connection
+# compiles each of them once and then reuses it from its statement cache.
+CREATE_TABLE = "CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT)"
+SELECT_USERNAME = "SELECT 1 FROM users WHERE username=?"
+SELECT_PASSWORD = "SELECT password FROM users WHERE username=?"
+SELECT_RECENT = "SELECT username, password FROM users ORDER BY rowid DESC LIMIT ?"
+INSERT_USER = "INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)"
+UPDATE_PASSWORD = "UPDATE users SET password=? WHERE username=?"
+
+
+def connect(db_path):
+    """Open a connection to the users database in WAL mode.
+
+    With write-ahead logging readers never wait for the writer, and
+    synchronous=NORMAL only syncs the log at checkpoints, which is still safe
+    against application crashes.
+
+    Input Arguments:
+    - db_path (str): Path of the users database.
+
+    Output Arguments:
+    - sqlite3.Connection: The connection, usable from any thread.
+    """
+    connection = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class CredentialCache:
+    """Bounded LRU map of usernames to password hashes with a time to live.
+
+    Only registered users are cached, so a hit proves that the username is
+    taken and carries the hash to check a login against. When the cache is
+    full the least recently used entry is evicted.
+    """
+
+    def __init__(self, max_entries=None, ttl=None):
+        """Initialize an empty cache.
+
+        Input Arguments:
+        - max_entries (int): Most entries held, CACHE_SIZE by default.
+        - ttl (float): Seconds an entry stays valid, CACHE_TTL by default.
+        """
+        self.max_entries = CACHE_SIZE if max_entries is None else max_entries
+        self.ttl = CACHE_TTL if ttl is None else ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, username):
+        """Return the cached hash of a username, or None on a miss.
+
+        Input Arguments:
+        - username (str): The username to look up.
+
+        Output Arguments:
+        - str: The password hash, or None if not cached or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[username]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, username, hashed_password):
+        """Cache the hash of a registered user.
+
+        Input Arguments:
+        - username (str): The username.
+        - hashed_password (str): The password hash stored in users.db.
+
+        Output Arguments:
+        - None
+        """
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[username] = (hashed_password, time.monotonic() + self.ttl)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, username):
+        """Forget a username."""
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def stats(self):
+        """Return the entry count and the hit, miss and eviction counters."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class UserStore:
+    """Registered users in users.db, shared by every client handler.
+
+    Credential lookups borrow a connection from a bounded pool instead of
+    opening the database per client. Registrations are handed to a single
+    writer thread that commits whatever has queued up in one transaction, so
+    a burst of sign-ups costs a few commits rather than one each. A
+    CredentialCache in front of the pool answers lookups for recently seen
+    users without touching the disk.
+    """
+
+    def __init__(self, db_path="users.db", pool_size=None, cache=None):
+        """Open the pool, create the users table, warm the cache and start the writer.
+
+        Input Arguments:
+        - db_path (str): Path of the users database.
+        - pool_size (int): Number of read connections, POOL_SIZE by default.
+        - cache (CredentialCache): The credential cache, a default sized one
+          when None.
+        """
+        self.db_path = db_path
+        self.pool_size = pool_size or POOL_SIZE
+        self._writer_connection = connect(db_path)
+        self._writer_connection.execute(CREATE_TABLE)
+        self._writer_connection.commit()
+
+        self._pool = queue.LifoQueue()
+        for _ in range(self.pool_size):
+            self._pool.put(connect(db_path))
+
+        # Warm the cache with the most recently registered users.
+        self.cache = cache if cache is not None else CredentialCache()
+        if self.cache.max_entries > 0:
+            rows = self._writer_connection.execute(SELECT_RECENT, (self.cache.max_entries,)).fetchall()
+            for username, hashed_password in reversed(rows):
+                self.cache.put(username, hashed_password)
+
+        self._pending = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="users-db-writer", daemon=True)
+        self._writer.start()
+
+    def _query(self, statement, parameters):
+        """Run a read-only statement on a pooled connection and return the first row."""
+        with metrics.DB_SECONDS.time("read"):
+            connection = self._pool.get()
+            try:
+                return connection.execute(statement, parameters).fetchone()
+            finally:
+                self._pool.put(connection)
+
+    def password_hash(self, username):
+        """Return the stored password hash of a user.
+
+        Served from the cache when possible; a hash read from users.db is
+        cached for the next lookup.
+
+        Input Arguments:
+        - username (str): The username to look up.
+
+        Output Arguments:
+        - str: The password hash, or None if the user is not registered.
+        """
+        hashed_password = self.cache.get(username)
+        if hashed_password is None:
+            row = self._query(SELECT_PASSWORD, (username,))
+            if row is None:
+                return None
+            hashed_password = row[0]
+            self.cache.put(username, hashed_password)
+        return hashed_password
+
+    def username_exists(self, username):
+        """Check if a username is registered.
+
+        Input Arguments:
+        - username (str): The username to check.
+
+        Output Arguments:
+        - bool: True if the username is taken, False otherwise.
+        """
+        if self.cache.get(username) is not None:
+            return True
+        return self._query(SELECT_USERNAME, (username,)) is not None
+
+    def add_user(self, username, hashed_password):
+        """Register a new user and wait until the row is committed.
+
+        Input Arguments:
+        - username (str): The username of the new user.
+        - hashed_password (str): The hashed password of the new user.
+
+        Output Arguments:
+        - bool: False if the username was registered in the meantime.
+        """
+        added = self._write(INSERT_USER, (username, hashed_password))
+        if added:
+            self.cache.put(username, hashed_password)
+        return added
+
+    def update_password(self, username, hashed_password):
+        """Replace the stored password hash of a user and wait for the commit.
+
+        Input Arguments:
+        - username (str): The username of the user.
+        - hashed_password (str): The new password hash.
+
+        Output Arguments:
+        - bool: False if the user does not exist.
+        """
+        updated = self._write(UPDATE_PASSWORD, (hashed_password, username))
+        if updated:
+            self.cache.put(username, hashed_password)
+        return updated
+
+    def _write(self, statement, parameters):
+        """Queue a statement for the writer and return whether it changed a row."""
+        with metrics.DB_SECONDS.time("write"):
+            future = Future()
+            self._pending.put((statement, parameters, future))
+            return future.result()
+
+    def _write_loop(self):
+        """Commit queued writes in batches until close()."""
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            batch = [item]
+
+            # Give concurrent writes a moment to join the transaction.
+            while len(batch) < BATCH_SIZE:
+                try:
+                    item = self._pending.get(timeout=BATCH_INTERVAL)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._pending.put(None)
+                    break
+                batch.append(item)
+
+            try:
+                with self._writer_connection:
+                    changed = [
+                        self._writer_connection.execute(statement, parameters).rowcount == 1
+                        for statement, parameters, _ in batch
+                    ]
+            except sqlite3.Error as error:
+                for _, _, future in batch:
+                    future.set_exception(error)
+                continue
+
+            for (_, _, future), result in zip(batch, changed):
+                future.set_result(result)
+
+    def close(self):
+        """Commit outstanding writes and close every connection."""
+        self._pending.put(None)
+        self._writer.join()
+        self._writer_connection.close()
+        while not self._pool.empty():
+            self._pool.get().close()